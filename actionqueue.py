@@ -1,5 +1,41 @@
-from time import time
-from queue import Empty, PriorityQueue, Queue
+import heapq
+from asyncio import get_running_loop
+from collections import namedtuple
+from itertools import count
+from threading import Condition
+from time import monotonic, time
+from latency import current_trace, tracing
+from pbasync import LoopEvent
+
+# How one lane of an ActionQueue is to be treated.
+# - weight: how many actions from this lane are done, relative to the other
+#   lanes' weights, when they all have actions waiting
+# - max_depth: how many actions may wait in this lane. Any more are dropped.
+#   0 means there is no limit.
+# - max_wait: if not None, an action that has waited this many seconds is
+#   done next, ahead of every other lane's
+Lane = namedtuple('Lane', ['weight', 'max_depth', 'max_wait'])
+
+DEFAULT_LANES = {'default': Lane(weight=1, max_depth=0, max_wait=None)}
+
+
+class _LaneQueue:
+    __slots__ = ['name', 'lane', 'heap', 'pass_', 'done', 'dropped',
+                 'wait_seconds', 'max_wait_seconds']
+
+    def __init__(self, name, lane):
+        self.name = name
+        self.lane = lane
+        # (priority, seq, enqueued_at, func, args, kwargs, trace), where
+        # enqueued_at is a monotonic() time and trace is the
+        # latency.current_trace() when the action was added
+        self.heap = []
+        # Virtual time at which this lane next deserves a turn
+        self.pass_ = 0.0
+        self.done = 0
+        self.dropped = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
 
 
 class ActionQueue:
@@ -10,20 +46,63 @@ class ActionQueue:
     arguments. A priority may also be specified. Lower priority items will be
     handled first.
 
+    Actions can also be put in different lanes, given as a dict of lane
+    names to Lanes. Priority only orders actions within one lane. Between
+    lanes with actions waiting, each lane gets turns in proportion to its
+    weight (stride scheduling), so a busy lane can't starve a quiet one, and
+    a lane with a max_wait jumps ahead of the others if its oldest action
+    has waited that long. Actions given an unknown lane, or none, go in the
+    'default' lane. How long every action waited is kept track of, see
+    stats().
+
     The controlling thread should repeatedly call loop_once(), most likely in a
     (near) infinite main loop. It is up to the controlling thread to realize
-    if/when it is time to shutdown and quit. '''
+    if/when it is time to shutdown and quit.
+
+    Everything waiting is kept in the lanes' heaps, all protected by one
+    condition variable. An add() is visible to the controlling thread in its
+    place as soon as add() returns, and wakes it up if it is waiting. While
+    there are actions waiting, the controlling thread sleeps exactly until
+    time_between_actions_func says the next one may be done. '''
 
-    def __init__(self, long_timeout=10, time_between_actions_func=None):
+    def __init__(self, long_timeout=10, time_between_actions_func=None,
+                 loop=None, after_actions_func=None, lanes=None):
         ''' long_timeout is how long loop_once() will block when there is
         nothing to do.
 
         time_between_actions_func is a function called after every action to
         determine how long we must wait before executing another action. The
         function must take one argument: a variable holding its state. It
-        must return a tuple: (time_to_wait, new_state). '''
-        self._incoming_queue = Queue()
-        self._action_queue = PriorityQueue()
+        must return a tuple: (time_to_wait, new_state).
+
+        Every action that time_between_actions_func allows to happen right
+        away is done in the same loop_once(). after_actions_func, if given, is
+        called with no arguments after each such batch of actions. It is the
+        place to flush anything the actions buffered.
+
+        loop is the asyncio event loop the controlling coroutine runs on, if
+        it is a coroutine calling loop_once_async() instead of a thread
+        calling loop_once().
+
+        lanes is a dict of lane names to Lanes. It should have a 'default'
+        lane, which is added if it doesn't. '''
+        # Protects everything about the lanes, and is notified on every add()
+        self._cond = Condition()
+        # Also set on every add() when the controlling coroutine waits on it
+        self._wakeup = None if loop is None else LoopEvent(loop)
+        lanes = dict(lanes or DEFAULT_LANES)
+        lanes.setdefault('default', DEFAULT_LANES['default'])
+        self._lanes = {name: _LaneQueue(name, lane)
+                       for name, lane in lanes.items()}
+        self._urgent_lanes = [lq for lq in self._lanes.values()
+                              if lq.lane.max_wait is not None]
+        # The pass_ of the lane that had the last turn
+        self._vtime = 0.0
+        # Number of actions waiting in all lanes
+        self._queued = 0
+        # Breaks ties between actions with the same priority, so they are
+        # done in the order they came in
+        self._seq = count()
         # A function pointer that is called after every action to caclulate
         # the amount of time to wait before executing the next action in the
         # priority queue. The function takes one argument, a variable for
@@ -36,18 +115,23 @@ class ActionQueue:
             self._time_between_actions_func = \
                 ActionQueue.__default_time_between_actions_func
         self._time_between_actions_func_state = None
-        # timestamp at which we can perform another action, as calculated by
-        # the current time + return value from time_between_actions_func
+        self._after_actions_func = after_actions_func
+        # monotonic() time at which we can perform another action, as
+        # calculated by the current time + return value from
+        # time_between_actions_func
         self._next_action = 0
+        # How many times, and for how many seconds in all,
+        # time_between_actions_func made us wait before the next action
+        self.rate_limited = 0
+        self.rate_limit_seconds = 0.0
         # Number of seconds to wait for a new action to come in via
-        # self.add(...) when we have no actions in the priority queue.
-        # Too low, and we hurt CPU by abusively busy waiting.
-        # Too high, and we don't react to the controlling process wanting to
-        # shut down very quickly
+        # self.add(...) when we have no actions in the lanes. add() wakes us
+        # up, so this only matters for how quickly we react to the
+        # controlling process wanting to shut down.
         self._long_timeout = long_timeout
 
     # This function should be called by the main thread to add an action to
-    # this thread's priority queue through this inter-thread FIFO.
+    # this thread's priority queue.
     # - func is the function to call in this thread
     # - args is an optional list of arguments to pass to the function
     # - kwargs is an optional dictionary of arguments to pass to the function
@@ -61,10 +145,38 @@ class ActionQueue:
     #   ActionQueue is essentially a FIFO queue in its own thread. NOTE: while
     #   priority defaults to time, that does NOT mean setting
     #   priority == time()+5 means the item will be processed after 5 seconds.
-    def add(self, func, args=None, kwargs=None, priority=None):
+    # - lane is the name of the lane to put the action in
+    def add(self, func, args=None, kwargs=None, priority=None, lane=None):
         if priority is None:
             priority = time()
-        self._incoming_queue.put((priority, (func, args, kwargs)))
+        with self._cond:
+            lq = self._lanes.get(lane) or self._lanes['default']
+            if lq.lane.max_depth and len(lq.heap) >= lq.lane.max_depth:
+                lq.dropped += 1
+                return
+            if not lq.heap:
+                # Don't let a lane that was idle make up for the turns it
+                # didn't need by taking all of the next ones
+                lq.pass_ = max(lq.pass_, self._vtime)
+            heapq.heappush(lq.heap, (priority, next(self._seq), monotonic(),
+                                     func, args, kwargs, current_trace()))
+            self._queued += 1
+            self._cond.notify()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stats(self):
+        ''' Return a dict of lane names to dicts with how many actions are
+        waiting in the lane, how many were done and dropped, and the total
+        and max seconds that the done ones waited '''
+        with self._cond:
+            return {lq.name: {
+                'queued': len(lq.heap),
+                'done': lq.done,
+                'dropped': lq.dropped,
+                'wait_seconds': lq.wait_seconds,
+                'max_wait_seconds': lq.max_wait_seconds,
+            } for lq in self._lanes.values()}
 
     # A very simple time_between_actions_func that instructs the ActionQueue
     # to not wait at all between actions. All time_between_actions_func's must
@@ -73,56 +185,108 @@ class ActionQueue:
     def __default_time_between_actions_func(state):
         return 0, None
 
-    def __process_incoming_queue(self, timeout):
-        try:
-            item = self._incoming_queue.get(timeout=timeout)
-        except Empty:
-            item = None
-        if item is not None:
-            self._action_queue.put(item)
+    def __next_lane(self, now):
+        ''' Return the lane whose turn it is, or None if they are all empty.
+        Must hold self._cond. '''
+        urgent = None
+        for lq in self._urgent_lanes:
+            # The first action in the lane is the oldest unless priorities
+            # were given, in which case it's the one that matters most
+            if lq.heap and now - lq.heap[0][2] >= lq.lane.max_wait and \
+                    (urgent is None or lq.heap[0][2] < urgent.heap[0][2]):
+                urgent = lq
+        if urgent is not None:
+            return urgent
+        best = None
+        for lq in self._lanes.values():
+            if lq.heap and (best is None or lq.pass_ < best.pass_):
+                best = lq
+        return best
 
     def loop_once(self):
-        time_to_wait = None
-
-        # first make sure enough time has passed since our last action
-        if time() >= self._next_action:
-            # get an action out of the priority queue
-            try:
-                item = self._action_queue.get_nowait()
-            except Empty:
-                item = None
-            # if we got one, then handle it
-            if item is not None:
-                # item comes in as (priority, (func, args=[], kwargs={}) )
-                func, args, kwargs = item[1]
-                if args is None and kwargs is None:
-                    func()
-                elif args and kwargs is None:
-                    func(*args)
-                elif kwargs and args is None:
-                    func(**kwargs)
-                else:
-                    func(*args, **kwargs)
-                # now run the _time_between_actions_func to determine how long
-                # we must wait before processing another event
-                old_state = self._time_between_actions_func_state
-                time_to_wait, new_state = \
-                    self._time_between_actions_func(old_state)
-                self._time_between_actions_func_state = new_state
-                self._next_action = time() + time_to_wait
-
-        # Now we have handled zero or one actions from the priority queue and
-        # are done with it for this loop. We should see if there are any more
-        # actions in the incoming queue to add to the priority queue.
-
-        # if there is nothing in the priority queue, we can afford to wait a
-        # long time for a new action to come in.
-        if self._action_queue.empty():
-            self.__process_incoming_queue(timeout=self._long_timeout)
-        # if there is another action waiting in the priority queue, we can only
-        # afford to wait for the remaining time until we should perform it
+        self.__do_actions()
+        with self._cond:
+            timeout = self.__wait_timeout()
+            if timeout > 0:
+                self._cond.wait(timeout)
+
+    async def loop_once_async(self):
+        ''' Like loop_once(), but for a controlling coroutine. Actions may
+        block (writing to ii's FIFOs does until ii reads them), so they are
+        done in the loop's default executor instead of on the loop itself. '''
+        await get_running_loop().run_in_executor(None, self.__do_actions)
+        # Clear before looking, so an add() after we look wakes us up
+        self._wakeup.clear()
+        with self._cond:
+            timeout = self.__wait_timeout()
+        if timeout > 0:
+            await self._wakeup.wait(timeout)
+
+    def __do_actions(self):
+        did_action = False
+        while self.__do_action():
+            did_action = True
+        if did_action and self._after_actions_func:
+            self._after_actions_func()
+
+    def __do_action(self):
+        ''' Do the next action if there is one and enough time has passed
+        since our last. Returns whether we did one. '''
+        with self._cond:
+            now = monotonic()
+            # first make sure enough time has passed since our last action
+            if now < self._next_action:
+                return False
+            # get an action out of the lane whose turn it is
+            lq = self.__next_lane(now)
+            if lq is None:
+                return False
+            item = heapq.heappop(lq.heap)
+            self._queued -= 1
+            self._vtime = lq.pass_
+            lq.pass_ += 1.0 / lq.lane.weight
+            waited = now - item[2]
+            lq.done += 1
+            lq.wait_seconds += waited
+            lq.max_wait_seconds = max(lq.max_wait_seconds, waited)
+        # Call it without holding the lock, so add() never waits on an action
+        func, args, kwargs, trace = item[3:]
+        if trace is None:
+            ActionQueue.__call(func, args, kwargs)
+        else:
+            # Keep following the line it was done for, if any
+            with tracing(trace.stage_done('outbound_queue')):
+                ActionQueue.__call(func, args, kwargs)
+        # now run the _time_between_actions_func to determine how long
+        # we must wait before processing another event
+        old_state = self._time_between_actions_func_state
+        time_to_wait, new_state = \
+            self._time_between_actions_func(old_state)
+        self._time_between_actions_func_state = new_state
+        self._next_action = monotonic() + time_to_wait
+        if time_to_wait > 0:
+            self.rate_limited += 1
+            self.rate_limit_seconds += time_to_wait
+        return True
+
+    @staticmethod
+    def __call(func, args, kwargs):
+        if args is None and kwargs is None:
+            func()
+        elif args and kwargs is None:
+            func(*args)
+        elif kwargs and args is None:
+            func(**kwargs)
         else:
-            timeout = self._next_action - time()
-            if timeout < 0:
-                timeout = 0
-            self.__process_incoming_queue(timeout=timeout)
+            func(*args, **kwargs)
+
+    def __wait_timeout(self):
+        ''' How long to wait before there might be something to do. Must
+        hold self._cond. '''
+        # if there is nothing in the lanes, we can afford to wait a long time
+        # for a new action to come in. add() wakes us up if one does.
+        if not self._queued:
+            return self._long_timeout
+        # if there is another action waiting, we only need to wait for the
+        # remaining time until we may perform it
+        return max(0, self._next_action - monotonic())
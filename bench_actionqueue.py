@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+''' Measure how long it takes an ActionQueue to get from add() to calling the
+action, with the lanes the OutboundMessageThread uses and no rate limit.
+
+    ./bench_actionqueue.py [--count N] [--interval SECONDS] [--asyncio]
+
+Three cases are run:
+- trickle: one add() every --interval seconds, so the queue is idle (and
+  the controlling thread asleep) before each one
+- burst: --count add()s at once from another thread
+- mixed: a burst of log lines with one moderation action added in the
+  middle of it '''
+import asyncio
+import time
+from argparse import ArgumentParser
+from threading import Event, Thread
+from actionqueue import ActionQueue
+from outboundmessagethread import LANES
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, latencies):
+    ms = [lat * 1000 for lat in latencies]
+    print('{:8} n={:<6} p50={:8.3f}ms p99={:8.3f}ms max={:8.3f}ms'.format(
+        name, len(ms), percentile(ms, 50), percentile(ms, 99), max(ms)))
+
+
+class Consumer:
+    ''' Runs an ActionQueue's loop in a thread or on an event loop in a
+    thread, like OutboundMessageThread does '''
+    def __init__(self, use_asyncio):
+        self._stop = Event()
+        self._loop = asyncio.new_event_loop() if use_asyncio else None
+        # Without depth limits, so nothing is dropped
+        lanes = {name: lane._replace(max_depth=0)
+                 for name, lane in LANES.items()}
+        self.queue = ActionQueue(long_timeout=5, loop=self._loop, lanes=lanes)
+        if use_asyncio:
+            self._thread = Thread(target=self._run_async)
+        else:
+            self._thread = Thread(target=self._run)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.queue.loop_once()
+
+    def _run_async(self):
+        async def run():
+            while not self._stop.is_set():
+                await self.queue.loop_once_async()
+        self._loop.run_until_complete(run())
+
+    def stop(self):
+        self._stop.set()
+        self.queue.add(lambda: None)
+        self._thread.join()
+
+
+def run_case(consumer, count, interval, lanes):
+    ''' add() count actions with the given lanes (cycled through), sleeping
+    interval seconds between each, and return the latencies of each '''
+    latencies = [None] * count
+    done = Event()
+
+    def action(i, added_at):
+        latencies[i] = time.perf_counter() - added_at
+        if i == count - 1:
+            done.set()
+
+    for i in range(count):
+        consumer.queue.add(action, [i, time.perf_counter()],
+                           lane=lanes[i % len(lanes)])
+        if interval:
+            time.sleep(interval)
+    done.wait()
+    return latencies
+
+
+def main(args):
+    consumer = Consumer(args.asyncio)
+    try:
+        report('trickle', run_case(
+            consumer, min(args.count, 500), args.interval, ['default']))
+        report('burst', run_case(consumer, args.count, 0, ['default']))
+        lanes = ['log'] * (args.count // 2) + ['moderation'] + \
+            ['log'] * (args.count - args.count // 2 - 1)
+        latencies = run_case(consumer, args.count, 0, lanes)
+        report('mixed', latencies)
+        print('{:8} moderation action: {:.3f}ms'.format(
+            '', latencies[args.count // 2] * 1000))
+    finally:
+        consumer.stop()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--interval', type=float, default=0.002)
+    parser.add_argument('--asyncio', action='store_true')
+    main(parser.parse_args())
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+''' Replay recorded ii out files through the real parsing and ChanOpThread
+detection logic as fast as possible, to see how many lines a second we can
+keep up with.
+
+    ./bench_replay.py SERVER_DIR [--config FILE] [--capture FILE]
+                      [--log FILE] [--log-level LEVEL]
+
+SERVER_DIR is laid out like ii's directory for a server: the server's out
+file at the top, and one directory per channel (or nick, for private
+messages) with an out file in it. Lines from all the files are replayed in
+the order of their timestamps. Channel lines go to that channel's
+ChanOpThread and server lines to all of them. Private messages are only
+parsed, since they would be commands from masters.
+
+The config (config.ini by default) gives the patterns and limits to moderate
+with. The channels moderated are the ones in SERVER_DIR, not the config's.
+
+Each line is handled in this thread, one after the other, instead of being
+queued for the ChanOpThreads' own threads. Operator actions are sent as soon
+as the line that led to them is handled, as if we were always opped. What
+would be written to the server's in FIFO goes to a capture sink instead,
+through a real OutboundMessageThread without a rate limit, and to --capture
+if given.
+
+Reported are lines per second, how many messages each detector caught, what
+was sent, the time each line took to handle, and the latency of each stage
+(see latency.py) of the commands that were sent.
+
+The flood and slow highlight spam detectors go by the time lines are
+replayed, not when they were recorded, so they catch a lot more than they
+would have at the time. '''
+import os
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from heapq import merge
+from chanopthread import ChanOpThread
+from heartbeatthread import HeartbeatThread
+from iievent import parse_line
+from latency import LatencyHistogram, latencies, stage_started, tracing
+from main import new_global_state
+from operatorbatch import OperatorBatch
+from outboundmessagethread import OutboundMessageThread
+from pastlylogger import PastlyLogger
+
+
+def recorded_files(server_dir):
+    ''' Return a list of (source, channel name, path) for the out files in
+    server_dir '''
+    files = []
+    path = os.path.join(server_dir, 'out')
+    if os.path.isfile(path):
+        files.append(('serv', None, path))
+    for name in sorted(os.listdir(server_dir)):
+        path = os.path.join(server_dir, name, 'out')
+        if not os.path.isfile(path):
+            continue
+        if name[:1] in '#&':
+            files.append(('chan', name, path))
+        else:
+            files.append(('priv', None, path))
+    return files
+
+
+def read_lines(source, channel_name, path):
+    ''' Yield (timestamp, source, channel name, line) for each line in path '''
+    with open(path, 'rt', errors='replace') as fd:
+        for line in fd:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            timestamp = ' '.join(line.split(None, 2)[:2])
+            yield timestamp, source, channel_name, line
+
+
+def command_kind(line):
+    ''' What kind of command a line to ii is, like "/kick" or "chanserv
+    akick" '''
+    words = line.split(None, 3)
+    if len(words) >= 3 and words[0] == '/privmsg' and \
+            words[1].lower() == 'chanserv':
+        return 'chanserv ' + words[2].lower()
+    return words[0] if words else ''
+
+
+class CaptureSink:
+    ''' Stands in for the FifoWriter to the server's in FIFO. Counts the
+    lines that would have been written, by command_kind(), and writes them
+    to a file if given one. '''
+    def __init__(self, fname=None):
+        self._fd = open(fname, 'wt') if fname else None
+        self._pending = []
+        self.commands = Counter()
+        self.writes = 0
+        self.write_seconds = 0.0
+
+    def add(self, line):
+        self._pending.append(line)
+
+    def flush(self):
+        if not self._pending:
+            return None
+        lines, self._pending = self._pending, []
+        start = time.perf_counter()
+        for line in lines:
+            self.commands[command_kind(line)] += 1
+        if self._fd:
+            self._fd.write(''.join(line + '\n' for line in lines))
+        elapsed = time.perf_counter() - start
+        self.writes += 1
+        self.write_seconds += elapsed
+        return elapsed
+
+    def close(self):
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
+
+class ReplayOperatorActions:
+    ''' Stands in for a channel's OperatorActionThread. Always opped, so
+    there is nothing to wait for: the mode changes and kicks asked for while
+    handling a line are sent, batched like the real thread does, when
+    flush() is called after it. '''
+    def __init__(self, channel_name, out_msg, kick_targets=4):
+        self._channel_name = channel_name
+        self._out_msg = out_msg
+        self._batch = OperatorBatch(kick_targets)
+        self._traces = []
+        self._muted = False
+
+    def recv_action(self, *args, **kwargs):
+        self._out_msg.add(*args, **kwargs)
+
+    def temporary_mute(self, enabled=True):
+        # Never unmuted, since the replay doesn't wait for timers
+        if enabled and not self._muted:
+            self._muted = True
+            self.set_chan_mode('+RM', 'temporary mute')
+
+    def set_chan_mode(self, mode_str, reason):
+        self._queued()
+        self._batch.add_mode(mode_str)
+
+    def kick_nick(self, nick, reason):
+        self._queued()
+        self._batch.add_kick(nick, reason)
+
+    def set_opped(self, opped):
+        pass
+
+    def _queued(self):
+        trace = stage_started()
+        if trace is not None:
+            self._traces.append(trace)
+
+    def flush(self):
+        if not len(self._batch):
+            return
+        trace = min(self._traces, key=lambda t: t.received_at, default=None)
+        self._traces = []
+        out_msg = self._out_msg
+        with tracing(trace):
+            for command in self._batch.commands(self._channel_name):
+                out_msg.add(out_msg.servmsg, [command], {'log_it': True},
+                            lane='moderation')
+
+
+def create(args, channel_names, sink):
+    gs = new_global_state(args.config)
+    if args.log:
+        gs['log'] = PastlyLogger(debug=args.log, overwrite=['debug'],
+                                 log_threads=True, level=args.log_level,
+                                 async_writes=True)
+    else:
+        gs['log'] = PastlyLogger()
+    gs['threads']['heart'] = HeartbeatThread(gs)
+    out_msg = OutboundMessageThread(gs, long_timeout=0.1, server_in=sink)
+    gs['threads']['out_message'] = out_msg
+    kick_targets = gs['conf'].getint('op_actions', 'kick_targets', fallback=4)
+    for channel_name in channel_names:
+        gs['threads']['op_actions'][channel_name] = ReplayOperatorActions(
+            channel_name, out_msg, kick_targets)
+        gs['threads']['chan_ops'][channel_name] = \
+            ChanOpThread(gs, channel_name)
+    return gs
+
+
+def replay(gs, files, handle_times):
+    ''' Handle every line in files. Returns a Counter of lines by source. '''
+    chanops = gs['threads']['chan_ops']
+    op_actions = gs['threads']['op_actions']
+    counts = Counter()
+    lines = merge(*[read_lines(*f) for f in files], key=lambda r: r[0])
+    for _, source, channel_name, line in lines:
+        counts[source] += 1
+        start = time.perf_counter()
+        ev = parse_line(source, line, received_at=time.monotonic())
+        if source == 'chan':
+            chanops[channel_name]._proc_traced_event(ev)
+            op_actions[channel_name].flush()
+        elif source == 'serv':
+            for name in chanops:
+                chanops[name]._proc_traced_event(ev)
+                op_actions[name].flush()
+        handle_times.record(time.perf_counter() - start)
+    return counts
+
+
+def wait_for_outbound(gs):
+    ''' Wait for everything to be sent, and stop the OutboundMessageThread.
+    Returns its stats per lane. '''
+    out_msg = gs['threads']['out_message']
+    while True:
+        lanes, _ = out_msg.metrics()
+        if not sum(stats['queued'] for stats in lanes.values()):
+            break
+        time.sleep(0.01)
+    gs['events']['kill_outmessage'].set()
+    out_msg.join()
+    lanes, _ = out_msg.metrics()
+    return lanes
+
+
+def ms(seconds):
+    return '{:.3f}ms'.format(seconds * 1000)
+
+
+def report_histogram(name, hist):
+    p50, p90, p99 = hist.quantiles([0.5, 0.9, 0.99])
+    print('  {:16} n={:<8} p50={:>10} p90={:>10} p99={:>10} max={:>10}'
+          .format(name, hist.count, ms(p50), ms(p90), ms(p99),
+                  ms(hist.max)))
+
+
+def report(counts, elapsed, drain_elapsed, gs, sink, lanes, handle_times):
+    total = sum(counts.values())
+    print('Replayed {} lines ({}) in {:.2f}s: {:.0f} lines/s'.format(
+        total, ', '.join('{} {}'.format(n, source)
+                         for source, n in sorted(counts.items())),
+        elapsed, total / elapsed if elapsed else 0))
+    print('Waited {:.2f}s more for outbound commands to be sent'.format(
+        drain_elapsed))
+    detections = Counter()
+    for chanop in gs['threads']['chan_ops'].values():
+        detections.update(chanop.detections())
+    print('Detections:')
+    for detector in ChanOpThread.detectors:
+        print('  {:20} {}'.format(detector, detections[detector]))
+    print('Sent {} commands:'.format(sum(sink.commands.values())))
+    for kind, n in sink.commands.most_common():
+        print('  {:20} {}'.format(kind, n))
+    dropped = sum(stats['dropped'] for stats in lanes.values())
+    if dropped:
+        print('  dropped because a lane was full:', ', '.join(
+            '{} {}'.format(stats['dropped'], lane)
+            for lane, stats in sorted(lanes.items()) if stats['dropped']))
+    print('Latency:')
+    if handle_times.count:
+        report_histogram('handle line', handle_times)
+    for stage, hist in latencies().items():
+        if hist.count:
+            report_histogram(stage, hist)
+
+
+def main(args):
+    files = recorded_files(args.server_dir)
+    if not files:
+        print('No out files in', args.server_dir)
+        return
+    channel_names = [f[1] for f in files if f[0] == 'chan']
+    sink = CaptureSink(args.capture)
+    gs = create(args, channel_names, sink)
+    gs['threads']['out_message'].start()
+    handle_times = LatencyHistogram()
+    start = time.perf_counter()
+    try:
+        counts = replay(gs, files, handle_times)
+    finally:
+        elapsed = time.perf_counter() - start
+        lanes = wait_for_outbound(gs)
+        drain_elapsed = time.perf_counter() - start - elapsed
+        gs['log'].close()
+    report(counts, elapsed, drain_elapsed, gs, sink, lanes, handle_times)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('server_dir')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--capture', help='Write the commands that would '
+                        'have been sent to this file')
+    parser.add_argument('--log', help='Log to this file')
+    parser.add_argument('--log-level', default='notice',
+                        choices=['error', 'warn', 'notice', 'info', 'debug'])
+    main(parser.parse_args())
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+''' Throw traffic from raidgen.py at running ChanOpThreads,
+OperatorActionThreads, and an OutboundMessageThread, to see how much they
+can take and what gives first.
+
+    ./bench_stress.py [--config FILE] [--rate LINES/S] [--interval SECONDS]
+                      [--no-rate-limit] [--warmup SECONDS] [raidgen options]
+
+The threads are the real ones, each in its own thread like in main.py, and
+the OperatorActionThreads are opped. Lines are parsed and handed to the
+ChanOpThreads from this thread, like the FileFollowerThread would, --rate a
+second (or as fast as they are taken, with --rate 0). Handing a line to a
+ChanOpThread whose queue is full waits, so when they can't keep up, fewer
+lines a second are handed over than --rate asks for. What would be written
+to the server's in FIFO is counted instead (see bench_replay.CaptureSink),
+after the usual rate limit unless --no-rate-limit is given.
+
+Every --interval seconds the lines handed over, the depth of every queue,
+the outbound messages dropped, the members and flood state kept, and the
+process's memory are printed. At the end come the detections, the commands
+sent, and the latency of each stage (see latency.py).
+
+ChanOpThreads clear their member lists 5 seconds after they start (see
+ChanOpThread._start_timers()), so the traffic starts after --warmup
+seconds. '''
+import resource
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from bench_replay import CaptureSink
+from chanopthread import ChanOpThread
+from heartbeatthread import HeartbeatThread
+from iievent import parse_line
+from latency import latencies
+from main import new_global_state
+from operatoractionthread import OperatorActionThread
+from outboundmessagethread import OutboundMessageThread
+from pastlylogger import PastlyLogger
+from tokenbucket import token_bucket
+import raidgen
+
+
+def rss_bytes():
+    ''' How much memory this process is using right now, or at most so far
+    if we can't tell '''
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # In KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def create(args, channel_names, sink):
+    gs = new_global_state(args.config)
+    gs['log'] = PastlyLogger()
+    gs['threads']['heart'] = HeartbeatThread(gs)
+    gs['threads']['out_message'] = OutboundMessageThread(
+        gs, long_timeout=0.5, server_in=sink,
+        time_between_actions_func=None if args.no_rate_limit
+        else token_bucket(5, 0.505))
+    for channel_name in channel_names:
+        gs['threads']['op_actions'][channel_name] = \
+            OperatorActionThread(gs, channel_name)
+        gs['threads']['chan_ops'][channel_name] = \
+            ChanOpThread(gs, channel_name)
+    return gs
+
+
+def start(gs):
+    gs['threads']['out_message'].start()
+    for t in ['op_actions', 'chan_ops']:
+        for thread in gs['threads'][t].values():
+            thread.start()
+    for oat in gs['threads']['op_actions'].values():
+        oat.set_opped(True)
+
+
+def stop(gs):
+    for event, t in [('kill_chanops', 'chan_ops'),
+                     ('kill_opactions', 'op_actions')]:
+        gs['events'][event].set()
+        for thread in gs['threads'][t].values():
+            thread.join()
+    gs['events']['kill_outmessage'].set()
+    gs['threads']['out_message'].join()
+
+
+class Sample:
+    ''' What the threads were up to at one point in time '''
+    def __init__(self, gs, sent, elapsed):
+        self.sent = sent
+        self.elapsed = elapsed
+        chanops = gs['threads']['chan_ops'].values()
+        oats = gs['threads']['op_actions'].values()
+        self.chanop_queue = sum(t.queue_size() for t in chanops)
+        self.op_queue = sum(t.queue_size() for t in oats)
+        lanes, _ = gs['threads']['out_message'].metrics()
+        self.out_queue = sum(s['queued'] for s in lanes.values())
+        self.dropped = sum(s['dropped'] for s in lanes.values())
+        self.members = sum(len(t.members) for t in chanops)
+        self.flood_state = sum(t.flood_state_stats()['size'] for t in chanops)
+        self.rss = rss_bytes()
+
+    def print(self, last):
+        seconds = self.elapsed - last.elapsed
+        rate = (self.sent - last.sent) / seconds if seconds else 0
+        print('{:7.1f}s sent={:<8} {:8.0f}/s chanop_q={:<4} op_q={:<4} '
+              'out_q={:<5} dropped={:<6} members={:<6} flood={:<6} '
+              'rss={:.1f}MiB'.format(
+                  self.elapsed, self.sent, rate, self.chanop_queue,
+                  self.op_queue, self.out_queue, self.dropped, self.members,
+                  self.flood_state, self.rss / 2**20))
+
+
+def drive(gs, lines, rate, interval):
+    ''' Hand lines to the ChanOpThreads, rate a second (0 for as fast as
+    they take them). Returns the Samples taken every interval seconds. '''
+    chanops = gs['threads']['chan_ops']
+    start_at = time.perf_counter()
+    samples = [Sample(gs, 0, 0.0)]
+    samples[0].print(samples[0])
+    next_sample = interval
+    for i, (source, channel_name, line) in enumerate(lines):
+        if rate:
+            ahead = i / rate - (time.perf_counter() - start_at)
+            if ahead > 0:
+                time.sleep(ahead)
+        ev = parse_line(source, '2026-01-01 00:00 ' + line,
+                        received_at=time.monotonic())
+        if source == 'chan':
+            chanops[channel_name].recv_event(ev)
+        else:
+            for chanop in chanops.values():
+                chanop.recv_event(ev)
+        elapsed = time.perf_counter() - start_at
+        if elapsed >= next_sample:
+            samples.append(Sample(gs, i + 1, elapsed))
+            samples[-1].print(samples[-2])
+            next_sample += interval
+    samples.append(Sample(gs, len(lines), time.perf_counter() - start_at))
+    samples[-1].print(samples[-2])
+    return samples
+
+
+def report(gs, samples, sink):
+    last = samples[-1]
+    print('Handed over {} lines in {:.2f}s: {:.0f} lines/s'.format(
+        last.sent, last.elapsed, last.sent / last.elapsed))
+    print('Peak queue depths: chanop {} op_actions {} outbound {}. Peak '
+          'memory {:.1f}MiB'.format(
+              max(s.chanop_queue for s in samples),
+              max(s.op_queue for s in samples),
+              max(s.out_queue for s in samples),
+              max(s.rss for s in samples) / 2**20))
+    detections = Counter()
+    for chanop in gs['threads']['chan_ops'].values():
+        detections.update(chanop.detections())
+    print('Detections:', ', '.join('{} {}'.format(detections[d], d)
+                                   for d in ChanOpThread.detectors))
+    lanes, stats = gs['threads']['out_message'].metrics()
+    print('Sent {} commands ({}), rate limited for {:.1f}s'.format(
+        sum(sink.commands.values()), ', '.join(
+            '{} {}'.format(n, kind)
+            for kind, n in sink.commands.most_common()),
+        stats['rate_limit_seconds']))
+    if last.dropped:
+        print('Dropped {} because a lane was full ({})'.format(
+            last.dropped, ', '.join(
+                '{} {}'.format(s['dropped'], lane)
+                for lane, s in sorted(lanes.items()) if s['dropped'])))
+    print('Latency:')
+    for stage, hist in latencies().items():
+        if not hist.count:
+            continue
+        p50, p99 = hist.quantiles([0.5, 0.99])
+        print('  {:16} n={:<8} p50={:10.3f}ms p99={:10.3f}ms '
+              'max={:10.3f}ms'.format(stage, hist.count, p50 * 1000,
+                                      p99 * 1000, hist.max * 1000))
+
+
+def main(args):
+    channel_names, lines = raidgen.generate(args)
+    sink = CaptureSink()
+    gs = create(args, channel_names, sink)
+    start(gs)
+    print('Generated {} lines. Starting in {}s'.format(
+        len(lines), args.warmup))
+    time.sleep(args.warmup)
+    try:
+        samples = drive(gs, lines, args.rate, args.interval)
+        # Let the ChanOpThreads finish what they have been handed. What the
+        # rate limit is holding back is not waited for.
+        while any(t.queue_size() for t in
+                  gs['threads']['chan_ops'].values()):
+            time.sleep(0.1)
+    finally:
+        stop(gs)
+    report(gs, samples, sink)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Lines a second to hand over, or 0 for as '
+                        'fast as they are taken')
+    parser.add_argument('--interval', type=float, default=1)
+    parser.add_argument('--no-rate-limit', action='store_true')
+    parser.add_argument('--warmup', type=float, default=6)
+    raidgen.add_arguments(parser)
+    main(parser.parse_args())
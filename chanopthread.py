@@ -1,9 +1,13 @@
 import json
 import re
-import time
-from queue import Empty, Queue
+from queue import Empty
 from threading import Event
+from floodstatetable import FloodStateTable
+from iievent import IIEvent
+from latency import Trace, stage_started, tracing
 from member import Member, MemberList
+from patternmatcher import PatternMatcher
+from pbasync import new_queue
 from pbtimer import fire_one_off_event, RepeatedTimer
 from pbthread import PBThread
 from tokenbucket import token_bucket
@@ -11,10 +15,9 @@ from tokenbucket import token_bucket
 
 class ChanOpThread(PBThread):
 
-    non_nick_punctuation = [':', ', ', '!', '?']
-    nick_prefixes = ['@', '+']
-    non_nick_punctuation.extend(nick_prefixes)
-    common_words = \
+    # Nicks that are also common words are too likely to be said without
+    # meaning to mention anybody, so they don't count as mentions
+    common_words = frozenset(
         ['the', 'be', 'to', 'of', 'and', 'a', 'in', 'that', 'have', 'i', 'it',
          'for', 'not', 'on', 'with', 'he', 'as', 'you', 'do', 'at', 'this',
          'but', 'his', 'by', 'from', 'they', 'we', 'say', 'her', 'she', 'or',
@@ -25,16 +28,22 @@ class ChanOpThread(PBThread):
          'them', 'see', 'other', 'than', 'then', 'now', 'look', 'only', 'come',
          'its', 'over', 'thnk', 'also', 'back', 'after', 'use', 'two', 'how',
          'our', 'work', 'first', 'well', 'way', 'even', 'new', 'want',
-         'because', 'any', 'these', 'give', 'day', 'most', 'us']
+         'because', 'any', 'these', 'give', 'day', 'most', 'us'])
+
+    # The ways _proc_chan_msg() can decide a message needs moderating, in the
+    # order they are checked. Only the first that matches counts.
+    detectors = ['banned_pattern', 'soapbox', 'highlight_spam',
+                 'slow_highlight_spam', 'flood']
 
     def __init__(self, global_state, channel_name):
         PBThread.__init__(self, self._enter,
                           name='ChanOp-{}'.format(channel_name))
-        self._message_queue = Queue(100)
-        self._members = MemberList()
+        self._message_queue = new_queue(global_state, 100)
         self._is_getting_members = Event()
         self._channel_name = channel_name
         self.update_global_state(global_state)
+        self._members = MemberList(registry=self._member_registry,
+                                   name=channel_name)
         if 'masters' not in self._conf['general']:
             self._masters = []
         else:
@@ -48,15 +57,16 @@ class ChanOpThread(PBThread):
             float(self._conf['highlight_spam']['long_mention_limit_seconds']) /
             float(self._conf['highlight_spam']['long_mention_limit']))
         self._highlight_spam_token_bucket_state = None
-        self._message_flood_token_bucket_func = token_bucket(
+        # detector -> how many messages it caught
+        self._detections = dict.fromkeys(ChanOpThread.detectors, 0)
+        # One flood token bucket per recent speaker
+        self._message_flood_token_buckets = FloodStateTable(
             int(self._conf['flood']['message_limit']),
             float(self._conf['flood']['message_limit_seconds']) /
-            float(self._conf['flood']['message_limit']))
-        self._message_flood_burst_token_bucket_func = token_bucket(
-            int(self._conf['flood']['burst_message_limit']),
-            float(self._conf['flood']['burst_message_limit_seconds']) /
-            float(self._conf['flood']['burst_message_limit']))
-        self._message_flood_token_bucket_states = {}
+            float(self._conf['flood']['message_limit']),
+            capacity=self._conf.getint(
+                'flood', 'state_capacity', fallback=10000),
+            ttl=self._conf.getfloat('flood', 'state_ttl', fallback=600))
 
     @property
     def channel_name(self):
@@ -66,6 +76,18 @@ class ChanOpThread(PBThread):
     def members(self):
         return self._members
 
+    def queue_size(self):
+        ''' How many events are waiting for us to process them '''
+        return self._message_queue.qsize()
+
+    def flood_state_stats(self):
+        return self._message_flood_token_buckets.stats()
+
+    def detections(self):
+        ''' Return a dict of detectors (see ChanOpThread.detectors) to how
+        many messages each caught '''
+        return dict(self._detections)
+
     def update_global_state(self, gs):
         self._log = gs['log']
         assert self._channel_name in gs['threads']['op_actions']
@@ -73,13 +95,14 @@ class ChanOpThread(PBThread):
         self._operator_action_thread = t
         self._out_msg_thread = gs['threads']['out_message']
         self._heart_thread = gs['threads']['heart']
+        self._member_registry = gs['member_registry']
         self._conf = gs['conf']
         self._end_event = gs['events']['kill_chanops']
-        self._banned_patterns = []
+        banned_patterns = []
         if 'pats' in self._conf['banned_patterns']:
-            for p in json.loads(self._conf['banned_patterns']['pats']):
-                self._banned_patterns.append(re.compile(p))
-        self._soapbox_patterns = []
+            banned_patterns = json.loads(self._conf['banned_patterns']['pats'])
+        self._banned_patterns = PatternMatcher(banned_patterns)
+        soapbox_patterns = []
         self._soapbox_reason = ''
         if 'pats' in self._conf['soapbox_patterns']:
             self._soapbox_reason = self._conf['soapbox_patterns']['reason']
@@ -87,116 +110,143 @@ class ChanOpThread(PBThread):
                 p = p.replace('/', ' */ *')
                 p = p.replace('-', ' *- *')
                 p = p.replace('.', ' *\\. *')
-                self._soapbox_patterns.append(re.compile(p, re.IGNORECASE))
+                soapbox_patterns.append(p)
+        self._soapbox_patterns = PatternMatcher(
+            soapbox_patterns, re.IGNORECASE)
         if self._log:
             self._log.info('ChanOpThread updated state')
 
     def _enter(self):
         log = self._log
         log.info('Started ChanOpThread instance')
-        fire_one_off_event(5, self._update_members_event_callback)
-        self._update_members_event = RepeatedTimer(
-            60*60*8,
-            self._update_members_event_callback)
+        self._start_timers()
         while not self._end_event.is_set():
-            source, line = "", ""
             try:
-                source, line = self._message_queue.get(timeout=1)
+                ev = self._message_queue.get(timeout=1)
             except Empty:
                 if self._end_event.is_set():
                     return self._shutdown()
-            if source not in ['chan', 'serv']:
                 continue
-            if not len(line):
-                continue
-            tokens = line.split()
-            speaker = tokens[2]
-            words = tokens[3:]
-            if speaker == '-!-':
-                self._proc_ctrl_msg(speaker, words)
-            elif speaker == self._channel_name:
-                if ' '.join(words) == 'End of /WHO list.':
-                    self._is_getting_members.clear()
-                elif self._is_getting_members.is_set():
-                    user, host, server, nick, unknown1, unknown2 = words[0:6]
-                    self._add_member(nick, user, host)
-            elif speaker[0] != '<' or speaker[-1] != '>':
-                # if speaker starts with '#', then ignore it. It's a channel
-                # and we end up spamming our logs when updating member lists
-                # when moderating many channels
-                if speaker[0] == '#':
-                    continue
-                log.debug('Ignoring weird speaker: {}'.format(speaker))
-            else:
-                speaker = speaker[1:-1].lower()
-                if speaker in self._ignores:
-                    log.debug('Ignoring speaker on ignore list: {}'.format(speaker))
-                    continue
-                self._proc_chan_msg(speaker, words)
-
-    def _proc_ctrl_msg(self, speaker, words):
-        assert speaker == '-!-'
+            self._proc_traced_event(ev)
+
+    async def _enter_async(self):
+        log = self._log
+        log.info('Started ChanOpThread instance')
+        self._start_timers()
+        try:
+            while True:
+                self._proc_traced_event(await self._message_queue.get())
+        finally:
+            self._shutdown()
+
+    def _start_timers(self):
+        fire_one_off_event(5, self._update_members_event_callback)
+        self._update_members_event = RepeatedTimer(
+            60*60*8,
+            self._update_members_event_callback)
+
+    def _proc_traced_event(self, ev):
+        ''' _proc_event() with a Trace of ev as the current one, so the
+        actions it leads to can be followed (see latency.py) '''
+        if ev.received_at is None:
+            return self._proc_event(ev)
+        trace = Trace.start(ev.received_at).stage_done('chanop_queue')
+        with tracing(trace):
+            self._proc_event(ev)
+        # Once, however many actions it led to. They each started their
+        # next stage when they were queued.
+        trace.stage_done('detect')
+
+    def _proc_event(self, ev):
+        log = self._log
+        if ev.source not in ['chan', 'serv']:
+            return
+        if ev.speaker == '-!-':
+            self._proc_ctrl_msg(ev)
+        elif ev.kind == IIEvent.WHO_END:
+            if ev.channel == self._channel_name:
+                self._is_getting_members.clear()
+        elif ev.kind == IIEvent.WHO_REPLY:
+            if ev.channel == self._channel_name and \
+                    self._is_getting_members.is_set():
+                self._add_member(ev.nick, ev.user, ev.host)
+        elif ev.kind != IIEvent.PRIVMSG:
+            # if speaker starts with '#', then ignore it. It's a channel
+            # and we end up spamming our logs when updating member lists
+            # when moderating many channels
+            if ev.speaker[:1] == '#':
+                return
+            log.debugf('Ignoring weird speaker: {}', ev.speaker)
+        else:
+            speaker = ev.speaker.lower()
+            if speaker in self._ignores:
+                log.debugf('Ignoring speaker on ignore list: {}', speaker)
+                return
+            self._proc_chan_msg(speaker, ev.words, ev.text)
+
+    def _proc_ctrl_msg(self, ev):
+        assert ev.speaker == '-!-'
         log = self._log
         oat = self._operator_action_thread
         channel_name = self._channel_name
-        if ' '.join(words[1:3]) == 'changed mode/{}'.format(channel_name):
-            # who = words[0]
-            mode = words[4]
-            arg = words[5] if len(words) >= 6 else None
-            if mode == '+o' and arg == 'TorModBot':
+        if ev.kind == IIEvent.MODE and ev.channel == channel_name:
+            if ev.mode == '+o' and ev.target == 'TorModBot':
                 oat.set_opped(True)
-            if mode == '-o' and arg == 'TorModBot':
+            if ev.mode == '-o' and ev.target == 'TorModBot':
                 oat.set_opped(False)
-        elif ' '.join(words[1:4]) == 'has joined {}'.format(channel_name):
-            s = words[0]
-            nick = s.split('(')[0]
-            user = s.split('(')[1].split('@')[0]
-            host = s.split('@')[1].split(')')[0]
+        elif ev.kind == IIEvent.JOIN and ev.channel == channel_name:
+            nick, user, host = ev.nick, ev.user, ev.host
             self._members.add(nick, user, host)
             log.info('Added (join)', '{}!{}@{} ({})'
                      .format(nick, user, host, len(self._members)))
-            self._heart_thread.event_add_nick()
-        elif ' '.join(words[1:4]) == 'has left {}'.format(channel_name):
-            s = words[0]
-            nick = s.split('(')[0]
+            self._heart_thread.event_add_nick(channel=self._channel_name)
+        elif ev.kind == IIEvent.PART and ev.channel == channel_name:
+            nick = ev.nick
             self._members.remove(nick)
             log.info('Removed (left) {} ({})'.format(nick, len(self._members)))
-            self._heart_thread.event_del_nick()
-        elif ' '.join(words[1:3]) == 'has quit':
-            s = words[0]
-            nick = s.split('(')[0]
+            self._heart_thread.event_del_nick(channel=self._channel_name)
+            self._message_flood_token_buckets.forget(nick)
+        elif ev.kind == IIEvent.QUIT:
+            nick = ev.nick
             if self._members.contains(nick):
                 self._members.remove(nick)
                 log.info('Removed (quit) {} ({})'.format(
                     nick, len(self._members)))
-                self._heart_thread.event_del_nick()
-            if nick in self._message_flood_token_bucket_states:
-                self._message_flood_token_bucket_states.pop(nick)
-        elif ' '.join(words[1:4]) == 'changed nick to':
-            from_nick = words[0]
-            to_nick = words[4]
+                self._heart_thread.event_del_nick(channel=self._channel_name)
+            self._message_flood_token_buckets.forget(nick)
+        elif ev.kind == IIEvent.NICK:
+            from_nick = ev.nick
+            to_nick = ev.target
             log.info(from_nick, 'changing to', to_nick)
-            self._heart_thread.event_change_nick()
-            if not self._members.contains(from_nick):
-                log.info('Do not have a member with nick', from_nick)
-            else:
-                mem = self._members[from_nick]
+            self._heart_thread.event_change_nick(channel=self._channel_name)
+            # Members are shared between channels, so another ChanOpThread
+            # may have already seen this nick change and applied it for us
+            mem = self._members[from_nick]
+            if mem is not None:
                 mem.set(nick=to_nick)
-            if from_nick in self._message_flood_token_bucket_states:
-                self._message_flood_token_bucket_states[to_nick] = \
-                    self._message_flood_token_bucket_states[from_nick]
-                self._message_flood_token_bucket_states.pop(from_nick)
+            elif self._members.contains(to_nick):
+                log.debug('Nick change to', to_nick, 'already applied')
+            else:
+                log.info('Do not have a member with nick', from_nick)
+            self._message_flood_token_buckets.rename(from_nick, to_nick)
         else:
-            log.debug('Ignoring ctrl msg:', ' '.join(words))
+            log.debug('Ignoring ctrl msg:', ev.text)
 
-    def _proc_chan_msg(self, speaker, words):
+    def _proc_chan_msg(self, speaker, words, text):
         log = self._log
         oat = self._operator_action_thread
-        log.debug('<{}> {}'.format(speaker, ' '.join(words)))
-        self._heart_thread.event_chan_msg()
-        if self._contains_banned_pattern(words):
+        log.debugf('<{}> {}', speaker, text)
+        self._heart_thread.event_chan_msg(channel=self._channel_name)
+        banned_pattern = self._contains_banned_pattern(text)
+        soapbox_pattern = None if banned_pattern else \
+            self._contains_soapbox_pattern(text)
+        mentioned = self._find_mentioned_nicks(text)
+        log.debugf('{} nicks mentioned', len(mentioned))
+        if banned_pattern:
+            self._detections['banned_pattern'] += 1
             oat.temporary_mute(enabled=True)
-            log.notice('{} said a banned pattern'.format(speaker))
+            log.notice('{} said a banned pattern: {}'.format(
+                speaker, banned_pattern))
             if self._members.contains(speaker):
                 mem = self._members[speaker]
                 self.chanserv_quiet_add(
@@ -206,8 +256,10 @@ class ChanOpThread(PBThread):
             else:
                 self.chanserv_quiet_add(
                     '{}!*@*'.format(speaker), 'banned pattern (auto)')
-        elif self._contains_soapbox_pattern(words):
-            log.notice('{} seems to be using us as a soapbox'.format(speaker))
+        elif soapbox_pattern:
+            self._detections['soapbox'] += 1
+            log.notice('{} seems to be using us as a soapbox: {}'.format(
+                speaker, soapbox_pattern))
             r = self._soapbox_reason
             if self._members.contains(speaker):
                 mem = self._members[speaker]
@@ -219,7 +271,8 @@ class ChanOpThread(PBThread):
                 self.chanserv_akick_add(
                     '{}!*@*'.format(speaker), '{} (soapboxing) (auto)'.format(r))
             oat.set_chan_mode('+R', 'soapboxing (auto)')
-        elif self._is_highlight_spam(words):
+        elif self._is_highlight_spam(mentioned):
+            self._detections['highlight_spam'] += 1
             oat.temporary_mute(enabled=True)
             log.notice('{} highlight spammed'.format(speaker))
             if self._members.contains(speaker):
@@ -231,7 +284,8 @@ class ChanOpThread(PBThread):
             else:
                 self.chanserv_akick_add(
                     '{}!*@*'.format(speaker), 'mass highlight spam (auto)')
-        elif self._is_slow_highlight_spam(words):
+        elif self._is_slow_highlight_spam(mentioned):
+            self._detections['slow_highlight_spam'] += 1
             oat.temporary_mute(enabled=True)
             log.notice('The channel is being highlight spammed slowly. '
                        'Kicking', speaker)
@@ -245,56 +299,32 @@ class ChanOpThread(PBThread):
                 self.chanserv_akick_add(
                     '{}!*@*'.format(speaker), 'slow highlight spam (auto)')
         elif self._is_speaker_flooding(speaker):
+            self._detections['flood'] += 1
             log.notice(speaker, 'has said too much recently. Kicking.')
             oat.kick_nick(speaker, 'flooding (auto)')
             oat.set_chan_mode('+R', 'flooding (auto)')
 
-    def _contains_banned_pattern(self, words):
-        # words = ' '.join([ w.lower() for w in words ])
-        for bp in self._banned_patterns:
-            # if bp.search(words): return True
-            if bp.search(' '.join(words)):
-                return True
-        return False
+    def _contains_banned_pattern(self, text):
+        ''' Returns the first banned pattern found in text, if any '''
+        return self._banned_patterns.search(text)
 
-    def _contains_soapbox_pattern(self, words):
-        # words = ' '.join([ w.lower() for w in words ])
-        for bp in self._soapbox_patterns:
-            # if bp.search(words): return True
-            if bp.search(' '.join(words)):
-                return True
-        return False
+    def _contains_soapbox_pattern(self, text):
+        ''' Returns the first soapbox pattern found in text, if any '''
+        return self._soapbox_patterns.search(text)
 
-    def _find_mentioned_nicks(self, words):
-        mems = self._members
-        matches = set()
-        words = [w.lower() for w in words]
-        words = [w for w in words if w not in ChanOpThread.common_words]
-        matches = set()
-        # first try straight nick mentions with no prefix/suffix obfuscation
-        for match in [w for w in words if mems.contains(w)]:
-            matches.add(match)
-        # then try removing leading/trailing punctuation from words and see if
-        # they then start to look like nicks. Not all punctuation is illegal
-        punc = ''.join(ChanOpThread.non_nick_punctuation)
-        for word in words:
-            word = word.lstrip(punc).rstrip(punc)
-            if mems.contains(word):
-                matches.add(word)
-        return matches
-
-    def _is_highlight_spam(self, words):
-        log = self._log
+    def _find_mentioned_nicks(self, text):
+        ''' Returns the set of (casefolded) nicks in this channel that text
+        mentions, even if surrounded by punctuation like "@nick:" '''
+        return self._members.mentioned_nicks(text) - ChanOpThread.common_words
+
+    def _is_highlight_spam(self, mentioned):
         limit = int(self._conf['highlight_spam']['mention_limit'])
-        matches = self._find_mentioned_nicks(words)
-        log.debug("{} nicks mentioned".format(len(matches)))
-        return len(matches) > limit
+        return len(mentioned) > limit
 
-    def _is_slow_highlight_spam(self, words):
+    def _is_slow_highlight_spam(self, mentioned):
         tb = self._highlight_spam_token_bucket
         tb_state = self._highlight_spam_token_bucket_state
-        matches = self._find_mentioned_nicks(words)
-        for match in matches:
+        for match in mentioned:
             wait_time, tb_state = tb(tb_state)
             self._highlight_spam_token_bucket_state = tb_state
             if wait_time > 0:
@@ -305,37 +335,18 @@ class ChanOpThread(PBThread):
         if speaker in self._masters:
             return False
         log = self._log
-        tb_flood_func = self._message_flood_token_bucket_func
-        tb_flood_burst_func = self._message_flood_burst_token_bucket_func
-        tb_states = self._message_flood_token_bucket_states
-        if speaker not in tb_states:
-            tb_states[speaker] = {
-                'last_message': 0,
-                'flood_state': None,
-                'flood_burst_state': None,
-            }
-        now = time.time()
-        # there's code to support having a burst token bucket and a regular
-        # token bucet, but for now just use the regular token bucket. Trust
-        # that OFTC and Floodserv will handle bursts of messages.
-        # if now - tb_states[speaker]['last_message'] > 1:
-        #     wait_time, new_state = tb_flood_func(
-        #         tb_states[speaker]['flood_state'])
-        #     tb_states[speaker]['flood_state'] = new_state
-        #     log.debug('REGLR', wait_time, new_state)
-        # else:
-        #     wait_time, new_state = tb_flood_burst_func(
-        #         tb_states[speaker]['flood_burst_state'])
-        #     tb_states[speaker]['flood_burst_state'] = new_state
-        #     log.debug('BURST', wait_time, new_state)
-        wait_time, new_state = tb_flood_func(tb_states[speaker]['flood_state'])
-        tb_states[speaker]['flood_state'] = new_state
-        tb_states[speaker]['last_message'] = now
-        log.debug('Flood TB: wait={} state={}'.format(wait_time, new_state))
+        # Only the regular token bucket is used. Trust that OFTC and
+        # Floodserv will handle bursts of messages.
+        tbs = self._message_flood_token_buckets
+        wait_time = tbs.spend(speaker)
+        if log.is_enabled('debug'):
+            log.debug('Flood TB: wait={} tokens={}'.format(
+                wait_time, tbs.tokens(speaker)))
         return wait_time > 0
 
     def _update_members_event_callback(self):
-        self._members = MemberList()
+        self._log_flood_state_stats()
+        self._members.clear()
         out_msg = self._out_msg_thread
         out_msg.add(self._ask_for_new_members)
 
@@ -358,7 +369,7 @@ class ChanOpThread(PBThread):
 
     def chanserv_akick_add(self, mask, reason='', master=None):
         ''' Can be called from any thread, including this one '''
-        self._heart_thread.event_add_akick()
+        self._heart_thread.event_add_akick(channel=self._channel_name)
         # Reason is included when chanserv akicks, so unlike
         # self.chanserv_quiet_add, we don't need to send NOTICE to room
         #
@@ -372,30 +383,31 @@ class ChanOpThread(PBThread):
 
     def chanserv_akick_del(self, mask):
         ''' Can be called from any thread, including this one '''
-        self._heart_thread.event_del_akick()
+        self._heart_thread.event_del_akick(channel=self._channel_name)
         return self._chanserv('akick', 'del', mask, reason='')
 
     def chanserv_quiet_add(self, mask, reason='', master=None):
         ''' Can be called from any thread, including this one '''
-        self._heart_thread.event_add_quiet()
+        self._heart_thread.event_add_quiet(channel=self._channel_name)
         log_str = 'quieting {} because {}'.format(mask, reason)
         # Reason isn't included when chanserv quiets, so send NOTICE to room
-        omt = self._out_msg_thread
-        omt.add(omt.notice, [self._channel_name, log_str])
+        # along with the quiet command
+        notice = log_str
         # And privately log the same reason, but add the nick of the master
         # who told us to add this quiet
         log_str += '' if not master else ' (by {})'.format(master)
         self._log.notice(log_str)
         # Finally actually send the quiet command
-        return self._chanserv('quiet', 'add', mask, reason)
+        return self._chanserv('quiet', 'add', mask, reason, notice=notice)
 
     def chanserv_quiet_del(self, mask):
         ''' Can be called from any thread, including this one '''
-        self._heart_thread.event_del_quiet()
+        self._heart_thread.event_del_quiet(channel=self._channel_name)
         return self._chanserv('quiet', 'del', mask, reason='')
 
-    def _chanserv(self, chanserv_list, action, mask, reason):
-        ''' Can be called from any thread, including this one '''
+    def _chanserv(self, chanserv_list, action, mask, reason, notice=None):
+        ''' Can be called from any thread, including this one. The same
+        command isn't queued twice (see ChanServTable). '''
         assert chanserv_list in ['akick', 'quiet']
         assert action in ['add', 'del']
         log = self._log
@@ -403,14 +415,23 @@ class ChanOpThread(PBThread):
             log.warn('Must give reason for', action, 'to/from', chanserv_list)
             return
         omt = self._out_msg_thread
-        message = '{l} {c} {a} {m} {r}'.format(
-            l=chanserv_list, c=self._channel_name, a=action, m=mask, r=reason)
-        omt.add(omt.privmsg, ['chanserv', message], {'log_it': True})
+        with tracing(stage_started()):
+            omt.add_chanserv(chanserv_list, self._channel_name, action, mask,
+                             reason, notice=notice)
+
+    def _log_flood_state_stats(self):
+        stats = self.flood_state_stats()
+        self._log.info(
+            'Flood state for', stats['size'], 'speakers (capacity',
+            '{}). {} hits, {} misses, {} expired, {} evicted'.format(
+                stats['capacity'], stats['hits'], stats['misses'],
+                stats['expired'], stats['evicted']))
 
     def _shutdown(self):
         log = self._log
         self._update_members_event.stop()
+        self._log_flood_state_stats()
         log.info('ChanOpThread going away')
 
-    def recv_line(self, source, line):
-        self._message_queue.put((source, line))
+    def recv_event(self, ev):
+        self._message_queue.put(ev)
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class ChanServTable:
+    ''' Keeps track of the ChanServ akick/quiet commands that are waiting to
+    be sent and that were sent recently, so that the same command isn't sent
+    over and over. During a raid, every message from the same host would
+    otherwise queue its own "akick #chan add *!*@host".
+
+    Commands are identified by a key of (list, channel, action, mask). add()
+    says whether a command should be queued at all, and pop() gives the
+    reason to send it with once it's its turn. Reasons given while the
+    command was waiting are merged into one. A command is forgotten
+    recent_seconds after it was sent, or as soon as the opposite action on
+    the same mask is added.
+
+    saved counts the outbound messages not sent because of all this.
+
+    Can be used from any thread. '''
+    def __init__(self, recent_seconds=60):
+        self._recent_seconds = recent_seconds
+        self._lock = Lock()
+        # key -> list of reasons
+        self._pending = {}
+        # key -> when it was sent, oldest first
+        self._sent = OrderedDict()
+        self.saved = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    @staticmethod
+    def _opposite(key):
+        chanserv_list, channel, action, mask = key
+        action = 'del' if action == 'add' else 'add'
+        return chanserv_list, channel, action, mask
+
+    def add(self, key, reason, messages=1):
+        ''' Returns True if the caller should queue the command for key.
+        Otherwise it is already queued or was just sent, and the caller
+        saved itself sending messages outbound messages. '''
+        with self._lock:
+            self._forget_old()
+            self._sent.pop(self._opposite(key), None)
+            if key in self._pending:
+                if reason and reason not in self._pending[key]:
+                    self._pending[key].append(reason)
+                self.saved += messages
+                return False
+            if key in self._sent:
+                self.saved += messages
+                return False
+            self._pending[key] = [reason] if reason else []
+            return True
+
+    def pop(self, key):
+        ''' Call when it's time to send the command for key. Returns the
+        reason(s) to send it with, or None if it isn't waiting to be sent. '''
+        with self._lock:
+            reasons = self._pending.pop(key, None)
+            if reasons is None:
+                return None
+            self._sent.pop(key, None)
+            self._sent[key] = time()
+            return '; '.join(reasons)
+
+    def _forget_old(self):
+        oldest = time() - self._recent_seconds
+        sent = self._sent
+        while sent:
+            key, at = next(iter(sent.items()))
+            if at >= oldest:
+                break
+            del sent[key]
@@ -1,8 +1,11 @@
+from iievent import IIEvent
+from latency import latencies
 from pbthread import PBThread
-from queue import Empty, Queue
+from queue import Empty
+from pbasync import new_queue
+from pbtimer import timer_service
 import json
 import random
-import time
 import helpdocumentation as helpdocu
 
 
@@ -18,7 +21,7 @@ class CommandListenerThread(PBThread):
 
     def __init__(self, global_state):
         PBThread.__init__(self, self._enter, name='CommandListener')
-        self._message_queue = Queue(100)
+        self._message_queue = new_queue(global_state, 100)
         self.update_global_state(global_state)
 
     def update_global_state(self, gs):
@@ -26,6 +29,8 @@ class CommandListenerThread(PBThread):
         self._out_msg_thread = gs['threads']['out_message']
         self._chan_op_threads = gs['threads']['chan_ops']
         self._operator_action_threads = gs['threads']['op_actions']
+        self._member_registry = gs['member_registry']
+        self._shard_links = gs['threads']['shard_links']
         self._conf = gs['conf']
         self._end_event = gs['events']['kill_command_listener']
         if 'masters' not in self._conf['general']:
@@ -50,57 +55,76 @@ class CommandListenerThread(PBThread):
         log = self._log
         log.info('Started CommandListenerThread instance')
         while not self._end_event.is_set():
-            source, line = "", ""
             try:
-                source, line = self._message_queue.get(timeout=1)
+                ev = self._message_queue.get(timeout=1)
             except Empty:
                 if self._end_event.is_set():
                     return self._shutdown()
-            if not len(line):
-                continue
-            if source not in ['priv', 'comm']:
-                continue
-            if source == 'comm' and self._command_channel is None:
-                log.warn('Got command from command channel, but no command '
-                         'channel known. Ignoring.')
-                continue
-            tokens = line.split()
-            # the speaker is token at index 2, then remove leading '<', then
-            # remove trailing '>'
-            speaker = tokens[2][1:][:-1]
-            words = tokens[3:]
-            if len(words) < 1:
-                continue
-            if words[0][0] == '#':
-                # ignore explicit non-commands (comments)
-                continue
-            if speaker not in self._masters:
-                # we get a lot of privmsges from -!- for some reason
-                if speaker == '!':
-                    continue
-                log.info('Ignoring command/privmsg from non-master',
-                         speaker)
-                continue
-            if ' '.join(words).lower() == 'ping':
-                self._proc_ping_msg(source, speaker, words)
-                continue
-            elif words[0].lower() == 'help':
-                self._proc_help_msg(source, speaker, words)
-            elif words[0].lower() == 'mode':
-                self._proc_mode_msg(source, speaker, words)
-                continue
-            elif words[0].lower() == 'kick':
-                self._proc_kick_msg(source, speaker, words)
-                continue
-            elif words[0].lower() in ['akick', 'quiet']:
-                self._proc_akick_or_quiet_msg(source, speaker, words)
-                continue
-            elif words[0].lower() in ['match']:
-                self._proc_match_msg(source, speaker, words)
-                continue
-            else:
-                self._notify_impl(source, speaker, 'I don\'t understand')
                 continue
+            self._proc_event(ev)
+
+    async def _enter_async(self):
+        log = self._log
+        log.info('Started CommandListenerThread instance')
+        try:
+            while True:
+                self._proc_event(await self._message_queue.get())
+        finally:
+            self._shutdown()
+
+    def _proc_event(self, ev):
+        log = self._log
+        source = ev.source
+        if source not in ['priv', 'comm']:
+            return
+        if source == 'comm' and self._command_channel is None:
+            log.warn('Got command from command channel, but no command '
+                     'channel known. Ignoring.')
+            return
+        # we get a lot of privmsges from -!- for some reason. Only things
+        # people actually said can be commands.
+        if ev.kind != IIEvent.PRIVMSG:
+            return
+        speaker = ev.speaker
+        words = ev.words
+        if len(words) < 1:
+            return
+        if words[0][0] == '#':
+            # ignore explicit non-commands (comments)
+            return
+        if speaker not in self._masters:
+            log.info('Ignoring command/privmsg from non-master',
+                     speaker)
+            return
+        if ev.text.lower() == 'ping':
+            self._proc_ping_msg(source, speaker, words)
+            return
+        elif words[0].lower() == 'help':
+            self._proc_help_msg(source, speaker, words)
+        elif words[0].lower() == 'mode':
+            self._proc_mode_msg(source, speaker, words)
+            return
+        elif words[0].lower() == 'kick':
+            self._proc_kick_msg(source, speaker, words)
+            return
+        elif words[0].lower() in ['akick', 'quiet']:
+            self._proc_akick_or_quiet_msg(source, speaker, words)
+            return
+        elif words[0].lower() in ['match']:
+            self._proc_match_msg(source, speaker, words)
+            return
+        elif words[0].lower() == 'timers':
+            self._proc_timers_msg(source, speaker, words)
+            return
+        elif words[0].lower() == 'latency':
+            self._proc_latency_msg(source, speaker, words)
+            return
+        elif words[0].lower() == 'loglevel':
+            self._proc_loglevel_msg(source, speaker, words)
+            return
+        else:
+            self._notify_impl(source, speaker, 'I don\'t understand')
+            return
 
     def _proc_help_msg(self, source, speaker, words):
         assert words[0].lower() == 'help'
@@ -117,7 +141,7 @@ class CommandListenerThread(PBThread):
         else:
             msg = '{}: {}'.format(speaker, msg)
             target = self._command_channel
-        omt.add(omt.privmsg, [target, msg], priority=time.time()+300)
+        omt.add(omt.privmsg, [target, msg], lane='master')
 
     def _notify_okay(self, source, speaker, *ok):
         if not ok:
@@ -142,55 +166,31 @@ class CommandListenerThread(PBThread):
         omt = self._out_msg_thread
         pong = random.choice(CommandListenerThread.pong_msgs)
         if source == 'priv':
-            omt.add(omt.privmsg, [speaker, pong])
+            omt.add(omt.privmsg, [speaker, pong], lane='master')
         else:
             chan = self._command_channel
             msg = '{}: {}'.format(speaker, pong)
-            omt.add(omt.privmsg, [chan, msg])
+            omt.add(omt.privmsg, [chan, msg], lane='master')
 
     def _find_member_for_nick(self, source, speaker, nick):
-        ''' support function for _match_nick. Looks through the member
-        lists for each moderated channel and returns the member for
-        the given nick if it can be found. Otherwise returns None '''
-        for chan in self._channel_names:
-            if chan not in self._chan_op_threads:
-                self._notify_warn(source, speaker, 'cannot find chanop thread '
-                                  'for channel', chan)
-                continue
-            chanop_thread = self._chan_op_threads[chan]
-            if chanop_thread.members.contains(nick):
-                return chanop_thread.members[nick]
-        return None
+        ''' support function for _match_nick. Looks up the member for the
+        given nick in the registry of members shared by all moderated channels
+        and returns it if it can be found. Otherwise returns None '''
+        return self._member_registry.find(nick)
 
     def _find_matching_members(self, member):
-        ''' support function for _match_nick. Query the member list in
-        each chanop thread for members that match the given member's username
-        and/or hostname. Returns a dictionary containing matches on username
-        and matches on host. The keys in the subdictionaries are nicknames,
-        and the values are the set of channels that nickname is found in.
+        ''' support function for _match_nick. Query the member registry for
+        members in any moderated channel that match the given member's
+        username and/or hostname. Returns a dictionary containing matches on
+        username and matches on host. The keys in the subdictionaries are
+        nicknames, and the values are the set of channels that nickname is
+        found in.
         '''
-        matches = {'user': {}, 'host': {}}
-        for chan in self._channel_names:
-            # Get all matches in this channel
-            chanop_thread = self._chan_op_threads[chan]
-            match_user, match_host = chanop_thread.members.matches(
-                user=member.user, host=member.host)
-            for match in match_user:
-                # Ignore it if it IS the nick we are asking about
-                if match.nick == member.nick:
-                    continue
-                if match.nick not in matches['user']:
-                    matches['user'][match.nick] = set()
-                # Remember that this matched nick is in this chan
-                matches['user'][match.nick].add(chan)
-            for match in match_host:
-                # Ignore it if it IS the nick we are asking about
-                if match.nick == member.nick:
-                    continue
-                if match.nick not in matches['host']:
-                    matches['host'][match.nick] = set()
-                # Remember that this matched nick is in this chan
-                matches['host'][match.nick].add(chan)
+        matches = self._member_registry.matches(
+            user=member.user, host=member.host)
+        # Ignore it if it IS the nick we are asking about
+        matches['user'].pop(member.nick, None)
+        matches['host'].pop(member.nick, None)
         return matches
 
     def _log_about_matches(self, source, speaker, member, matches, which):
@@ -232,32 +232,16 @@ class CommandListenerThread(PBThread):
                 source, speaker, 'Parsed partial nick "{}" from nick mask '
                 '"{}" which is not long enough. '.format(partial, wild_nick))
             return
-        matches = {}
-        for chan in self._chan_op_threads:
-            chanop_thread = self._chan_op_threads[chan]
-            for mem in chanop_thread.members:
-                mem_nick = mem.nick.lower()
-                if star_front and mem_nick.endswith(partial):
-                    if mem_nick not in matches:
-                        matches[mem_nick] = set()
-                    matches[mem_nick].add(chan)
-                if star_back and mem_nick.startswith(partial):
-                    if mem_nick not in matches:
-                        matches[mem_nick] = set()
-                    matches[mem_nick].add(chan)
-                if star_front and star_back and mem_nick.find(partial) >= 0:
-                    if mem_nick not in matches:
-                        matches[mem_nick] = set()
-                    matches[mem_nick].add(chan)
+        max_matches = 5
+        count, matches = self._member_registry.wildcard(
+            partial, star_front, star_back, limit=max_matches)
         self._notify_impl(
             source, speaker, '{} nicks match the pattern {} in our moderated '
-            'channel(s)'.format(len(matches), wild_nick))
-        max_matches = 5
-        if len(matches) > max_matches:
+            'channel(s)'.format(count, wild_nick))
+        if count > max_matches:
             self._notify_warn(source, speaker, 'only listing the first '
                               '{}'.format(max_matches))
-        keys = sorted(list(matches.keys()))[:max_matches]
-        for nick in keys:
+        for nick in sorted(matches):
             chans = ' '.join(matches[nick])
             self._notify_impl(
                 source, speaker, '    {}: ({})'.format(nick, chans))
@@ -277,6 +261,71 @@ class CommandListenerThread(PBThread):
         self._log_about_matches(source, speaker, member, matches, 'user')
         self._log_about_matches(source, speaker, member, matches, 'host')
 
+    def _proc_timers_msg(self, source, speaker, words):
+        assert words[0].lower() == 'timers'
+        assert speaker in self._masters
+        if len(words) > 2 or (len(words) == 2 and not words[1].isdigit()):
+            self._notify_error(source, speaker, 'bad TIMERS command')
+            self._proc_help_msg(source, speaker, 'help timers'.split())
+            return
+        limit = int(words[1]) if len(words) == 2 else 5
+        # Timers for the channels in shard worker processes (like unmutes)
+        # are there
+        requests = [link.request('timers', None, 'pending')
+                    for link in self._shard_links.values()]
+        pending = timer_service().pending()
+        for request in requests:
+            pending.extend(request.result() or [])
+        pending.sort()
+        self._notify_okay(source, speaker, len(pending), 'timer(s) pending')
+        for seconds, name in pending[:limit]:
+            self._notify_impl(source, speaker,
+                              '{} in {:.0f}s'.format(name, seconds))
+        if len(pending) > limit:
+            self._notify_impl(source, speaker, '... and {} more'.format(
+                len(pending) - limit))
+
+    def _proc_latency_msg(self, source, speaker, words):
+        assert words[0].lower() == 'latency'
+        assert speaker in self._masters
+        if len(words) > 1:
+            self._notify_error(source, speaker, 'bad LATENCY command')
+            self._proc_help_msg(source, speaker, 'help latency'.split())
+            return
+        for stage, hist in latencies().items():
+            if not hist.count:
+                self._notify_impl(source, speaker,
+                                  '{}: nothing yet'.format(stage))
+                continue
+            p50, p90, p99 = hist.quantiles([0.5, 0.9, 0.99])
+            self._notify_impl(
+                source, speaker, '{}: n={} p50={:.1f}ms p90={:.1f}ms '
+                'p99={:.1f}ms max={:.1f}ms'.format(
+                    stage, hist.count, p50 * 1000, p90 * 1000, p99 * 1000,
+                    hist.max * 1000))
+
+    def _proc_loglevel_msg(self, source, speaker, words):
+        assert words[0].lower() == 'loglevel'
+        assert speaker in self._masters
+        log = self._log
+        levels = ['error', 'warn', 'notice', 'info', 'debug']
+        if len(words) > 2 or (len(words) == 2 and
+                              words[1].lower() not in levels):
+            self._notify_error(source, speaker, 'bad LOGLEVEL command')
+            self._proc_help_msg(source, speaker, 'help loglevel'.split())
+            return
+        if len(words) == 1:
+            self._notify_okay(source, speaker, 'logging at', log.level)
+            return
+        level = words[1].lower()
+        # Before changing it, so the new level can't hide this
+        log.notice(speaker, 'set the log level to', level)
+        log.set_level(level)
+        # Shard worker processes have their own loggers
+        for link in self._shard_links.values():
+            link.cast('log', None, 'set_level', level)
+        self._notify_okay(source, speaker, 'logging at', level)
+
     def _proc_match_msg(self, source, speaker, words):
         assert words[0].lower() == 'match'
         assert speaker in self._masters
@@ -448,9 +497,13 @@ class CommandListenerThread(PBThread):
                                           channel, verb, nick, masks, reason)
         self._notify_okay(source, speaker)
 
+    def queue_size(self):
+        ''' How many events are waiting for us to process them '''
+        return self._message_queue.qsize()
+
     def _shutdown(self):
         log = self._log
         log.info('CommandListenerThread going away')
 
-    def recv_line(self, source, line):
-        self._message_queue.put((source, line))
+    def recv_event(self, ev):
+        self._message_queue.put(ev)
@@ -0,0 +1,91 @@
+import errno
+import os
+import time
+
+
+class FifoWriter:
+    ''' Writes lines to one of ii's "in" FIFOs, keeping it open instead of
+    opening and closing it for every line.
+
+    Lines given to add() are buffered until flush(), which writes all of them
+    with a single write(). If ii isn't running or went away (so nobody is
+    reading the FIFO), the FIFO is reopened, trying for up to retry_timeout
+    seconds before giving up on the buffered lines.
+
+    The time each write takes is logged and kept track of in writes,
+    write_seconds, and max_write_seconds. '''
+    def __init__(self, fname, log, retry_timeout=5):
+        self._fname = fname
+        self._log = log
+        self._retry_timeout = retry_timeout
+        self._fd = None
+        self._pending = []
+        self.writes = 0
+        self.write_seconds = 0.0
+        self.max_write_seconds = 0.0
+
+    @property
+    def fname(self):
+        return self._fname
+
+    def add(self, line):
+        self._pending.append(line)
+
+    def flush(self):
+        ''' Write all the lines given to add() since last time. Returns how
+        long the write took, or None if there was nothing to write or we
+        gave up. '''
+        if not self._pending:
+            return None
+        lines, self._pending = self._pending, []
+        data = ''.join(line + '\n' for line in lines).encode('utf8')
+        give_up_at = time.time() + self._retry_timeout
+        warned = False
+        while True:
+            start = time.perf_counter()
+            try:
+                if self._fd is None:
+                    self._open()
+                self._write_all(data)
+            except OSError as e:
+                self._close()
+                if e.errno not in [errno.EPIPE, errno.ENXIO, errno.ENOENT]:
+                    raise
+                if time.time() >= give_up_at:
+                    self._log.warn(e, 'so dropping', len(lines), 'line(s)')
+                    return None
+                if not warned:
+                    self._log.warn(e, 'trying again every 0.1s')
+                    warned = True
+                time.sleep(0.1)
+                continue
+            elapsed = time.perf_counter() - start
+            self.writes += 1
+            self.write_seconds += elapsed
+            self.max_write_seconds = max(self.max_write_seconds, elapsed)
+            self._log.debug('Wrote', len(lines), 'line(s) to', self._fname,
+                            'in {:.3f}ms'.format(elapsed * 1000))
+            return elapsed
+
+    def close(self):
+        self._close()
+
+    def _open(self):
+        # Opening a FIFO for writing normally waits for a reader. With
+        # O_NONBLOCK it fails with ENXIO instead, so we don't hang if ii
+        # isn't running.
+        fd = os.open(self._fname, os.O_WRONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        os.set_blocking(fd, True)
+        self._fd = fd
+        self._log.info('Opened', self._fname)
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = None
+
+    def _write_all(self, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(self._fd, view)
+            view = view[n:]
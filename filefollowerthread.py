@@ -0,0 +1,338 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from threading import Lock
+from pbthread import PBThread
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+_IN_WATCH_MASK = \
+    IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_IN_EVENT = struct.Struct('iIII')
+
+
+class _Inotify:
+    ''' Just enough of inotify(7), through ctypes, to know which files in
+    which directories changed. Raises OSError if inotify isn't available. '''
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, 'Cannot find libc')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'libc does not have inotify')
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(
+            self.fd, os.fsencode(path), _IN_WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read_events(self):
+        ''' Return a list of (wd, mask, name) for all pending events '''
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            off = 0
+            while off < len(buf):
+                wd, mask, _, name_len = _IN_EVENT.unpack_from(buf, off)
+                off += _IN_EVENT.size
+                name = buf[off:off+name_len].rstrip(b'\0')
+                off += name_len
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _FollowedFile:
+    def __init__(self, fname, callback):
+        self.fname = fname
+        self.dirname = os.path.dirname(os.path.abspath(fname))
+        self.basename = os.path.basename(fname)
+        self.callback = callback
+        self.fd = None
+        self.ident = None
+        self.offset = 0
+        self.partial = b''
+        self.lines = 0
+
+
+class FileFollowerThread(PBThread):
+    ''' Follows any number of files like `tail -F -n 0` would, all in this one
+    thread.
+
+    Call follow() with a file name and a function to call with each new line
+    (without the trailing newline) appended to that file. Lines are read from
+    where the file ends at the time follow() is called. Callbacks are called
+    from this thread without any lock held, so they may call follow() and
+    unfollow(), but while one blocks no file is read.
+
+    When inotify is available, the thread sleeps until the kernel says one of
+    the directories containing the files changed and then only looks at the
+    files that changed. Otherwise it stats every file every poll_interval
+    seconds. Either way new data is read in large chunks, and truncated,
+    deleted, or replaced files are noticed and reopened. '''
+    def __init__(self, global_state, poll_interval=0.2):
+        PBThread.__init__(self, self._enter, name='FileFollower')
+        self._poll_interval = poll_interval
+        self._lock = Lock()
+        # fname -> _FollowedFile
+        self._files = {}
+        # dirname -> {basename: _FollowedFile}
+        self._dirs = {}
+        # inotify watch descriptor -> dirname, and the reverse
+        self._wds = {}
+        self._dir_wds = {}
+        self._inotify = None
+        self.update_global_state(global_state)
+
+    def update_global_state(self, gs):
+        self._log = gs['log']
+        self._end_event = gs['events']['kill_watches']
+        if self._log:
+            self._log.info('FileFollowerThread updated state')
+
+    def follow(self, fname, callback):
+        ''' Call from any thread. Start calling callback(line) for every line
+        appended to fname from now on. '''
+        f = _FollowedFile(fname, callback)
+        with self._lock:
+            self._files[fname] = f
+            self._dirs.setdefault(f.dirname, {})[f.basename] = f
+            self._open(f, at_end=True)
+            self._add_watch(f.dirname)
+
+    def unfollow(self, fname):
+        ''' Call from any thread. Stop following fname. '''
+        with self._lock:
+            f = self._files.pop(fname, None)
+            if f is None:
+                return
+            del self._dirs[f.dirname][f.basename]
+            self._close(f)
+
+    def lines_read(self, fname):
+        ''' How many lines we have read from fname since we started
+        following it '''
+        f = self._files.get(fname)
+        return f.lines if f else 0
+
+    def _start_inotify(self):
+        try:
+            self._inotify = _Inotify()
+        except OSError as e:
+            self._log.notice('inotify unavailable, polling files instead:', e)
+            self._inotify = None
+        with self._lock:
+            for dirname in self._dirs:
+                self._add_watch(dirname)
+
+    def _enter(self):
+        log = self._log
+        self._start_inotify()
+        log.info('Started FileFollowerThread instance')
+        while not self._end_event.is_set():
+            if self._inotify is None:
+                self._end_event.wait(self._poll_interval)
+                self._check_all()
+                continue
+            try:
+                readable, _, _ = select.select([self._inotify.fd], [], [], 1)
+            except InterruptedError:
+                continue
+            if not readable:
+                # Nothing happened for a while. Check everything anyway in
+                # case a directory was created (and so couldn't be watched)
+                # after we started following a file in it.
+                self._check_all()
+                continue
+            self._check_changed(self._inotify.read_events())
+        self._shutdown()
+
+    async def _enter_async(self):
+        log = self._log
+        self._start_inotify()
+        log.info('Started FileFollowerThread instance')
+        if self._inotify is None:
+            try:
+                while True:
+                    await asyncio.sleep(self._poll_interval)
+                    self._check_all()
+            finally:
+                self._shutdown()
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(self._inotify.fd, readable.set)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(readable.wait(), 1)
+                except asyncio.TimeoutError:
+                    self._check_all()
+                    continue
+                readable.clear()
+                self._check_changed(self._inotify.read_events())
+        finally:
+            loop.remove_reader(self._inotify.fd)
+            self._shutdown()
+
+    def _shutdown(self):
+        with self._lock:
+            for f in self._files.values():
+                self._close(f)
+        if self._inotify is not None:
+            self._inotify.close()
+        self._log.info('FileFollowerThread going away')
+
+    def _add_watch(self, dirname):
+        if self._inotify is None or dirname in self._dir_wds:
+            return
+        try:
+            wd = self._inotify.add_watch(dirname)
+        except OSError:
+            # Probably doesn't exist yet. We'll try again later.
+            return
+        self._wds[wd] = dirname
+        self._dir_wds[dirname] = wd
+
+    def _check_changed(self, events):
+        changed = set()
+        overflowed = False
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            dirname = self._wds.get(wd)
+            if dirname is not None:
+                changed.add((dirname, name))
+        if overflowed:
+            return self._check_all()
+        new_lines = []
+        with self._lock:
+            for dirname, name in changed:
+                f = self._dirs.get(dirname, {}).get(name)
+                if f is not None:
+                    new_lines.append((f.callback, self._check(f)))
+        self._deliver(new_lines)
+
+    def _check_all(self):
+        new_lines = []
+        with self._lock:
+            for f in self._files.values():
+                self._add_watch(f.dirname)
+                new_lines.append((f.callback, self._check(f)))
+        self._deliver(new_lines)
+
+    def _deliver(self, new_lines):
+        ''' Call each callback with its lines. Done after letting go of the
+        lock, so a slow callback doesn't keep other threads from calling
+        follow() or unfollow(), and a callback can call them itself. '''
+        for callback, lines in new_lines:
+            for line in lines:
+                callback(line)
+
+    def _open(self, f, at_end):
+        try:
+            fd = os.open(f.fname, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            return
+        st = os.fstat(fd)
+        f.fd = fd
+        f.ident = (st.st_dev, st.st_ino)
+        f.offset = st.st_size if at_end else 0
+        f.partial = b''
+        os.lseek(fd, f.offset, os.SEEK_SET)
+
+    def _close(self, f):
+        if f.fd is not None:
+            os.close(f.fd)
+        f.fd = None
+        f.ident = None
+
+    def _check(self, f):
+        ''' Return whatever lines are new in f, noticing if it was truncated
+        or replaced since last time '''
+        lines = []
+        try:
+            st = os.stat(f.fname)
+        except OSError:
+            st = None
+        if f.fd is not None:
+            if st is None or (st.st_dev, st.st_ino) != f.ident:
+                # Deleted or replaced. Get the last of what was written to the
+                # old file before moving on.
+                lines = self._read(f)
+                self._close(f)
+            elif st.st_size < f.offset:
+                self._log.notice(f.fname, 'was truncated')
+                os.lseek(f.fd, 0, os.SEEK_SET)
+                f.offset = 0
+                f.partial = b''
+        if f.fd is None:
+            if st is None:
+                return lines
+            # A new file, so it's all new to us
+            self._open(f, at_end=False)
+            if f.fd is None:
+                # Gone again already, or we can't read it. Try again next
+                # time.
+                return lines
+        return lines + self._read(f)
+
+    def _read(self, f):
+        ''' Return the complete lines that are new in f '''
+        chunks = []
+        while True:
+            data = os.read(f.fd, 256 * 1024)
+            if not data:
+                break
+            chunks.append(data)
+            f.offset += len(data)
+        if not chunks:
+            return []
+        data = f.partial + b''.join(chunks) if f.partial or len(chunks) > 1 \
+            else chunks[0]
+        end = data.rfind(b'\n')
+        if end < 0:
+            f.partial = data
+            return []
+        f.partial = data[end+1:]
+        complete = data[:end]
+        try:
+            lines = complete.decode('utf8').split('\n')
+        except UnicodeDecodeError:
+            lines = [self._decode(line) for line in complete.split(b'\n')]
+        lines = [line for line in lines if line]
+        f.lines += len(lines)
+        return lines
+
+    def _decode(self, line):
+        try:
+            return line.decode('utf8')
+        except UnicodeDecodeError:
+            try:
+                return line.decode('iso-8859-1')
+            except UnicodeDecodeError:
+                self._log.warn('Can\'t decode line, so ignoring:', line)
+                return None
@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from time import time
+from member import fold
+from tokenbucket import TokenBucketArray
+
+
+class FloodStateTable:
+    ''' The flood token buckets of the people speaking in a channel, keyed by
+    casefolded nick (see member.fold()), that only keeps the ones that
+    matter. Nicks can be given in any case.
+
+    A speaker's bucket is forgotten once they have been quiet for ttl
+    seconds and their bucket has refilled, since a new bucket would be
+    exactly the same. If there are ever more than capacity speakers, the one
+    heard from least recently is forgotten early, which does lose state;
+    capacity should be well above the number of people who can speak in ttl
+    seconds.
+
+    hits and misses count spend()s for speakers we had or didn't have a
+    bucket for. expired counts buckets forgotten for being idle, and evicted
+    ones forgotten early for lack of capacity.
+
+    Not thread safe. '''
+    def __init__(self, size, refill_rate, capacity=10000, ttl=600):
+        self._buckets = TokenBucketArray(size, refill_rate)
+        self._capacity = max(1, capacity)
+        self._ttl = ttl
+        # nick -> when last heard from, least recently first
+        self._last_seen = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def __contains__(self, nick):
+        return fold(nick) in self._last_seen
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'capacity': self._capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+    def tokens(self, nick):
+        return self._buckets.tokens(fold(nick))
+
+    def spend(self, nick, now=None):
+        ''' Spend a token from nick's bucket. Returns how long they must wait
+        before speaking again (see token_bucket()). '''
+        if now is None:
+            now = time()
+        nick = fold(nick)
+        last_seen = self._last_seen
+        if nick in last_seen:
+            self.hits += 1
+            last_seen.move_to_end(nick)
+        else:
+            self.misses += 1
+        last_seen[nick] = now
+        wait_time = self._buckets.spend(nick, now)
+        self._expire(now)
+        return wait_time
+
+    def forget(self, nick):
+        ''' Call when nick leaves the channel '''
+        nick = fold(nick)
+        if self._last_seen.pop(nick, None) is not None:
+            self._buckets.forget(nick)
+
+    def rename(self, old_nick, new_nick):
+        ''' Call when old_nick changes their nick to new_nick '''
+        old_nick, new_nick = fold(old_nick), fold(new_nick)
+        if old_nick == new_nick:
+            return
+        seen = self._last_seen.pop(old_nick, None)
+        if seen is None:
+            return
+        self._last_seen.pop(new_nick, None)
+        self._last_seen[new_nick] = seen
+        self._buckets.rename(old_nick, new_nick)
+
+    def clear(self):
+        self._last_seen.clear()
+        self._buckets.clear()
+
+    def _expire(self, now):
+        ''' Forget the buckets that aren't needed anymore. Each spend() only
+        looks at the least recently used few. '''
+        last_seen = self._last_seen
+        oldest_ok = now - self._ttl
+        while last_seen:
+            nick, seen = next(iter(last_seen.items()))
+            if len(last_seen) > self._capacity:
+                self.evicted += 1
+            elif seen > oldest_ok:
+                break
+            elif not self._buckets.is_full(nick, now):
+                # Still paying off a flood. Look again in another ttl.
+                last_seen.move_to_end(nick)
+                last_seen[nick] = now
+                continue
+            else:
+                self.expired += 1
+            del last_seen[nick]
+            self._buckets.forget(nick)
@@ -1,6 +1,7 @@
 from pbthread import PBThread
-from queue import Empty, Queue
 from enum import Enum
+import asyncio
+import threading
 import time
 
 
@@ -32,78 +33,129 @@ class HeartbeatThread(PBThread):
         SET_MODE = 8
         KICK = 9
         CHAN_MSG = 10
+        CHANSERV_SAVED = 11
 
-    def __init__(self, global_state):
+    # The name of the counter for each kind of event
+    _COUNTER_NAMES = {
+        HBEvent.ADD_NICK: 'add_nick',
+        HBEvent.CHANGE_NICK: 'change_nick',
+        HBEvent.DEL_NICK: 'del_nick',
+        HBEvent.QUIET_ADD: 'quiet_add',
+        HBEvent.AKICK_ADD: 'akick_add',
+        HBEvent.QUIET_DEL: 'quiet_del',
+        HBEvent.AKICK_DEL: 'akick_del',
+        HBEvent.SET_MODE: 'mode',
+        HBEvent.KICK: 'kick',
+        HBEvent.CHAN_MSG: 'chan_msg',
+        HBEvent.CHANSERV_SAVED: 'chanserv_saved',
+    }
+
+    def __init__(self, global_state, forward_to=None, shard=None,
+                 forward_interval=5):
         PBThread.__init__(self, self._enter, name='Heartbeat')
-        self._event_queue = Queue(10)
         self._start = time.time()
-        self._counters = {
-            'add_nick': 0, 'add_nick_total': 0,
-            'change_nick': 0, 'change_nick_total': 0,
-            'del_nick': 0, 'del_nick_total': 0,
-            'quiet_add': 0, 'quiet_add_total': 0,
-            'quiet_del': 0, 'quiet_del_total': 0,
-            'akick_add': 0, 'akick_add_total': 0,
-            'akick_del': 0, 'akick_del_total': 0,
-            'mode': 0, 'mode_total': 0,
-            'kick': 0, 'kick_total': 0,
-            'chan_msg': 0, 'chan_msg_total': 0,
-        }
-
+        # In a shard worker process, the main process's HeartbeatThread (a
+        # RemoteThread) that our totals are sent to every forward_interval
+        # seconds. We don't log heartbeats ourselves then. Sending totals
+        # instead of every event keeps the pipe off the path every chat
+        # line takes.
+        self._forward_to = forward_to
+        self._shard = shard
+        self._forward_interval = forward_interval
+        # shard -> the totals_by_channel() it last sent us
+        self._remote_totals = {}
+        # Every thread that reports events counts them in its own lists (one
+        # per channel), indexed by HBEvent value, so reporting an event never
+        # waits on anybody. We add them all up when logging a heartbeat.
+        self._local = threading.local()
+        # (channel, counts) for every list in every thread
+        self._all_counts = []
+        self._all_counts_lock = threading.Lock()
+        # The totals as of the last heartbeat
+        self._last_totals = self.totals()
         self.update_global_state(global_state)
 
     def _enter(self):
         log = self._log
         log.info('Starting Heartbeatthread instance')
-        while not self._end_event.is_set():
-            event = None
-            try:
-                event = self._event_queue.get(timeout=1)
-            except Empty:
-                if self._end_event.is_set():
-                    return self._shutdown()
-            if event is not None:
-                self._handle_event(event)
-            if self._should_log_heartbeat():
-                self._log_heartbeat()
-
-    def _handle_event(self, event):
-        assert isinstance(event, HeartbeatThread.HBEvent)
-        counters = self._counters
-        if event == HeartbeatThread.HBEvent.ADD_NICK:
-            counters['add_nick'] += 1
-            counters['add_nick_total'] += 1
-        elif event == HeartbeatThread.HBEvent.CHANGE_NICK:
-            counters['change_nick'] += 1
-            counters['change_nick_total'] += 1
-        elif event == HeartbeatThread.HBEvent.DEL_NICK:
-            counters['del_nick'] += 1
-            counters['del_nick_total'] += 1
-        elif event == HeartbeatThread.HBEvent.QUIET_ADD:
-            counters['quiet_add'] += 1
-            counters['quiet_add_total'] += 1
-        elif event == HeartbeatThread.HBEvent.AKICK_ADD:
-            counters['akick_add'] += 1
-            counters['akick_add_total'] += 1
-        elif event == HeartbeatThread.HBEvent.QUIET_DEL:
-            counters['quiet_del'] += 1
-            counters['quiet_del_total'] += 1
-        elif event == HeartbeatThread.HBEvent.AKICK_DEL:
-            counters['akick_del'] += 1
-            counters['akick_del_total'] += 1
-        elif event == HeartbeatThread.HBEvent.SET_MODE:
-            counters['mode'] += 1
-            counters['mode_total'] += 1
-        elif event == HeartbeatThread.HBEvent.KICK:
-            counters['kick'] += 1
-            counters['kick_total'] += 1
-        elif event == HeartbeatThread.HBEvent.CHAN_MSG:
-            counters['chan_msg'] += 1
-            counters['chan_msg_total'] += 1
-        else:
-            assert None, 'Unreachable'
+        while not self._end_event.wait(self._wait_time()):
+            self._beat()
+        self._shutdown()
+
+    async def _enter_async(self):
+        log = self._log
+        log.info('Starting Heartbeatthread instance')
+        try:
+            while True:
+                await asyncio.sleep(self._wait_time())
+                self._beat()
+        finally:
+            self._shutdown()
+
+    @property
+    def forwards_totals(self):
+        ''' True if our totals are sent to another process's
+        HeartbeatThread, which counts them as its own '''
+        return self._forward_to is not None
+
+    def _beat(self):
+        if self.forwards_totals:
+            self._forward()
+        elif self._should_log_heartbeat():
+            self._log_heartbeat()
+
+    def _forward(self):
+        self._forward_to.set_remote_totals(
+            self._shard, self.totals_by_channel())
+
+    def set_remote_totals(self, shard, by_channel):
+        ''' Call from any thread. Count by_channel, the totals_by_channel()
+        of the HeartbeatThread in the given shard worker process, instead of
+        whatever it sent before. '''
+        with self._all_counts_lock:
+            self._remote_totals[shard] = by_channel
+
+    def _wait_time(self):
+        if self.forwards_totals:
+            return self._forward_interval
+        # Wake up at least once a minute in case the interval changed
+        until = self._time_until_heartbeat()
+        return 60 if until is None else min(60, until + 0.01)
+
+    def totals(self):
+        ''' Call from any thread. Return a dict of counter names to how many
+        of each event happened since we started, including in shard worker
+        processes. '''
+        totals = dict.fromkeys(HeartbeatThread._COUNTER_NAMES.values(), 0)
+        for channel_totals in self.totals_by_channel().values():
+            for name, total in channel_totals.items():
+                totals[name] += total
+        return totals
+
+    def totals_by_channel(self):
+        ''' Call from any thread. Like totals(), but a dict of channel names
+        to totals for events in that channel. Events that weren't about a
+        channel are under None. '''
+        with self._all_counts_lock:
+            all_counts = list(self._all_counts)
+            remote_totals = list(self._remote_totals.values())
+        by_channel = {}
+        for channel, counts in all_counts:
+            totals = by_channel.setdefault(channel, dict.fromkeys(
+                HeartbeatThread._COUNTER_NAMES.values(), 0))
+            for event, name in HeartbeatThread._COUNTER_NAMES.items():
+                totals[name] += counts[event.value]
+        for shard_totals in remote_totals:
+            for channel, channel_totals in shard_totals.items():
+                totals = by_channel.setdefault(channel, dict.fromkeys(
+                    HeartbeatThread._COUNTER_NAMES.values(), 0))
+                for name, total in channel_totals.items():
+                    totals[name] += total
+        return by_channel
 
     def _shutdown(self):
+        if self.forwards_totals:
+            self._forward()
         self._log.info('HeartbeatThread going away')
 
     def _should_log_heartbeat(self):
@@ -114,9 +166,20 @@ class HeartbeatThread(PBThread):
         last = self._last
         return last + interval < now
 
+    def _time_until_heartbeat(self):
+        ''' Seconds until we should log a heartbeat, or None if never '''
+        if self._interval < 0:
+            return None
+        return max(0, self._last + self._interval - time.time())
+
     def _log_heartbeat(self):
         log = self._log
-        counters = self._counters
+        totals = self.totals()
+        counters = {}
+        for name, total in totals.items():
+            counters[name] = total - self._last_totals[name]
+            counters[name + '_total'] = total
+        self._last_totals = totals
         self._last = time.time()
         runtime = seconds_to_duration(self._last - self._start)
         log('Running for {runtime}. '
@@ -129,7 +192,8 @@ class HeartbeatThread(PBThread):
             '{qadd} added quiets ({qadd_t}); '
             '{qdel} deleted quiets ({qdel_t}); '
             '{badd} added akicks ({badd_t}); '
-            '{bdel} deleted akicks ({bdel_t}).'
+            '{bdel} deleted akicks ({bdel_t}); '
+            '{csaved} chanserv messages not resent ({csaved_t}).'
             .format(
                 runtime=runtime,
                 nadd=counters['add_nick'], nadd_t=counters['add_nick_total'],
@@ -142,18 +206,10 @@ class HeartbeatThread(PBThread):
                 bdel=counters['akick_del'], bdel_t=counters['akick_del_total'],
                 mode=counters['mode'], mode_t=counters['mode_total'],
                 kick=counters['kick'], kick_t=counters['kick_total'],
-                cmsg=counters['chan_msg'], cmsg_t=counters['chan_msg_total']
+                cmsg=counters['chan_msg'], cmsg_t=counters['chan_msg_total'],
+                csaved=counters['chanserv_saved'],
+                csaved_t=counters['chanserv_saved_total'],
             ))
-        counters['add_nick'] = 0
-        counters['change_nick'] = 0
-        counters['del_nick'] = 0
-        counters['quiet_add'] = 0
-        counters['quiet_del'] = 0
-        counters['akick_add'] = 0
-        counters['akick_del'] = 0
-        counters['mode'] = 0
-        counters['kick'] = 0
-        counters['chan_msg'] = 0
 
     def update_global_state(self, gs):
         self._log = gs['log']
@@ -169,47 +225,63 @@ class HeartbeatThread(PBThread):
         self._last = time.time()
         self._end_event = gs['events']['kill_heartbeat']
 
-    def _add(self, event):
-        ''' Called (indirectly) from other threads '''
-        assert isinstance(event, HeartbeatThread.HBEvent)
-        self._event_queue.put(event)
+    def _add(self, event, n=1, channel=None):
+        ''' Called (indirectly) from other threads. Never blocks. '''
+        try:
+            by_channel = self._local.counts
+        except AttributeError:
+            by_channel = self._local.counts = {}
+        counts = by_channel.get(channel)
+        if counts is None:
+            # First event about this channel from this thread
+            counts = [0] * (len(HeartbeatThread.HBEvent) + 1)
+            by_channel[channel] = counts
+            with self._all_counts_lock:
+                self._all_counts.append((channel, counts))
+        # Only this thread ever changes its counts
+        counts[event.value] += n
+
+    def event_add_nick(self, channel=None):
+        ''' Call from other threads when events happen '''
+        return self._add(HeartbeatThread.HBEvent.ADD_NICK, channel=channel)
 
-    def event_add_nick(self):
+    def event_del_nick(self, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.ADD_NICK)
+        return self._add(HeartbeatThread.HBEvent.DEL_NICK, channel=channel)
 
-    def event_del_nick(self):
+    def event_change_nick(self, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.DEL_NICK)
+        return self._add(HeartbeatThread.HBEvent.CHANGE_NICK, channel=channel)
 
-    def event_change_nick(self):
+    def event_add_akick(self, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.CHANGE_NICK)
+        return self._add(HeartbeatThread.HBEvent.AKICK_ADD, channel=channel)
 
-    def event_add_akick(self):
+    def event_add_quiet(self, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.AKICK_ADD)
+        return self._add(HeartbeatThread.HBEvent.QUIET_ADD, channel=channel)
 
-    def event_add_quiet(self):
+    def event_del_quiet(self, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.QUIET_ADD)
+        return self._add(HeartbeatThread.HBEvent.QUIET_DEL, channel=channel)
 
-    def event_del_quiet(self):
+    def event_del_akick(self, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.QUIET_DEL)
+        return self._add(HeartbeatThread.HBEvent.AKICK_DEL, channel=channel)
 
-    def event_del_akick(self):
+    def event_set_mode(self, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.AKICK_DEL)
+        return self._add(HeartbeatThread.HBEvent.SET_MODE, channel=channel)
 
-    def event_set_mode(self):
+    def event_kick(self, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.SET_MODE)
+        return self._add(HeartbeatThread.HBEvent.KICK, channel=channel)
 
-    def event_kick(self):
+    def event_chan_msg(self, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.KICK)
+        return self._add(HeartbeatThread.HBEvent.CHAN_MSG, channel=channel)
 
-    def event_chan_msg(self):
+    def event_chanserv_saved(self, messages=1, channel=None):
         ''' Call from other threads when events happen '''
-        return self._add(HeartbeatThread.HBEvent.CHAN_MSG)
+        return self._add(HeartbeatThread.HBEvent.CHANSERV_SAVED, messages,
+                         channel=channel)
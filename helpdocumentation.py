@@ -87,6 +87,20 @@ examples:
     match freak*
 '''
 
+help_timers = '''List the timers waiting to fire (like unmutes), soonest first.
+timers [count]
+With shards, includes the timers in every worker process.
+'''
+
+help_loglevel = '''Show the level the bot logs at, or change it. Messages noisier than the level aren't logged at all.
+loglevel [error|warn|notice|info|debug]
+'''
+
+help_latency = '''Show how long lines from ii took to get through each stage on their way to becoming a kick, quiet, or mode change, from reading the line (chanop_queue) to writing the command to ii (fifo_write), and in total.
+latency
+With shards, the stages before outbound_queue happen in the worker processes, so only show up in their metrics.
+'''
+
 help_ = {
     'help': {
         'str': help_help,
@@ -126,6 +140,18 @@ help_ = {
         'str': help_match,
         'subs': None,
     },
+    'timers': {
+        'str': help_timers,
+        'subs': None,
+    },
+    'latency': {
+        'str': help_latency,
+        'subs': None,
+    },
+    'loglevel': {
+        'str': help_loglevel,
+        'subs': None,
+    },
 }
 
 help_['help']['str'] = help_['help']['str'].format(comms=' '.join(help_.keys()))
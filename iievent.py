@@ -0,0 +1,97 @@
+from collections import namedtuple
+
+
+class IIEvent(namedtuple('IIEvent', [
+        'source', 'timestamp', 'kind', 'speaker', 'words', 'text',
+        'channel', 'nick', 'user', 'host', 'mode', 'target',
+        'received_at'])):
+    ''' One line from one of ii's out files, parsed once by the
+    WatchFile that read it and then handed to every thread that cares
+    about it. Immutable, so it can be shared between threads without copying.
+
+    - source: what kind of file the line came from. One of 'chan', 'comm',
+      'serv', or 'priv'.
+    - timestamp: the timestamp ii wrote at the start of the line
+    - kind: see IIEvent.KINDS
+    - speaker: for privmsg, the nick that said it. For ctrl messages '-!-'.
+      For WHO replies, the channel. Otherwise whatever ii put there.
+    - words: tuple of the whitespace separated words after the speaker
+    - text: the words joined back together with single spaces
+    - received_at: the monotonic() time the line was read, if known (see
+      latency.Trace)
+
+    The remaining fields are None unless they make sense for the kind of
+    event:
+
+    - channel: the channel joined/left/whose mode changed/in the WHO reply
+    - nick: who joined/left/quit/changed nick/changed mode/is in a WHO reply
+    - user, host: for join and WHO replies
+    - mode: for mode changes, the mode string (like '+o')
+    - target: for mode changes, the argument to the mode (if any). For nick
+      changes, the new nick.
+    '''
+    __slots__ = ()
+
+    PRIVMSG = 'privmsg'
+    JOIN = 'join'
+    PART = 'part'
+    QUIT = 'quit'
+    NICK = 'nick'
+    MODE = 'mode'
+    WHO_REPLY = 'who-reply'
+    WHO_END = 'who-end'
+    OTHER = 'other'
+    KINDS = [PRIVMSG, JOIN, PART, QUIT, NICK, MODE, WHO_REPLY, WHO_END, OTHER]
+
+
+def _split_nick_user_host(s):
+    ''' Split ii's "nick(user@host)" '''
+    nick, _, rest = s.partition('(')
+    user, _, host = rest.partition('@')
+    return nick, user or None, host.rstrip(')') or None
+
+
+def parse_line(source, line, received_at=None):
+    ''' Parse one line from an ii out file into an IIEvent '''
+    tokens = line.split()
+    timestamp = ' '.join(tokens[0:2])
+    speaker = tokens[2] if len(tokens) > 2 else ''
+    words = tuple(tokens[3:])
+    text = ' '.join(words)
+    kind = IIEvent.OTHER
+    channel, nick, user, host, mode, target = [None] * 6
+    if speaker == '-!-' and len(words) >= 3:
+        if words[1] == 'changed' and words[2].startswith('mode/'):
+            kind = IIEvent.MODE
+            nick = words[0]
+            channel = words[2][len('mode/'):]
+            mode = words[4] if len(words) >= 5 else None
+            target = words[5] if len(words) >= 6 else None
+        elif words[1:3] == ('has', 'joined') and len(words) >= 4:
+            kind = IIEvent.JOIN
+            nick, user, host = _split_nick_user_host(words[0])
+            channel = words[3]
+        elif words[1:3] == ('has', 'left') and len(words) >= 4:
+            kind = IIEvent.PART
+            nick = words[0].split('(')[0]
+            channel = words[3]
+        elif words[1:3] == ('has', 'quit'):
+            kind = IIEvent.QUIT
+            nick = words[0].split('(')[0]
+        elif words[1:4] == ('changed', 'nick', 'to') and len(words) >= 5:
+            kind = IIEvent.NICK
+            nick = words[0]
+            target = words[4]
+    elif len(speaker) > 2 and speaker[0] == '<' and speaker[-1] == '>':
+        kind = IIEvent.PRIVMSG
+        speaker = speaker[1:-1]
+        nick = speaker
+    elif speaker[:1] == '#':
+        channel = speaker
+        if text == 'End of /WHO list.':
+            kind = IIEvent.WHO_END
+        elif len(words) >= 6:
+            kind = IIEvent.WHO_REPLY
+            user, host, _, nick = words[0:4]
+    return IIEvent(source, timestamp, kind, speaker, words, text,
+                   channel, nick, user, host, mode, target, received_at)
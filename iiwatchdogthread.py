@@ -1,3 +1,4 @@
+import asyncio
 import os
 import subprocess
 import json
@@ -9,21 +10,24 @@ class IIWatchdogThread(PBThread):
         PBThread.__init__(self, self._enter, name='IIWatchdog')
         self.update_global_state(global_state)
 
-    def _enter(self):
-        log = self._log
+    def _ii_command(self):
         conf = self._conf
         ii_bin = conf['ii']['path']
         nick = conf['ii']['server_username']
         server = conf['ii']['server']
         port = conf['ii']['port']
-        server_pass = conf['ii']['server_password']
         ircdir = conf['ii']['ircdir']
+        return '{} -i {} -s {} -p {} -n {} -k PASS'\
+            .format(ii_bin, ircdir, server, port, nick).split(' ')
+
+    def _enter(self):
+        log = self._log
+        server_pass = self._conf['ii']['server_password']
         while True:
             self._prepare_ircdir()
             log.info('(Re)Starting ii process')
             ii = subprocess.Popen(
-                '{} -i {} -s {} -p {} -n {} -k PASS'
-                .format(ii_bin, ircdir, server, port, nick).split(' '),
+                self._ii_command(),
                 env={'PASS': server_pass},
             )
             while not self._end_event.wait(10):
@@ -44,6 +48,25 @@ class IIWatchdogThread(PBThread):
                 ii.terminate()
                 break
 
+    async def _enter_async(self):
+        log = self._log
+        server_pass = self._conf['ii']['server_password']
+        ii = None
+        try:
+            while True:
+                self._prepare_ircdir()
+                log.info('(Re)Starting ii process')
+                ii = await asyncio.create_subprocess_exec(
+                    *self._ii_command(), env={'PASS': server_pass})
+                await ii.wait()
+                log.debug('ii process went away')
+                # Don't restart it in a tight loop if it keeps dying
+                await asyncio.sleep(10)
+        finally:
+            if ii is not None and ii.returncode is None:
+                log.info('Stopping ii process for good')
+                ii.terminate()
+
     def _prepare_ircdir(self):
         conf = self._conf
         server_dir = os.path.join(conf['ii']['ircdir'], conf['ii']['server'])
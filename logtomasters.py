@@ -0,0 +1,48 @@
+class LogToMasters:
+    ''' watches a file for log messages, and then sends them to an IRC
+    channel
+
+    The reading itself is done by the FileFollowerThread. Call start() once
+    the global state has everything in it to start relaying lines. '''
+    def __init__(self, fname, global_state):
+        self._fname = fname
+        self.update_global_state(global_state)
+
+    @property
+    def fname(self):
+        return self._fname
+
+    @property
+    def source(self):
+        return 'log'
+
+    def lines_read(self):
+        return self._file_follower.lines_read(self._fname)
+
+    def start(self):
+        log = self._log
+        log.info('Starting LogToMasters', self._fname)
+        self._file_follower.follow(self._fname, self._recv_line)
+        return self
+
+    def stop(self):
+        self._file_follower.unfollow(self._fname)
+        log = self._log
+        if log:
+            log.info('LogToMasters', self._fname, 'going away')
+
+    def _recv_line(self, line):
+        ''' Called in the FileFollowerThread with every new line '''
+        omt = self._out_msg_thread
+        omt.add(omt.privmsg,
+                [self._channel, line],
+                {'log_it': False},
+                lane='log')
+
+    def update_global_state(self, gs):
+        self._log = gs['log']
+        self._channel = gs['conf']['log']['out_channel']
+        self._out_msg_thread = gs['threads']['out_message']
+        self._file_follower = gs['threads']['file_follower']
+        if self._log:
+            self._log.info('LogToMasters', self._fname, 'updated state')
@@ -1,154 +1,390 @@
 #!/usr/bin/env python3
 # python stuff
+import asyncio
+import multiprocessing
 import os
+import signal
 import time
 import json
 from configparser import ConfigParser
 from threading import Event
 # my stuff
 from tokenbucket import token_bucket
-from watchfilethread import WatchFileThread
-from logtomastersthread import LogToMastersThread
+from filefollowerthread import FileFollowerThread
+from watchfile import WatchFile
+from logtomasters import LogToMasters
+from metricsthread import MetricsThread
 from chanopthread import ChanOpThread
 from commandlistenerthread import CommandListenerThread
 from iiwatchdogthread import IIWatchdogThread
 from operatoractionthread import OperatorActionThread
 from outboundmessagethread import OutboundMessageThread
 from heartbeatthread import HeartbeatThread
+from member import MemberRegistry
 from pastlylogger import PastlyLogger
+from pbthread import PBThread
+from pbtimer import use_event_loop, use_log
+from shard import OutboundProxy, RemoteChanOp, RemoteThread, \
+    ShardedMemberRegistry, ShardLinkThread, split_channels
 
 
-def create_threads(gs):
-    server_dir = os.path.join(
-        gs['conf']['ii']['ircdir'], gs['conf']['ii']['server'])
-
+def create_logger(gs, overwrite=['debug']):
+    # If asked, messages are written by the logger's own thread so that
+    # logging doesn't slow down the threads doing the moderating. It drops
+    # messages when too many are waiting, so it is off unless turned on.
+    async_writes = gs['conf'].getboolean('log', 'async', fallback=False)
+    buffer_size = gs['conf'].getint('log', 'buffer_size', fallback=10000)
+    level = gs['conf'].get('log', 'level', fallback='debug')
     if 'log' in gs['conf'] and \
             'in_file' in gs['conf']['log'] and \
             'out_channel' in gs['conf']['log']:
         fname = gs['conf']['log']['in_file']
         gs['log'] = PastlyLogger(
             debug='/dev/stdout', notice=fname,
-            overwrite=['debug'], log_threads=True, default='notice')
+            overwrite=overwrite, log_threads=True, default='notice',
+            async_writes=async_writes, buffer_size=buffer_size,
+            level=level)
     else:
         gs['log'] = PastlyLogger(
-            debug='/dev/stdout', overwrite=['debug'],
-            log_threads=True, default='notice')
+            debug='/dev/stdout', overwrite=overwrite,
+            log_threads=True, default='notice',
+            async_writes=async_writes, buffer_size=buffer_size,
+            level=level)
+    # So a failed unmute shows up in the log, not just on stderr
+    use_log(gs['log'])
+    return gs
 
-    channel_names = json.loads(gs['conf']['ii']['channels'])
 
-    gs['threads']['heart'] = HeartbeatThread(gs)
+def configured_shards(gs):
+    ''' How many worker processes the channels should be spread over. 1 (or
+    less) means everything is done in this process. '''
+    return gs['conf'].getint('general', 'shards', fallback=1)
 
-    gs['threads']['out_message'] = \
-        OutboundMessageThread(gs, long_timeout=5,
-                              time_between_actions_func=token_bucket(5, 0.505))
+
+def create_channel_components(gs, channel_names):
+    ''' Create the threads and watches that moderate the given channels, and
+    the watch on the server's out file that they all need '''
+    server_dir = os.path.join(
+        gs['conf']['ii']['ircdir'], gs['conf']['ii']['server'])
 
     for channel_name in channel_names:
         gs['threads']['op_actions'][channel_name] = \
             OperatorActionThread(gs, channel_name)
         gs['threads']['chan_ops'][channel_name] = \
             ChanOpThread(gs, channel_name)
-        gs['threads']['watch_chans'][channel_name] = WatchFileThread(
+        gs['watches']['chans'][channel_name] = WatchFile(
             os.path.join(server_dir, channel_name, 'out'), 'chan', gs,
             channel_name=channel_name)
 
-    gs['threads']['command_listener'] = CommandListenerThread(gs)
-
-    gs['threads']['watch_serv'] = WatchFileThread(
+    gs['watches']['serv'] = WatchFile(
         os.path.join(server_dir, 'out'), 'serv', gs)
+    return gs
+
+
+def create_metrics(gs, shard=None):
+    ''' Create the thread that writes metrics, if the config asks for them.
+    Shard worker processes write to their own file. '''
+    fname = gs['conf'].get('metrics', 'file', fallback=None)
+    if not fname:
+        return gs
+    if shard is not None:
+        base, ext = os.path.splitext(fname)
+        fname = '{}.shard{}{}'.format(base, shard, ext)
+    gs['threads']['metrics'] = MetricsThread(gs, fname, shard=shard)
+    return gs
+
 
-    gs['threads']['watch_priv'] = WatchFileThread(
+def create_shards(gs, shards):
+    ''' Instead of moderating the channels in this process, create (but don't
+    start) up to shards worker processes that each moderate some of them,
+    and stand-ins for their threads '''
+    ctx = multiprocessing.get_context('spawn')
+    channel_names = json.loads(gs['conf']['ii']['channels'])
+    links = []
+    for shard, shard_channels in \
+            enumerate(split_channels(channel_names, shards)):
+        if not shard_channels:
+            continue
+        peer = 'shard{}'.format(shard)
+        conn, child_conn = ctx.Pipe()
+        link = ShardLinkThread(gs, conn, peer)
+        links.append(link)
+        gs['threads']['shard_links'][peer] = link
+        gs['shards'][peer] = {
+            'process': ctx.Process(
+                target=run_shard_worker, name=peer,
+                args=(gs['config_file'], shard, shards, child_conn)),
+            'conn': child_conn,
+        }
+        for channel_name in shard_channels:
+            gs['threads']['op_actions'][channel_name] = \
+                RemoteThread(link, 'op_actions', channel_name)
+            gs['threads']['chan_ops'][channel_name] = \
+                RemoteChanOp(link, channel_name)
+    gs['member_registry'] = ShardedMemberRegistry(links)
+    return gs
+
+
+def create_components(gs, shards=1):
+    ''' Create (but don't start) everything that makes up the bot '''
+    server_dir = os.path.join(
+        gs['conf']['ii']['ircdir'], gs['conf']['ii']['server'])
+
+    gs = create_logger(gs)
+
+    channel_names = json.loads(gs['conf']['ii']['channels'])
+
+    gs['threads']['heart'] = HeartbeatThread(gs)
+
+    gs['threads']['out_message'] = \
+        OutboundMessageThread(gs, long_timeout=5,
+                              time_between_actions_func=token_bucket(5, 0.505))
+
+    gs['threads']['file_follower'] = FileFollowerThread(gs)
+
+    if shards > 1:
+        gs = create_shards(gs, shards)
+    else:
+        gs = create_channel_components(gs, channel_names)
+
+    gs['threads']['command_listener'] = CommandListenerThread(gs)
+
+    gs['watches']['priv'] = WatchFile(
         os.path.join(server_dir, 'TorModBot'.lower(), 'out'), 'priv', gs)
 
     if 'general' in gs['conf'] and 'command_channel' in gs['conf']['general']:
         comm_chan = gs['conf']['general']['command_channel']
-        gs['threads']['watch_comm'] = WatchFileThread(
+        gs['watches']['comm'] = WatchFile(
             os.path.join(server_dir, comm_chan, 'out'), 'comm', gs,
             channel_name=comm_chan)
 
     if 'log' in gs['conf'] and \
             'in_file' in gs['conf']['log'] and \
             'out_channel' in gs['conf']['log']:
-        gs['threads']['log_to_masters'] = LogToMastersThread(
+        gs['watches']['log_to_masters'] = LogToMasters(
             gs['conf']['log']['in_file'], gs)
 
     gs['threads']['ii_watchdog'] = IIWatchdogThread(gs)
+    gs = create_metrics(gs)
+    return gs
 
-    gs['threads']['ii_watchdog'].start()
-    time.sleep(2)
+
+def start_watches(gs):
+    for w in gs['watches']:
+        watch = gs['watches'][w]
+        if watch is None:
+            continue
+        if isinstance(watch, dict):
+            for watch_ in watch:
+                watch[watch_].update_global_state(gs)
+                watch[watch_].start()
+        else:
+            watch.update_global_state(gs)
+            watch.start()
+
+
+def start_threads(gs):
+    ''' Start every thread in gs that isn't running yet. Stand-ins for
+    threads in other processes are skipped. '''
     for t in gs['threads']:
         thread = gs['threads'][t]
         if thread is None:
             continue
         if isinstance(thread, dict):
             for thread_ in thread:
-                if not thread[thread_].is_alive():
+                if isinstance(thread[thread_], PBThread) and \
+                        not thread[thread_].is_alive():
                     thread[thread_].update_global_state(gs)
                     thread[thread_].start()
-        else:
-            if not thread.is_alive():
-                thread.update_global_state(gs)
-                thread.start()
+        elif isinstance(thread, PBThread) and not thread.is_alive():
+            thread.update_global_state(gs)
+            thread.start()
+
+
+def create_threads(gs):
+    gs = create_components(gs, shards=configured_shards(gs))
+
+    gs['threads']['ii_watchdog'].start()
+    time.sleep(2)
+    for peer in gs['shards']:
+        gs['shards'][peer]['process'].start()
+        # Only the worker needs its end of the pipe. Closing ours means we
+        # notice if it dies.
+        gs['shards'][peer]['conn'].close()
+    start_threads(gs)
+    start_watches(gs)
     time.sleep(1)
     return gs
 
 
+def join_threads(gs, t):
+    ''' Wait for the thread(s) in gs['threads'][t] that live in this
+    process '''
+    threads = gs['threads'][t]
+    if not isinstance(threads, dict):
+        threads = {t: threads}
+    for thread in threads.values():
+        if isinstance(thread, PBThread):
+            thread.join()
+
+
 def destroy_threads(gs):
+    if gs['shards']:
+        gs['log'].notice('Waiting for shard worker processes ...')
+        for peer in gs['shards']:
+            gs['threads']['shard_links'][peer].stop()
+        for peer in gs['shards']:
+            process = gs['shards'][peer]['process']
+            # Leftover timers (like for unmuting) would keep it around
+            process.join(timeout=10)
+            if process.is_alive():
+                gs['log'].warn(peer, 'is taking too long. Terminating it.')
+                process.terminate()
+                process.join()
+            gs['threads']['shard_links'][peer].join()
+
+    # First, so its last snapshot is of everything still running
+    gs['events']['kill_metrics'].set()
+    gs['log'].notice('Waiting for metrics thread ...')
+    join_threads(gs, 'metrics')
+
     gs['events']['kill_heartbeat'].set()
     gs['log'].notice('Waiting for heartbeat thread ...')
-    gs['threads']['heart'].join()
+    join_threads(gs, 'heart')
 
     gs['events']['kill_command_listener'].set()
     gs['log'].notice('Waiting for command listener threads ..')
-    gs['threads']['command_listener'].join()
+    join_threads(gs, 'command_listener')
 
     gs['events']['kill_watches'].set()
-    gs['log'].notice('Waiting for watch file threads ...')
-    for t in gs['threads']['watch_chans']:
-        gs['threads']['watch_chans'][t].join()
-    gs['threads']['watch_serv'].join()
-    gs['threads']['watch_priv'].join()
-    gs['threads']['watch_comm'].join()
+    gs['log'].notice('Waiting for file follower thread ...')
+    join_threads(gs, 'file_follower')
 
     gs['events']['kill_chanops'].set()
     gs['log'].notice('Waiting for chan op threads ...')
-    for t in gs['threads']['chan_ops']:
-        gs['threads']['chan_ops'][t].join()
+    join_threads(gs, 'chan_ops')
 
     gs['events']['kill_opactions'].set()
     gs['log'].notice('Waiting for operator action threads ...')
-    for t in gs['threads']['op_actions']:
-        gs['threads']['op_actions'][t].join()
-
-    if gs['threads']['log_to_masters'] is not None:
-        gs['events']['kill_logtomasters'].set()
-        gs['log'].notice('Waiting for log to masters thread ...')
-        gs['threads']['log_to_masters'].join()
+    join_threads(gs, 'op_actions')
 
     gs['events']['kill_outmessage'].set()
     gs['log'].notice('Waiting for out message thread ...')
-    gs['threads']['out_message'].join()
+    join_threads(gs, 'out_message')
 
     gs['events']['kill_iiwatchdog'].set()
     gs['log'].notice('Waiting for ii watchdog thread ...')
-    gs['threads']['ii_watchdog'].join()
+    join_threads(gs, 'ii_watchdog')
     return gs
 
 
-def main():
-    config_file = 'config.ini'
+def run_shard_worker(config_file, shard, shards, conn):
+    ''' The main function of a shard worker process (see create_shards()).
+    Moderate this shard's channels, sending everything else to the main
+    process over conn, until the main process tells us to stop. '''
+    # The main process decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    gs = new_global_state(config_file)
+    # The main process already started the log files. Add to them.
+    gs = create_logger(gs, overwrite=[])
+    link = ShardLinkThread(gs, conn, 'main')
+    gs['threads']['shard_links']['main'] = link
+    gs['threads']['out_message'] = OutboundProxy(link)
+    gs['threads']['heart'] = HeartbeatThread(
+        gs, forward_to=RemoteThread(link, 'heart'), shard=shard)
+    gs['threads']['file_follower'] = FileFollowerThread(gs)
+    channel_names = split_channels(
+        json.loads(gs['conf']['ii']['channels']), shards)[shard]
+    gs = create_channel_components(gs, channel_names)
+    gs = create_metrics(gs, shard=shard)
+    start_threads(gs)
+    start_watches(gs)
+    gs['log'].notice('Shard', shard, 'moderating', ', '.join(channel_names))
+    link.join()
+    gs = destroy_threads(gs)
+    gs['log'].notice('Shard', shard, 'done')
+    gs['log'].close()
+
+
+async def run_async(gs):
+    ''' The alternative to create_threads() and destroy_threads(). Instead of
+    each component getting its own thread, run every one of them as a
+    coroutine on this one asyncio event loop until we get SIGINT or SIGTERM.
+    Queues, events, and timers all use the loop too. '''
+    loop = asyncio.get_running_loop()
+    gs['loop'] = loop
+    use_event_loop(loop)
+    gs = create_components(gs)
+    log = gs['log']
+    if configured_shards(gs) > 1:
+        log.warn('Shards are not supported with the asyncio runtime. '
+                 'Moderating all channels in this process.')
+
+    def log_task_death(task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error('Task', task.get_name(), 'died:', task.exception())
+
+    def start_task(name, thread):
+        thread.update_global_state(gs)
+        task = loop.create_task(thread.run_async(), name=name)
+        task.add_done_callback(log_task_death)
+        return task
+
+    tasks = [start_task('ii_watchdog', gs['threads']['ii_watchdog'])]
+    await asyncio.sleep(2)
+    for t in gs['threads']:
+        thread = gs['threads'][t]
+        if thread is None or t == 'ii_watchdog':
+            continue
+        if isinstance(thread, dict):
+            for thread_ in thread:
+                tasks.append(start_task('{}-{}'.format(t, thread_),
+                                        thread[thread_]))
+        else:
+            tasks.append(start_task(t, thread))
+    start_watches(gs)
+    log_ready(gs)
+
+    stop = asyncio.Event()
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    log.notice('Cancelling all tasks ...')
+    for task in reversed(tasks):
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    use_event_loop(None)
+    return gs
+
+
+def log_ready(gs):
+    channels_str = ', '.join(json.loads(gs['conf']['ii']['channels']))
+    masters_str = ', '.join(json.loads(gs['conf']['general']['masters']))
+    gs['log'](
+        'All started and ready to go. I can\'t wait to help! '
+        'We are moderating: {chans}. We have masters: {masters}.'.format(
+            chans=channels_str, masters=masters_str))
+
+
+def new_global_state(config_file):
     gs = {
         'threads': {
-            'watch_chans': {},
-            'watch_serv': None,
-            'watch_priv': None,
-            'watch_comm': None,
+            'file_follower': None,
             'chan_ops': {},
             'command_listener': None,
             'ii_watchdog': None,
             'op_actions': {},
             'out_message': None,
-            'log_to_masters': None,
             'heart': None,
+            'shard_links': {},
+            'metrics': None,
+        },
+        'watches': {
+            'chans': {},
+            'serv': None,
+            'priv': None,
+            'comm': None,
+            'log_to_masters': None,
         },
         'events': {
             'kill_command_listener': Event(),
@@ -158,20 +394,28 @@ def main():
             'kill_iiwatchdog': Event(),
             'kill_outmessage': Event(),
             'kill_heartbeat': Event(),
-            'kill_logtomasters': Event(),
+            'kill_metrics': Event(),
         },
+        'shards': {},
+        'config_file': config_file,
         'conf': ConfigParser(),
         'log': None,
+        'loop': None,
+        'member_registry': MemberRegistry(),
     }
-
     gs['conf'].read(config_file)
+    return gs
+
+
+def main():
+    gs = new_global_state('config.ini')
+    if gs['conf'].get('general', 'runtime', fallback='threads') == 'asyncio':
+        gs = asyncio.run(run_async(gs))
+        gs['log']('Bye bye :( If you see this, tell my wife I love her')
+        gs['log'].close()
+        return
     gs = create_threads(gs)
-    channels_str = ', '.join(json.loads(gs['conf']['ii']['channels']))
-    masters_str = ', '.join(json.loads(gs['conf']['general']['masters']))
-    gs['log'](
-        'All started and ready to go. I can\'t wait to help! '
-        'We are moderating: {chans}. We have masters: {masters}.'.format(
-            chans=channels_str, masters=masters_str))
+    log_ready(gs)
     try:
         while True:
             time.sleep(300)
@@ -179,6 +423,7 @@ def main():
         pass
     gs = destroy_threads(gs)
     gs['log']('Bye bye :( If you see this, tell my wife I love her')
+    gs['log'].close()
 
 
 if __name__ == '__main__':
@@ -1,66 +1,301 @@
+from collections import deque
+from sys import intern
+from threading import RLock
 from time import time
+from mentiondetector import MentionDetector
+from nickindex import NickIndex
+
+
+def fold(s):
+    ''' Return the key used to index nicks, users, and hosts. IRC treats them
+    case insensitively, so all lookups are done on the casefolded string. '''
+    return s.casefold() if s else s
+
+
+def _intern(s):
+    return intern(s) if s else s
+
+
+def _index_attr(index, m, value):
+    ''' Add m to the set of members in index under the given user/host '''
+    if value:
+        index.setdefault(intern(fold(value)), set()).add(m)
+
+
+def _unindex_attr(index, m, value):
+    ''' Remove m from the set of members in index under the given
+    user/host, forgetting about the user/host entirely if it was the last '''
+    if not value:
+        return
+    key = fold(value)
+    ms = index.get(key)
+    if ms is None:
+        return
+    ms.discard(m)
+    if not ms:
+        del index[key]
 
 
 class Member:
-    def __init__(self, nick, user=None, host=None):
-        self.nick = nick
-        self.user = user
-        self.host = host
+    __slots__ = ('nick', 'user', 'host', '_lists', '_registry')
+
+    def __init__(self, nick, user=None, host=None, registry=None):
+        self.nick = _intern(nick)
+        self.user = _intern(user)
+        self.host = _intern(host)
+        # The MemberLists this member is in. They are told when the nick,
+        # user, or host changes so they can keep their indexes up to date.
+        self._lists = []
+        # The MemberRegistry that owns this member, if any
+        self._registry = registry
 
     def __str__(self):
         return '{}!{}@{}'.format(self.nick, self.user, self.host)
 
+    def __reduce__(self):
+        # Sent to another process as a copy that isn't in any list
+        return (Member, (self.nick, self.user, self.host))
+
+    @property
+    def channels(self):
+        ''' The names of the channels this member is in '''
+        return set(ml.name for ml in self._lists if ml.name is not None)
+
     def set(self, nick=None, user=None, host=None):
-        if nick:
+        if self._registry is None:
+            return self._set(nick, user, host)
+        with self._registry.lock:
+            return self._set(nick, user, host)
+
+    def _set(self, nick, user, host):
+        if nick and nick != self.nick:
             self._set_nick(nick)
-        if user:
+        if user and user != self.user:
             self._set_user(user)
-        if host:
+        if host and host != self.host:
             self._set_host(host)
 
     def _set_nick(self, nick):
-        self.nick = nick
+        old = self.nick
+        self.nick = _intern(nick)
+        if self._registry is not None:
+            self._registry._reindex(self, 'nick', old)
+        for ml in self._lists:
+            ml._reindex(self, 'nick', old)
 
     def _set_user(self, user):
-        self.user = user
+        old = self.user
+        self.user = _intern(user)
+        if self._registry is not None:
+            self._registry._reindex(self, 'user', old)
+        for ml in self._lists:
+            ml._reindex(self, 'user', old)
 
     def _set_host(self, host):
-        self.host = host
+        old = self.host
+        self.host = _intern(host)
+        if self._registry is not None:
+            self._registry._reindex(self, 'host', old)
+        for ml in self._lists:
+            ml._reindex(self, 'host', old)
+
+
+class MemberRegistry:
+    ''' The one place in the process where a Member lives.
+
+    Nicks are unique on the network, so when the same person is in many of
+    our channels there is no reason to remember them once per channel. Every
+    MemberList gets its Members from here and just holds references to them.
+    A Member is forgotten once the last MemberList lets go of it.
+
+    Since every Member knows the MemberLists (and thus channels) it is in,
+    the registry doubles as the cross-channel index used to answer questions
+    like "which channels is this nick in" and "who else shares this host"
+    without asking every channel. It also keeps a NickIndex of every
+    (casefolded) nick for wildcard matching.
+
+    Changing a Member, or which MemberLists it is in, holds this registry's
+    lock, since the lists are owned by different ChanOpThreads but share
+    Members. Each MemberList also has its own lock for its indexes, taken
+    after the registry's, so looking things up in one channel (like the
+    mentions in every message) doesn't wait on the others. '''
+    def __init__(self):
+        self.lock = RLock()
+        self._by_nick = {}
+        self._by_user = {}
+        self._by_host = {}
+        self._nick_index = NickIndex()
+
+    def __len__(self):
+        return len(self._by_nick)
+
+    def __getitem__(self, nick):
+        return self._by_nick.get(fold(nick))
+
+    def find(self, nick):
+        ''' Return the Member with the given nick if they are in any of our
+        channels, otherwise None '''
+        with self.lock:
+            m = self._by_nick.get(fold(nick))
+            return m if m is not None and m._lists else None
+
+    def channels(self, nick):
+        ''' Return the set of channel names the given nick is in '''
+        with self.lock:
+            m = self._by_nick.get(fold(nick))
+            return m.channels if m is not None else set()
+
+    def matches(self, user=None, host=None):
+        ''' Find everybody with the given user and/or host in any of our
+        channels. Returns a dictionary with keys 'user' and 'host'. The values
+        are dictionaries mapping nicks to the set of channels that nick is
+        in. '''
+        assert user is not None or host is not None
+        matches = {'user': {}, 'host': {}}
+        with self.lock:
+            if user:
+                for m in self._by_user.get(fold(user), ()):
+                    matches['user'][m.nick] = m.channels
+            if host:
+                for m in self._by_host.get(fold(host), ()):
+                    matches['host'][m.nick] = m.channels
+        return matches
+
+    def wildcard(self, partial, star_front, star_back, limit=None):
+        ''' Find nicks in any of our channels that end with (star_front),
+        start with (star_back), or contain (both) partial, case insensitively.
+        Returns the number of matching nicks and a dictionary mapping the
+        first limit of them (casefolded, in sorted order) to the set of
+        channels they are in. '''
+        assert star_front or star_back
+        partial = fold(partial)
+        ni = self._nick_index
+        with self.lock:
+            if star_front and star_back:
+                count, nicks = ni.substring(partial, limit)
+            elif star_front:
+                count, nicks = ni.suffix(partial, limit)
+            else:
+                count, nicks = ni.prefix(partial, limit)
+            return count, {n: self._by_nick[n].channels for n in nicks}
+
+    def acquire(self, nick, user=None, host=None):
+        ''' Return the Member with the given nick, creating it if needed.
+        A given user and/or host replaces what we knew before. '''
+        with self.lock:
+            m = self._by_nick.get(fold(nick))
+            if m is None:
+                m = Member(nick, user, host, registry=self)
+                self._by_nick[_intern(fold(nick))] = m
+                self._nick_index.add(fold(nick))
+                _index_attr(self._by_user, m, m.user)
+                _index_attr(self._by_host, m, m.host)
+            else:
+                m._set(None, user, host)
+            return m
+
+    def release(self, m):
+        ''' Forget about the given Member if no MemberList holds it anymore '''
+        with self.lock:
+            if m._lists:
+                return
+            key = fold(m.nick)
+            if self._by_nick.get(key) is m:
+                del self._by_nick[key]
+                self._nick_index.remove(key)
+            _unindex_attr(self._by_user, m, m.user)
+            _unindex_attr(self._by_host, m, m.host)
+
+    def _reindex(self, m, attr, old):
+        if attr == 'nick':
+            key = fold(old)
+            if self._by_nick.get(key) is m:
+                del self._by_nick[key]
+                self._nick_index.remove(key)
+            stale = self._by_nick.get(fold(m.nick))
+            if stale is not None and stale is not m:
+                self._evict(stale)
+            self._by_nick[_intern(fold(m.nick))] = m
+            self._nick_index.add(fold(m.nick))
+            return
+        index = self._by_user if attr == 'user' else self._by_host
+        _unindex_attr(index, m, old)
+        _index_attr(index, m, getattr(m, attr))
+
+    def _evict(self, m):
+        ''' Somebody else now has m's nick, so whoever m was left (or changed
+        nick) without us noticing. Take m out of every MemberList and forget
+        about them. '''
+        for ml in list(m._lists):
+            ml._evict(m)
+        self.release(m)
 
 
 class MemberList:
-    def __init__(self, recent_until=10.00):
-        self._members = set()
-        self._recent = []
+    ''' The members of a channel, indexed by casefolded nick, user, and host
+    so that lookups don't have to scan every member.
+
+    Nicks are unique, so the nick index maps straight to a Member. Many
+    members can share a user or host, so those indexes map to sets of
+    Members. The Members themselves come from (and are shared through) a
+    MemberRegistry.
+
+    name is the channel this is the member list of. '''
+    def __init__(self, registry=None, name=None, recent_until=10.00):
+        self.name = name
+        self._registry = registry if registry is not None \
+            else MemberRegistry()
+        # Taken after the registry's lock, never before it
+        self._lock = RLock()
+        self._by_nick = {}
+        self._by_user = {}
+        self._by_host = {}
+        self._mentions = MentionDetector()
+        self._recent = deque()
         self._recent_until = recent_until
 
     def __len__(self):
-        return len(self._members)
+        return len(self._by_nick)
 
     def __iter__(self):
-        return self._members.__iter__()
+        return iter(list(self._by_nick.values()))
 
     def add(self, nick, user=None, host=None):
-        if not self.contains(nick=nick):
-            m = Member(nick, user, host)
-            self._members.add(m)
-            self._recent.append((time(), m))
-        else:
-            member = self.__getitem__(nick)
-            member.set(user=user, host=host)
-        self._trim_recent()
+        with self._registry.lock, self._lock:
+            m = self._by_nick.get(fold(nick))
+            if m is None:
+                m = self._registry.acquire(nick, user, host)
+                self._index(m)
+                m._lists.append(self)
+                self._recent.append((time(), m))
+            else:
+                m._set(None, user, host)
+            self._trim_recent()
 
     def remove(self, nick):
-        member = self.__getitem__(nick)
-        if not member:
-            return
-        self._members.discard(member)
-        self._recent = [(at, m) for at, m in self._recent if m.nick != nick]
-        self._trim_recent()
+        with self._registry.lock, self._lock:
+            m = self._by_nick.get(fold(nick))
+            if m is None:
+                return
+            self._unindex(m)
+            m._lists.remove(self)
+            self._registry.release(m)
+            self._trim_recent()
 
     def discard(self, nick):
         return self.remove(nick)
 
+    def clear(self):
+        with self._registry.lock, self._lock:
+            for m in list(self._by_nick.values()):
+                m._lists.remove(self)
+                self._registry.release(m)
+            self._by_nick.clear()
+            self._by_user.clear()
+            self._by_host.clear()
+            self._mentions = MentionDetector()
+            self._recent.clear()
+
     def contains(self, nick=None, user=None, host=None):
         assert nick is not None or user is not None or host is not None
 
@@ -97,56 +332,86 @@ class MemberList:
         return m if m else False
 
     def _contains_user(self, user):
-        user = user.lower()
-        for m in self:
-            if m.user.lower() == user:
-                return m
-        return False
+        with self._lock:
+            ms = self._by_user.get(fold(user))
+            return next(iter(ms)) if ms else False
 
     def _contains_host(self, host):
-        host = host.lower()
-        for m in self:
-            if m.host.lower() == host:
-                return m
-        return False
+        with self._lock:
+            ms = self._by_host.get(fold(host))
+            return next(iter(ms)) if ms else False
 
     def __getitem__(self, nick):
-        nick = nick.lower()
-        for m in self:
-            if m.nick.lower() == nick:
-                return m
-        return None
+        return self._by_nick.get(fold(nick))
+
+    def mentioned_nicks(self, text):
+        ''' Return the set of (casefolded) nicks in this list that text
+        mentions. See MentionDetector. '''
+        with self._lock:
+            return self._mentions.find(text)
 
     def matches(self, user=None, host=None):
         assert user is not None or host is not None
         matching_users = []
         matching_hosts = []
-        if user:
-            user = user.lower()
-        if host:
-            host = host.lower()
-        for m in self:
-            if user and m.user.lower() == user:
-                matching_users.append(m)
-            if host and m.host.lower() == host:
-                matching_hosts.append(m)
+        with self._lock:
+            if user:
+                matching_users = list(self._by_user.get(fold(user), ()))
+            if host:
+                matching_hosts = list(self._by_host.get(fold(host), ()))
         if user and host:
             return matching_users, matching_hosts
         if user:
             return matching_users
         return matching_hosts
 
+    def _index(self, m):
+        self._by_nick[intern(fold(m.nick))] = m
+        self._mentions.add(fold(m.nick))
+        _index_attr(self._by_user, m, m.user)
+        _index_attr(self._by_host, m, m.host)
+
+    def _unindex(self, m):
+        key = fold(m.nick)
+        if self._by_nick.get(key) is m:
+            del self._by_nick[key]
+            self._mentions.remove(key)
+        _unindex_attr(self._by_user, m, m.user)
+        _unindex_attr(self._by_host, m, m.host)
+
+    def _reindex(self, m, attr, old):
+        ''' Called by a Member in this list when its nick, user, or host
+        changes from old to whatever it is now '''
+        with self._lock:
+            if attr == 'nick':
+                key = fold(old)
+                if self._by_nick.get(key) is m:
+                    del self._by_nick[key]
+                    self._mentions.remove(key)
+                self._by_nick[intern(fold(m.nick))] = m
+                self._mentions.add(fold(m.nick))
+                return
+            index = self._by_user if attr == 'user' else self._by_host
+            _unindex_attr(index, m, old)
+            _index_attr(index, m, getattr(m, attr))
+
+    def _evict(self, m):
+        ''' Called by the registry to take a stale Member out of this list '''
+        with self._lock:
+            self._unindex(m)
+            m._lists.remove(self)
+
     def _trim_recent(self):
-        new_recent = []
-        now = time()
-        for at, m in self._recent:
-            if at + self._recent_until >= now:
-                new_recent.append((at, m))
-        self._recent = new_recent
+        recent = self._recent
+        oldest = time() - self._recent_until
+        while recent and recent[0][0] < oldest:
+            recent.popleft()
 
     def get_joined_since(self, t):
         members = set()
-        for at, m in self._recent:
-            if at >= t:
-                members.add(m)
+        with self._lock:
+            for at, m in self._recent:
+                # Skip members that have since left
+                if at >= t and self in m._lists:
+                    members.add(m)
         return members
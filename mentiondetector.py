@@ -0,0 +1,98 @@
+# Characters that can't be in a nick, so they end any nick before them. Being
+# mentioned as "@nick", "nick:", "nick," or "nick!?" still counts.
+SEPARATORS = frozenset(' \t:,!?@+')
+
+# The key in a trie node that, if present, holds the nick ending there. No
+# real character is the empty string.
+_END = ''
+
+
+class MentionDetector:
+    ''' Finds which of a set of nicks are mentioned in a message, in one pass
+    over the message.
+
+    Nicks are kept in a trie that is updated incrementally with add() and
+    remove() as people join, leave, and change nicks, so there is nothing to
+    rebuild. Since nicks can't contain any of the SEPARATORS, a mention must
+    start right after one of them (or at the start of the message) and end
+    right before one (or at the end). So find() only needs to walk the trie
+    from the start of each word, and gives up on a word at the first
+    character that no nick continues with. Each character of the message is
+    looked at (at most) once.
+
+    Nicks are stored as given, so the caller should casefold them first.
+    Messages are casefolded by find(). '''
+    def __init__(self):
+        self._root = {}
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, nick):
+        node = self._root
+        for c in nick:
+            node = node.get(c)
+            if node is None:
+                return False
+        return _END in node
+
+    def add(self, nick):
+        node = self._root
+        for c in nick:
+            nxt = node.get(c)
+            if nxt is None:
+                nxt = node[c] = {}
+            node = nxt
+        if _END not in node:
+            self._len += 1
+        node[_END] = nick
+
+    def remove(self, nick):
+        # Remember the path so branches that no longer lead to any nick can
+        # be pruned on the way back up
+        path = []
+        node = self._root
+        for c in nick:
+            nxt = node.get(c)
+            if nxt is None:
+                return
+            path.append((node, c))
+            node = nxt
+        if _END not in node:
+            return
+        del node[_END]
+        self._len -= 1
+        for parent, c in reversed(path):
+            if parent[c]:
+                break
+            del parent[c]
+
+    def find(self, text):
+        ''' Return the set of nicks mentioned in text '''
+        found = set()
+        if not self._root:
+            return found
+        text = text.casefold()
+        root, seps = self._root, SEPARATORS
+        i, n = 0, len(text)
+        while i < n:
+            if text[i] in seps:
+                i += 1
+                continue
+            # The start of a word. Walk the trie as far as the word goes.
+            node = root
+            while i < n and text[i] not in seps:
+                node = node.get(text[i])
+                i += 1
+                if node is None:
+                    break
+            if node is None:
+                # Not a nick. Skip the rest of the word.
+                while i < n and text[i] not in seps:
+                    i += 1
+                continue
+            nick = node.get(_END)
+            if nick is not None:
+                found.add(nick)
+        return found
@@ -0,0 +1,224 @@
+import asyncio
+import os
+from latency import latencies
+from pbthread import PBThread
+from pbtimer import timer_service
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+class _Metrics:
+    ''' Builds a snapshot in the Prometheus text exposition format '''
+    def __init__(self, prefix, labels=None):
+        self._prefix = prefix
+        self._labels = labels or {}
+        # name -> (type, help, [(labels, value)])
+        self._families = {}
+
+    def add(self, name, kind, help_, value, suffix='', **labels):
+        ''' Add a sample to the family name. A summary's _sum and _count
+        samples are added to it with the suffix. '''
+        family = self._families.setdefault(
+            self._prefix + name, (kind, help_, []))
+        family[2].append((suffix, labels, value))
+
+    def text(self):
+        lines = []
+        for name, (kind, help_, samples) in self._families.items():
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                labels = dict(self._labels, **labels)
+                if labels:
+                    name_labels = '{}{}{{{}}}'.format(name, suffix, ','.join(
+                        '{}="{}"'.format(k, _escape(v))
+                        for k, v in sorted(labels.items())))
+                else:
+                    name_labels = name + suffix
+                lines.append('{} {}'.format(name_labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsThread(PBThread):
+    ''' Every interval seconds, writes a snapshot of what the threads in this
+    process are up to, in the Prometheus text format, to a file. Point the
+    node_exporter textfile collector at the file's directory (or anything
+    else that can read it) to graph them.
+
+    Configured in the [metrics] section. Shard worker processes each write
+    their own file, with the shard number added to its name and to every
+    metric as a label. '''
+    def __init__(self, global_state, fname, shard=None):
+        PBThread.__init__(self, self._enter, name='Metrics')
+        self._fname = fname
+        self._shard = shard
+        self.update_global_state(global_state)
+
+    def update_global_state(self, gs):
+        self._log = gs['log']
+        self._threads = gs['threads']
+        self._watches = gs['watches']
+        self._interval = gs['conf'].getfloat(
+            'metrics', 'interval', fallback=15)
+        self._end_event = gs['events']['kill_metrics']
+
+    def _enter(self):
+        log = self._log
+        log.info('Started MetricsThread instance writing to', self._fname)
+        while not self._end_event.wait(self._interval):
+            self._write()
+        self._shutdown()
+
+    async def _enter_async(self):
+        log = self._log
+        log.info('Started MetricsThread instance writing to', self._fname)
+        try:
+            while True:
+                await asyncio.sleep(self._interval)
+                self._write()
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        self._write()
+        self._log.info('MetricsThread going away')
+
+    def _write(self):
+        try:
+            text = self.snapshot()
+        except Exception as e:
+            self._log.warn('Could not take a metrics snapshot:', e)
+            return
+        # Write a new file and move it into place, so readers never see half
+        # of one
+        tmp = self._fname + '.tmp'
+        try:
+            with open(tmp, 'wt') as fd:
+                fd.write(text)
+            os.replace(tmp, self._fname)
+        except OSError as e:
+            self._log.warn('Could not write metrics to', self._fname, e)
+
+    def _local(self, t):
+        ''' The thread(s) in self._threads[t] that live in this process '''
+        threads = self._threads.get(t)
+        if threads is None:
+            return {}
+        if not isinstance(threads, dict):
+            threads = {None: threads}
+        return {k: v for k, v in threads.items() if isinstance(v, PBThread)}
+
+    def snapshot(self):
+        ''' Return the current metrics as Prometheus text '''
+        m = _Metrics('tormodbot_', labels=None if self._shard is None
+                     else {'shard': self._shard})
+        self._add_events(m)
+        self._add_channels(m)
+        self._add_outbound(m)
+        for cl in self._local('command_listener').values():
+            m.add('queue_depth', 'gauge',
+                  'Events or actions waiting to be processed',
+                  cl.queue_size(), queue='command_listener')
+        self._add_watches(m)
+        self._add_latencies(m)
+        m.add('timers_pending', 'gauge', 'Timers waiting to fire',
+              len(timer_service()))
+        return m.text()
+
+    def _add_events(self, m):
+        for heart in self._local('heart').values():
+            if heart.forwards_totals:
+                # The main process's HeartbeatThread counts them
+                continue
+            by_channel = heart.totals_by_channel()
+            for channel in sorted(by_channel, key=lambda c: c or ''):
+                for name, total in by_channel[channel].items():
+                    m.add('events_total', 'counter',
+                          'Events counted for the heartbeat', total,
+                          channel=channel or '', event=name)
+
+    def _add_channels(self, m):
+        for channel, chanop in sorted(self._local('chan_ops').items()):
+            m.add('queue_depth', 'gauge',
+                  'Events or actions waiting to be processed',
+                  chanop.queue_size(), queue='chan_ops', channel=channel)
+            m.add('members', 'gauge', 'People in the channel',
+                  len(chanop.members), channel=channel)
+            for detector, n in chanop.detections().items():
+                m.add('detections_total', 'counter',
+                      'Messages caught by each detector', n,
+                      channel=channel, detector=detector)
+            stats = chanop.flood_state_stats()
+            m.add('flood_state_size', 'gauge',
+                  'Speakers with flood state kept', stats['size'],
+                  channel=channel)
+            for name in ['hits', 'misses', 'expired', 'evicted']:
+                m.add('flood_state_{}_total'.format(name), 'counter',
+                      'Flood state table {}'.format(name), stats[name],
+                      channel=channel)
+        for channel, oat in sorted(self._local('op_actions').items()):
+            m.add('queue_depth', 'gauge',
+                  'Events or actions waiting to be processed',
+                  oat.queue_size(), queue='op_actions', channel=channel)
+
+    def _add_outbound(self, m):
+        for omt in self._local('out_message').values():
+            lanes, stats = omt.metrics()
+            for lane, lane_stats in sorted(lanes.items()):
+                m.add('outbound_queued', 'gauge',
+                      'Outbound messages waiting to be sent',
+                      lane_stats['queued'], lane=lane)
+                m.add('outbound_sent_total', 'counter',
+                      'Outbound messages sent', lane_stats['done'],
+                      lane=lane)
+                m.add('outbound_dropped_total', 'counter',
+                      'Outbound messages dropped because the lane was full',
+                      lane_stats['dropped'], lane=lane)
+                m.add('outbound_wait_seconds_total', 'counter',
+                      'Time outbound messages waited to be sent',
+                      lane_stats['wait_seconds'], lane=lane)
+                m.add('outbound_max_wait_seconds', 'gauge',
+                      'Longest time an outbound message waited to be sent',
+                      lane_stats['max_wait_seconds'], lane=lane)
+            m.add('outbound_rate_limited_total', 'counter',
+                  'Times the rate limit made us wait to send',
+                  stats['rate_limited'])
+            m.add('outbound_rate_limit_seconds_total', 'counter',
+                  'Time the rate limit made us wait to send',
+                  stats['rate_limit_seconds'])
+            m.add('fifo_writes_total', 'counter',
+                  'Writes to the server\'s in FIFO', stats['fifo_writes'])
+            m.add('fifo_write_seconds_total', 'counter',
+                  'Time spent writing to the server\'s in FIFO',
+                  stats['fifo_write_seconds'])
+            m.add('chanserv_saved_total', 'counter',
+                  'ChanServ messages not sent because they were duplicates',
+                  stats['chanserv_saved'])
+
+    def _add_latencies(self, m):
+        help_ = 'Seconds lines from ii spent in each stage (see latency.py)'
+        quantiles = [0.5, 0.9, 0.99]
+        for stage, hist in latencies().items():
+            for q, value in zip(quantiles, hist.quantiles(quantiles)):
+                if value is not None:
+                    m.add('latency_seconds', 'summary', help_, value,
+                          stage=stage, quantile=q)
+            m.add('latency_seconds', 'summary', help_, hist.sum,
+                  suffix='_sum', stage=stage)
+            m.add('latency_seconds', 'summary', help_, hist.count,
+                  suffix='_count', stage=stage)
+
+    def _add_watches(self, m):
+        watches = []
+        for w in self._watches.values():
+            if isinstance(w, dict):
+                watches.extend(w.values())
+            elif w is not None:
+                watches.append(w)
+        for w in watches:
+            m.add('lines_read_total', 'counter',
+                  'Lines read from a followed file', w.lines_read(),
+                  source=w.source, file=w.fname)
@@ -0,0 +1,124 @@
+from bisect import bisect_left, insort
+from heapq import nsmallest
+from itertools import islice
+
+# Sorts after every character that can appear in a nick, so every string that
+# starts with some prefix p sorts before p + _MAX_CHAR
+_MAX_CHAR = chr(0x10ffff)
+
+
+class NickIndex:
+    ''' Indexes of nicks for answering "match foo*", "match *foo", and
+    "match *foo*" without looking at every nick.
+
+    - a sorted list of nicks answers prefix queries with a binary search
+    - a sorted list of reversed nicks does the same for suffix queries
+    - a map from every n-gram to the nicks containing it narrows down
+      substring queries to the few nicks that contain all of the query's
+      n-grams
+
+    All three are updated incrementally with add() and remove(). Nicks are
+    stored as given, so the caller should casefold them first if it wants
+    case insensitive matching.
+
+    The query functions all return (count, nicks) where nicks is at most the
+    first limit matching nicks in sorted order (or all of them if limit is
+    None). Counting and picking the first few never builds a list of every
+    match. '''
+    def __init__(self, n=3):
+        self._n = n
+        self._nicks = []
+        self._reversed = []
+        self._grams = {}
+        # nicks too short to have any n-grams
+        self._short = set()
+
+    def __len__(self):
+        return len(self._nicks)
+
+    def __contains__(self, nick):
+        i = bisect_left(self._nicks, nick)
+        return i < len(self._nicks) and self._nicks[i] == nick
+
+    def _ngrams(self, s):
+        n = self._n
+        return set(s[i:i+n] for i in range(len(s) - n + 1))
+
+    def add(self, nick):
+        if nick in self:
+            return
+        insort(self._nicks, nick)
+        insort(self._reversed, nick[::-1])
+        grams = self._ngrams(nick)
+        if not grams:
+            self._short.add(nick)
+        for g in grams:
+            self._grams.setdefault(g, set()).add(nick)
+
+    def remove(self, nick):
+        i = bisect_left(self._nicks, nick)
+        if i >= len(self._nicks) or self._nicks[i] != nick:
+            return
+        del self._nicks[i]
+        rev = nick[::-1]
+        del self._reversed[bisect_left(self._reversed, rev)]
+        self._short.discard(nick)
+        for g in self._ngrams(nick):
+            nicks = self._grams[g]
+            nicks.discard(nick)
+            if not nicks:
+                del self._grams[g]
+
+    def _range(self, arr, partial):
+        return bisect_left(arr, partial), \
+            bisect_left(arr, partial + _MAX_CHAR)
+
+    def prefix(self, partial, limit=None):
+        lo, hi = self._range(self._nicks, partial)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return self.count_prefix(partial), self._nicks[lo:hi]
+
+    def count_prefix(self, partial):
+        lo, hi = self._range(self._nicks, partial)
+        return hi - lo
+
+    def suffix(self, partial, limit=None):
+        lo, hi = self._range(self._reversed, partial[::-1])
+        matches = (rev[::-1] for rev in islice(self._reversed, lo, hi))
+        if limit is None:
+            return hi - lo, sorted(matches)
+        return hi - lo, nsmallest(limit, matches)
+
+    def count_suffix(self, partial):
+        lo, hi = self._range(self._reversed, partial[::-1])
+        return hi - lo
+
+    def _substring_candidates(self, partial):
+        grams = self._ngrams(partial)
+        if grams:
+            # Every nick containing partial contains all its n-grams. Start
+            # with the rarest and only check those.
+            postings = sorted(
+                (self._grams.get(g, set()) for g in grams), key=len)
+            return postings[0]
+        # partial is shorter than an n-gram, so it can only be in nicks that
+        # have an n-gram containing it or that are themselves very short
+        candidates = set(n for n in self._short if partial in n)
+        for g, nicks in self._grams.items():
+            if partial in g:
+                candidates.update(nicks)
+        return candidates
+
+    def _substring_matches(self, partial):
+        return (n for n in self._substring_candidates(partial)
+                if partial in n)
+
+    def substring(self, partial, limit=None):
+        count = self.count_substring(partial)
+        if limit is None:
+            return count, sorted(self._substring_matches(partial))
+        return count, nsmallest(limit, self._substring_matches(partial))
+
+    def count_substring(self, partial):
+        return sum(1 for _ in self._substring_matches(partial))
@@ -1,18 +1,24 @@
-from queue import Empty, Queue
+import asyncio
+from queue import Empty
 from random import randint
-from time import sleep, time
-from threading import Event, Timer
+from time import monotonic, sleep, time
+from latency import latencies, stage_started, tracing
+from operatorbatch import OperatorBatch
+from pbasync import new_event, new_queue
 from pbthread import PBThread
+from pbtimer import fire_one_off_event
 
 
 class OperatorActionThread(PBThread):
     def __init__(self, global_state, channel_name):
         PBThread.__init__(self, self._enter,
                           name='OperatorAction-{}'.format(channel_name))
-        self._is_op = Event()
-        self._waiting_actions = Queue(100)
+        self._is_op = new_event(global_state)
+        self._waiting_actions = new_queue(global_state, 100)
+        self._batch = OperatorBatch()
         self._unmute_timer = None
-        self._last_mute = 0.1
+        # When we first asked to be opped, if we are waiting to be
+        self._op_asked_at = None
         self._channel_name = channel_name
         self.update_global_state(global_state)
 
@@ -22,6 +28,15 @@ class OperatorActionThread(PBThread):
         self._end_event = gs['events']['kill_opactions']
         self._out_msg = gs['threads']['out_message']
         self._heart_thread = gs['threads']['heart']
+        # Mode changes and kicks asked for while others are waiting, or
+        # within coalesce_gap seconds of the last one, are sent together (see
+        # OperatorBatch), for at most coalesce_seconds
+        self._coalesce_seconds = self._conf.getfloat(
+            'op_actions', 'coalesce_seconds', fallback=0.5)
+        self._coalesce_gap = self._conf.getfloat(
+            'op_actions', 'coalesce_gap', fallback=0.05)
+        self._batch.kick_targets = self._conf.getint(
+            'op_actions', 'kick_targets', fallback=4)
 
     def _enter(self):
         log = self._log
@@ -37,7 +52,7 @@ class OperatorActionThread(PBThread):
                 break
             item = None
             count_empty, max_empty = 0, randint(120, 180)
-            log.debug('waiting {}s for an action'.format(max_empty))
+            log.debugf('waiting {}s for an action', max_empty)
             while count_empty < max_empty and \
                     not self._end_event.is_set():
                 try:
@@ -51,76 +66,204 @@ class OperatorActionThread(PBThread):
             if not item:
                 log.debug('no item')
                 if self._is_op.is_set():
-                    log.debug('Asking to be deopped')
-                    self._out_msg.add(
-                        self._out_msg.privmsg,
-                        ['chanserv', 'deop {} TorModBot'.format(channel_name)],
-                        {'log_it': True})
+                    self._ask_to_be_deopped()
                     sleep(1.0)
                 continue
-            args, kwargs = item
-            # log.debug('item: {} {}'.format(args, kwargs))
-            self._out_msg.add(*args, **kwargs)
+            items = [item]
+            give_up_at = time() + self._coalesce_seconds
+            while not self._end_event.is_set():
+                timeout = self._coalesce_timeout(items, give_up_at)
+                try:
+                    if timeout is None:
+                        break
+                    elif timeout > 0:
+                        item = self._waiting_actions.get(timeout=timeout)
+                    else:
+                        item = self._waiting_actions.get_nowait()
+                except Empty:
+                    break
+                items.append(item)
+            self._do_items(items)
         self._shutdown()
 
+    async def _enter_async(self):
+        log = self._log
+        log.info('Started OperatorActionThread instance')
+        log.debug('Asking to be deopped')
+        channel_name = self._channel_name
+        self._out_msg.add(self._out_msg.privmsg,
+                          ['chanserv', 'deop {} TorModBot'.format(channel_name)])
+        try:
+            while True:
+                await self._is_op.wait()
+                max_empty = randint(120, 180)
+                log.debugf('waiting {}s for an action', max_empty)
+                try:
+                    item = await self._waiting_actions.get(timeout=max_empty)
+                except Empty:
+                    log.debug('no item')
+                    if self._is_op.is_set():
+                        self._ask_to_be_deopped()
+                        await asyncio.sleep(1.0)
+                    continue
+                items = [item]
+                give_up_at = time() + self._coalesce_seconds
+                while True:
+                    timeout = self._coalesce_timeout(items, give_up_at)
+                    try:
+                        if timeout is None:
+                            break
+                        elif timeout > 0:
+                            item = await self._waiting_actions.get(
+                                timeout=timeout)
+                        else:
+                            item = self._waiting_actions.get_nowait()
+                    except Empty:
+                        break
+                    items.append(item)
+                self._do_items(items)
+        finally:
+            self._shutdown()
+
+    def _coalesce_timeout(self, items, give_up_at):
+        ''' How long to wait for another action to send along with items: 0
+        to only take one that is already waiting, or None to send them now.
+        A lone action is sent right away. Only while more keep coming do we
+        wait a little for the next one, until give_up_at. '''
+        if len(items) >= 100:
+            return None
+        if len(items) == 1:
+            return 0
+        remaining = give_up_at - time()
+        if remaining <= 0:
+            return None
+        return min(self._coalesce_gap, remaining)
+
+    def _ask_to_be_deopped(self):
+        log = self._log
+        log.debug('Asking to be deopped')
+        self._out_msg.add(
+            self._out_msg.privmsg,
+            ['chanserv', 'deop {} TorModBot'.format(self._channel_name)],
+            {'log_it': True})
+
+    def _do_items(self, items):
+        ''' Do the actions that were waiting, sending mode changes and kicks
+        together as a batch. Other actions are done in the order they came,
+        so the batch so far is sent before each of them.
+
+        Each item comes with the Trace of the line that led to it, if any.
+        The batch is followed with the oldest of its items' Traces. '''
+        batch = self._batch
+        batch_traces = []
+        for item, trace in items:
+            if trace is not None:
+                trace = trace.stage_done('op_queue')
+            if item[0] == 'mode':
+                batch.add_mode(item[1])
+            elif item[0] == 'kick':
+                batch.add_kick(item[1], item[2])
+            else:
+                self._send_batch(batch_traces)
+                batch_traces = []
+                args, kwargs = item[1:]
+                with tracing(trace):
+                    self._out_msg.add(*args, **kwargs)
+                continue
+            if trace is not None:
+                batch_traces.append(trace)
+        self._send_batch(batch_traces)
+
+    def _send_batch(self, traces):
+        batch = self._batch
+        if not len(batch):
+            return
+        trace = min(traces, key=lambda t: t.received_at, default=None)
+        requests = len(batch)
+        commands = batch.commands(self._channel_name)
+        if len(commands) < requests:
+            self._log.info(
+                'Sending', len(commands), 'command(s) for', requests,
+                'mode changes and kicks in', self._channel_name)
+        out_msg = self._out_msg
+        with tracing(trace):
+            for command in commands:
+                out_msg.add(out_msg.servmsg, [command], {'log_it': True},
+                            lane='moderation')
+
+    def queue_size(self):
+        ''' How many actions are waiting for us to do them '''
+        return self._waiting_actions.qsize()
+
     def _shutdown(self):
         log = self._log
         log.info('OperatorActionThread going away')
 
-    def recv_action(self, *args, **kwargs):
-        ''' Call from other threads. '''
+    def _queue(self, item):
+        trace = stage_started()
         if not self._is_op.is_set():
             log = self._log
             log.debug('Asking to be opped in channel', self._channel_name)
-            self._out_msg.add(
-                self._out_msg.privmsg,
-                ['chanserv', 'op {} TorModBot'.format(self._channel_name)],
-                {'log_it': True})
-        self._waiting_actions.put((args, kwargs))
+            if self._op_asked_at is None:
+                self._op_asked_at = monotonic()
+            # Not followed, so the line's total includes the wait to be
+            # opped: only the actions themselves finish it
+            with tracing(None):
+                self._out_msg.add(
+                    self._out_msg.privmsg,
+                    ['chanserv', 'op {} TorModBot'.format(self._channel_name)],
+                    {'log_it': True}, lane='moderation')
+        self._waiting_actions.put((item, trace))
 
-    def temporary_mute(self, enabled=True):
+    def recv_action(self, *args, **kwargs):
         ''' Call from other threads. '''
+        self._queue(('action', args, kwargs))
+
+    def temporary_mute(self, enabled=True):
+        ''' Call from other threads. If the channel is already muted, the
+        mute is extended instead, so it lasts until things have been quiet
+        for a while. '''
         log = self._log
-        if enabled and self._last_mute + 5 < time():
+        if enabled:
+            unmute_in = randint(120, 300)
+            timer = self._unmute_timer
+            if timer is not None and timer.reschedule(unmute_in):
+                log.debug('Still muted. Unmuting in', unmute_in, 'seconds')
+                return
             log.info('Muting channel')
-            self._last_mute = time()
             self.set_chan_mode('+RM', 'temporary mute')
             log.info('Starting an unmute timer')
-            self._unmute_timer = Timer(
-                randint(120, 300),
-                self.temporary_mute,
-                kwargs={'enabled': False}).start()
-        elif not enabled:
+            self._unmute_timer = fire_one_off_event(
+                unmute_in, self.temporary_mute, kwargs={'enabled': False},
+                name='unmute {}'.format(self._channel_name))
+        else:
             log.info('Unmute timer done. Unmuting')
             self.set_chan_mode('-RM', 'end of temporary mute')
 
     def set_chan_mode(self, mode_str, reason):
         ''' Call from other threads. '''
         log = self._log
-        out_msg = self._out_msg
         log.notice(
             'Setting channel mode', mode_str, 'on', self._channel_name,
             'because', reason)
-        self._heart_thread.event_set_mode()
-        msg = '/mode {} {}'.format(self._channel_name, mode_str)
-        self.recv_action(out_msg.add,
-                         [out_msg.servmsg, [msg], {'log_it': True}])
+        self._heart_thread.event_set_mode(channel=self._channel_name)
+        self._queue(('mode', mode_str))
 
     def kick_nick(self, nick, reason):
         ''' Call from other threads. '''
         log = self._log
-        out_msg = self._out_msg
         log.notice(
             'Kicking', nick, 'from', self._channel_name, 'because', reason)
-        self._heart_thread.event_kick()
-        msg = '/kick {} {} :{}'.format(self._channel_name, nick, reason)
-        self.recv_action(out_msg.add,
-                         [out_msg.servmsg, [msg], {'log_it': True}])
+        self._heart_thread.event_kick(channel=self._channel_name)
+        self._queue(('kick', nick, reason))
 
     def set_opped(self, opped):
         log = self._log
         if opped:
             self._is_op.set()
+            asked_at, self._op_asked_at = self._op_asked_at, None
+            if asked_at is not None:
+                latencies().record('op_wait', monotonic() - asked_at)
         else:
             self._is_op.clear()
         log.info('We have been {}'.format("opped" if opped else "deopped"))
@@ -0,0 +1,85 @@
+import re
+from collections import OrderedDict
+
+# A mode string made up only of modes that don't take a parameter, like '+RM'
+# or '+R-M'. Anything else (like '+b *!*@host') is sent as it was given.
+_FLAG_MODES = re.compile(r'^([+-][A-Za-z]+)+$')
+
+
+class OperatorBatch:
+    ''' Collects the channel mode changes and kicks an OperatorActionThread
+    is asked to do within a short window, so that they can be sent as a few
+    combined commands instead of one per request.
+
+    Mode changes that don't take a parameter are merged into one MODE. When
+    the same mode is both set and unset, the later request wins and the
+    earlier one is dropped, so "+RM" followed by "-M" becomes "+R-M".
+
+    Kicks with the same reason are merged into KICKs of up to kick_targets
+    nicks each, which should be no more than the server's TARGMAX for KICK.
+    It can be changed at any time. A nick is only kicked once per batch. '''
+    def __init__(self, kick_targets=4):
+        self.kick_targets = kick_targets
+        # mode letter -> '+' or '-'
+        self._modes = OrderedDict()
+        # mode strings that couldn't be merged, in the order they came
+        self._other_modes = []
+        # reason -> nicks to kick for it
+        self._kicks = OrderedDict()
+        self._kicked = set()
+        self._requests = 0
+        # How many fewer commands were sent than were asked for
+        self.saved = 0
+
+    def __len__(self):
+        return self._requests
+
+    def add_mode(self, mode_str):
+        self._requests += 1
+        if not _FLAG_MODES.match(mode_str):
+            self._other_modes.append(mode_str)
+            return
+        sign = '+'
+        for c in mode_str:
+            if c in '+-':
+                sign = c
+                continue
+            # Move it to the end so that the merged modes are in the order
+            # they were last asked for
+            self._modes.pop(c, None)
+            self._modes[c] = sign
+
+    def add_kick(self, nick, reason):
+        self._requests += 1
+        if nick in self._kicked:
+            return
+        self._kicked.add(nick)
+        self._kicks.setdefault(reason, []).append(nick)
+
+    def commands(self, channel_name):
+        ''' Return the lines to give to OutboundMessageThread.servmsg() to do
+        everything in this batch, and empty it '''
+        commands = []
+        if self._modes:
+            mode_str = ''
+            last_sign = None
+            for c, sign in self._modes.items():
+                if sign != last_sign:
+                    mode_str += sign
+                    last_sign = sign
+                mode_str += c
+            commands.append('/mode {} {}'.format(channel_name, mode_str))
+        for mode_str in self._other_modes:
+            commands.append('/mode {} {}'.format(channel_name, mode_str))
+        for reason, nicks in self._kicks.items():
+            n = max(1, self.kick_targets)
+            for i in range(0, len(nicks), n):
+                commands.append('/kick {} {} :{}'.format(
+                    channel_name, ','.join(nicks[i:i+n]), reason))
+        self._modes.clear()
+        self._other_modes.clear()
+        self._kicks.clear()
+        self._kicked.clear()
+        self.saved += self._requests - len(commands)
+        self._requests = 0
+        return commands
@@ -1,6 +1,22 @@
 import os
+from time import monotonic
 from pbthread import PBThread
-from actionqueue import ActionQueue
+from actionqueue import ActionQueue, Lane
+from chanservtable import ChanServTable
+from fifowriter import FifoWriter
+from latency import current_trace
+
+# The lanes outbound messages are put in, so that no kind of message can hold
+# up the others for long. Moderation (modes, kicks, and asking to be opped)
+# gets the most turns and jumps ahead of everything else if it ever waits 2s.
+# Relayed log lines get the fewest, but still 1 in 17 when everything is busy.
+LANES = {
+    'moderation': Lane(weight=8, max_depth=500, max_wait=2.0),
+    'chanserv': Lane(weight=4, max_depth=500, max_wait=None),
+    'master': Lane(weight=2, max_depth=200, max_wait=None),
+    'default': Lane(weight=2, max_depth=0, max_wait=None),
+    'log': Lane(weight=1, max_depth=200, max_wait=None),
+}
 
 
 class OutboundMessageThread(PBThread):
@@ -16,21 +32,43 @@ class OutboundMessageThread(PBThread):
     More generally, specify the function you want to call as the first argument
     to add(), any arguments you want to pass to it in as a list, and finally
     any keyword arguments you want to pass to it as a dictionary.
+
+    Give the lane (see LANES) the message belongs in with the lane keyword:
+
+    >>> omt.add(omt.privmsg, ['#logs', 'a log line'], lane='log')
     '''
 
     def __init__(self, global_state,
-                 long_timeout=5, time_between_actions_func=None):
+                 long_timeout=5, time_between_actions_func=None,
+                 server_in=None):
+        ''' server_in, if given, is written to instead of the server's in
+        FIFO. It must have the add(), flush(), and close() methods and the
+        writes and write_seconds attributes of a FifoWriter. '''
         PBThread.__init__(self, self._enter, name='OutboundMessage')
+        self.update_global_state(global_state)
+        # Lines from every action the rate limit lets us do at once are sent
+        # to ii together, after the whole batch
+        if server_in is None:
+            server_in = FifoWriter(
+                os.path.join(self._server_dir, 'in'), self._log)
+        self._server_in = server_in
+        # The latency.Traces of the lines added to self._server_in since it
+        # was last flushed
+        self._traces = []
+        self._chanserv_table = ChanServTable()
         self._action_queue = \
             ActionQueue(long_timeout=long_timeout,
-                        time_between_actions_func=time_between_actions_func)
-        self.update_global_state(global_state)
+                        time_between_actions_func=time_between_actions_func,
+                        loop=global_state.get('loop'),
+                        after_actions_func=self._flush,
+                        lanes=LANES)
 
     def update_global_state(self, gs):
         self._log = gs['log']
         self._conf = gs['conf']
         self._server_dir = os.path.join(
             gs['conf']['ii']['ircdir'], gs['conf']['ii']['server'])
+        self._heart_thread = gs['threads']['heart']
         self._end_event = gs['events']['kill_outmessage']
 
     def _enter(self):
@@ -40,10 +78,38 @@ class OutboundMessageThread(PBThread):
             self._action_queue.loop_once()
         self._shutdown()
 
+    async def _enter_async(self):
+        log = self._log
+        log.info('Started OutboundMessageThread instance')
+        try:
+            while True:
+                await self._action_queue.loop_once_async()
+        finally:
+            self._shutdown()
+
     def _shutdown(self):
         log = self._log
+        self._server_in.close()
+        for lane, stats in sorted(self._action_queue.stats().items()):
+            log.info(
+                'Lane', lane, 'sent', stats['done'], 'dropped',
+                stats['dropped'], 'max wait {:.3f}s'.format(
+                    stats['max_wait_seconds']))
         log.info('OutboundMessageThread going away')
 
+    def metrics(self):
+        ''' Call from any thread. Return the stats of each lane (see
+        ActionQueue.stats()) and a dict of other stats. '''
+        aq = self._action_queue
+        fifo = self._server_in
+        return aq.stats(), {
+            'rate_limited': aq.rate_limited,
+            'rate_limit_seconds': aq.rate_limit_seconds,
+            'fifo_writes': fifo.writes,
+            'fifo_write_seconds': fifo.write_seconds,
+            'chanserv_saved': self._chanserv_table.saved,
+        }
+
     def add(self, *args, **kwargs):
         ''' Use this function to add outbound messages/commands.
 
@@ -72,6 +138,15 @@ class OutboundMessageThread(PBThread):
         '''
         self._action_queue.add(*args, **kwargs)
 
+    def _flush(self):
+        ''' Write what the actions just done buffered, and finish following
+        the lines they were done for '''
+        self._server_in.flush()
+        traces, self._traces = self._traces, []
+        now = monotonic()
+        for trace in traces:
+            trace.done('fifo_write', now)
+
     def servmsg(self, message, log_it=False):
         ''' Do not call this function directly. Pass it as an argument to add()
 
@@ -80,20 +155,10 @@ class OutboundMessageThread(PBThread):
         '''
         if log_it and False:
             self._log.notice('Sending:', message)
-        fname = os.path.join(self._server_dir, 'in')
-        try:
-            with open(fname, 'w') as server_in:
-                while True:
-                    try:
-                        server_in.write('{}\n'.format(message))
-                    except BrokenPipeError as e:
-                        log.warn(e, 'trying again in 0.1s')
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        break
-        except BrokenPipeError as e:
-            self._log.warn(e, 'will not try again')
+        self._server_in.add(message)
+        trace = current_trace()
+        if trace is not None:
+            self._traces.append(trace)
 
     def privmsg(self, nick, message, **kwargs):
         ''' Do not call this function directly. Pass it as an argument to add()
@@ -110,3 +175,31 @@ class OutboundMessageThread(PBThread):
         >>> omt.add(omt.notice, ['#foobar', 'Promise this isnt spam'])
         '''
         self.servmsg('/notice {} {}'.format(target, message), **kwargs)
+
+    def add_chanserv(self, chanserv_list, channel, action, mask, reason,
+                     notice=None):
+        ''' Call from other threads. Queue a ChanServ akick/quiet command,
+        unless the same one is already queued (in which case the reason is
+        added to it) or was recently sent. If given, notice is sent to the
+        channel first, but only if the command is. '''
+        key = (chanserv_list, channel, action, mask)
+        messages = 2 if notice else 1
+        if not self._chanserv_table.add(key, reason, messages=messages):
+            self._log.debug(
+                'Not sending', chanserv_list, action, mask, 'in', channel,
+                'again. Saved', self._chanserv_table.saved, 'messages so far')
+            self._heart_thread.event_chanserv_saved(
+                messages, channel=channel)
+            return
+        if notice:
+            self.add(self.notice, [channel, notice], lane='chanserv')
+        self.add(self._send_chanserv, [key], {'log_it': True}, lane='chanserv')
+
+    def _send_chanserv(self, key, **kwargs):
+        reason = self._chanserv_table.pop(key)
+        if reason is None:
+            return
+        chanserv_list, channel, action, mask = key
+        message = '{l} {c} {a} {m} {r}'.format(
+            l=chanserv_list, c=channel, a=action, m=mask, r=reason)
+        self.privmsg('chanserv', message, **kwargs)
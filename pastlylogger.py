@@ -1,5 +1,32 @@
+import atexit
+from collections import deque
 from datetime import datetime
-from threading import Lock, current_thread
+from threading import Event, Lock, Thread, current_thread
+from time import time
+# Quietest first
+_LEVELS = ['error', 'warn', 'notice', 'info', 'debug']
+class LazyFormat:
+    ''' A log message that is only formatted, with fmt.format(*args,
+    **kwargs), if and when it is written. See PastlyLogger.debugf() '''
+    __slots__ = ['fmt', 'args', 'kwargs']
+    def __init__(self, fmt, args, kwargs):
+        self.fmt, self.args, self.kwargs = fmt, args, kwargs
+    def __str__(self):
+        return self.fmt.format(*self.args, **self.kwargs)
+# Message parts of these types can't change after they are logged, so they
+# can be str()ed later by the writer thread. Anything else is str()ed when
+# it is logged, in the thread that owns it.
+_IMMUTABLE = {str, int, float, bool, bytes, type(None)}
+def _snapshot(value):
+    if type(value) in _IMMUTABLE:
+        return value
+    if type(value) is LazyFormat:
+        return LazyFormat(value.fmt, [_snapshot(_) for _ in value.args],
+            {k: _snapshot(v) for k, v in value.kwargs.items()})
+    try:
+        return str(value)
+    except Exception as e:
+        return 'Could not format message part: {}'.format(e)
 # Logging class inspired by Tor's logging API
 class PastlyLogger:
     # error, warn, etc. are file names to open for logging.
@@ -21,13 +48,33 @@ class PastlyLogger:
     #
     # default tells the logger what level to log at when called with
     # log('foobar') instead of log.info('foobar')
+    #
+    # level is the noisiest level to log at. Messages at noisier levels are
+    # ignored, as cheaply as possible. It can be changed with set_level().
+    # is_enabled() says whether messages at a level go anywhere, and
+    # debugf(), infof(), etc. take a format string and its arguments and only
+    # format them if so.
+    #
+    # async_writes tells the logger to leave formatting and writing messages
+    # to a background thread. Logging a message then only appends it to a
+    # queue, which the thread empties every flush_interval seconds, writing
+    # everything for a file at once. Messages are formatted when written,
+    # not when logged, but parts that could change in between (anything
+    # but str, int, float, bool, bytes, and None) are str()ed when logged.
+    # If buffer_size messages are already waiting, new ones are dropped and
+    # counted in dropped, and the count is logged as a warning. flush() and
+    # close() write everything waiting, and close() is called at exit.
     def __init__(self, error=None, warn=None, notice=None,
         info=None, debug=None, overwrite=[], log_threads=False,
-        default='notice'):
+        default='notice', async_writes=False, buffer_size=10000,
+        flush_interval=0.1, level='debug'):
 
         self.log_threads = log_threads
         assert default in ['debug','info','notice','warn','error']
         self.default_level = default
+        self.dropped = 0
+        self._records = None
+        self._writer = None
 
         # buffering=1 means line-based buffering
         if error:
@@ -66,6 +113,23 @@ class PastlyLogger:
             self.debug_fd = None
             self.debug_fd_mutex = None
 
+        self.set_level(level)
+
+        if async_writes:
+            # (fd, lock, time, level, thread name, message parts)
+            self._records = deque()
+            self._buffer_size = buffer_size
+            self._flush_interval = flush_interval
+            self._dropped_reported = 0
+            # Held while writing records, so they are written in order even
+            # if flush() is called while the writer thread is writing
+            self._write_mutex = Lock()
+            self._stop_writer = Event()
+            self._writer = Thread(target=self._write_records_loop,
+                name='PastlyLogger', daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
         self.debug('Creating PastlyLogger instance')
 
     def __call__(self, *s):
@@ -77,6 +141,7 @@ class PastlyLogger:
 
     def __del__(self):
         self.debug('Deleting PastlyLogger instance')
+        self.close()
         self.flush()
         if self.error_fd: self.error_fd.close()
         if self.warn_fd: self.warn_fd.close()
@@ -101,8 +166,21 @@ class PastlyLogger:
             if not self.debug_fd_mutex.acquire(blocking=False):
                 self.debug_fd_mutex.release()
 
-    def _log_file(fd, lock, log_threads, level, *s):
+    def _log_file(self, fd, lock, level, *s):
         assert fd
+        if not self._enabled[level]:
+            return
+        records = self._records
+        if records is not None:
+            # Appending to a deque is atomic, so no need for a lock
+            if len(records) >= self._buffer_size:
+                self.dropped += 1
+                return
+            records.append((fd, lock, time(), level,
+                current_thread().name if self.log_threads else None,
+                [_snapshot(_) for _ in s]))
+            return
+        log_threads = self.log_threads
         with lock:
             ts = datetime.now()
             try:
@@ -115,7 +193,85 @@ class PastlyLogger:
             except UnicodeDecodeError as e:
                 self.warn(e)
 
+    def _fd_for(self, level):
+        ''' The file (and its lock) messages at level end up in '''
+        for l in _LEVELS[_LEVELS.index(level):]:
+            fd = getattr(self, l + '_fd')
+            if fd: return fd, getattr(self, l + '_fd_mutex')
+        return None, None
+
+    def set_level(self, level):
+        ''' Only log messages at level or quieter from now on. Can be called
+        from any thread. '''
+        assert level in _LEVELS
+        self.level = level
+        self._enabled = {l: _LEVELS.index(l) <= _LEVELS.index(level) and
+            self._fd_for(l)[0] is not None for l in _LEVELS}
+
+    def is_enabled(self, level):
+        ''' Whether messages at level are written anywhere. Use it to avoid
+        working out something only needed for a log message. '''
+        return self._enabled[level]
+
+    def _write_records_loop(self):
+        while not self._stop_writer.wait(self._flush_interval):
+            self._write_records()
+
+    def _write_records(self, records=None):
+        ''' Format and write every record waiting (in records, if given),
+        with one write per file. Returns whether there were any. '''
+        with self._write_mutex:
+            if records is None:
+                records = self._records
+            # fd -> (lock, [lines])
+            batches = {}
+            while records:
+                fd, lock, ts, level, thread, s = records.popleft()
+                try:
+                    line = ' '.join([str(_) for _ in s])
+                except Exception as e:
+                    line = 'Could not format message: {}'.format(e)
+                if thread is not None:
+                    line = '[{}] [{}] [{}] {}\n'.format(
+                        datetime.fromtimestamp(ts), level, thread, line)
+                else:
+                    line = '[{}] [{}] {}\n'.format(
+                        datetime.fromtimestamp(ts), level, line)
+                batches.setdefault(fd, (lock, []))[1].append(line)
+            dropped = self.dropped
+            if dropped != self._dropped_reported:
+                fd, lock = self._fd_for('warn')
+                if fd:
+                    batches.setdefault(fd, (lock, []))[1].append(
+                        '[{}] [warn] Dropped {} log messages ({} in all) '
+                        'because too many were waiting\n'.format(
+                            datetime.now(), dropped - self._dropped_reported,
+                            dropped))
+                self._dropped_reported = dropped
+            for fd, (lock, lines) in batches.items():
+                with lock:
+                    if not fd.closed:
+                        fd.write(''.join(lines))
+            return bool(batches)
+
+    def close(self):
+        ''' Write everything waiting to be written and stop the writer
+        thread, if there is one. Messages logged after this are written
+        right away. '''
+        writer = self._writer
+        if writer is None:
+            return
+        self._writer = None
+        self._stop_writer.set()
+        writer.join()
+        # Stop queueing before writing the last of them, so nothing logged
+        # in the meantime is left behind in the queue
+        records, self._records = self._records, None
+        self._write_records(records)
+        self.flush()
+
     def flush(self):
+        if self._records is not None: self._write_records()
         if self.error_fd: self.error_fd.flush()
         if self.warn_fd: self.warn_fd.flush()
         if self.notice_fd: self.notice_fd.flush()
@@ -123,26 +279,49 @@ class PastlyLogger:
         if self.debug_fd: self.debug_fd.flush()
 
     def debug(self, *s, level='debug'):
-        if self.debug_fd: return PastlyLogger._log_file(
-            self.debug_fd, self.debug_fd_mutex, self.log_threads, level, *s)
+        if self.debug_fd: return self._log_file(
+            self.debug_fd, self.debug_fd_mutex, level, *s)
         return None
 
     def info(self, *s, level='info'):
-        if self.info_fd: return PastlyLogger._log_file(
-            self.info_fd, self.info_fd_mutex, self.log_threads, level, *s)
+        if self.info_fd: return self._log_file(
+            self.info_fd, self.info_fd_mutex, level, *s)
         else: return self.debug(*s, level=level)
 
     def notice(self, *s, level='notice'):
-        if self.notice_fd: return PastlyLogger._log_file(
-            self.notice_fd, self.notice_fd_mutex, self.log_threads, level, *s)
+        if self.notice_fd: return self._log_file(
+            self.notice_fd, self.notice_fd_mutex, level, *s)
         else: return self.info(*s, level=level)
 
     def warn(self, *s, level='warn'):
-        if self.warn_fd: return PastlyLogger._log_file(
-            self.warn_fd, self.warn_fd_mutex, self.log_threads, level, *s)
+        if self.warn_fd: return self._log_file(
+            self.warn_fd, self.warn_fd_mutex, level, *s)
         else: return self.notice(*s, level=level)
 
     def error(self, *s, level='error'):
-        if self.error_fd: return PastlyLogger._log_file(
-            self.error_fd, self.error_fd_mutex, self.log_threads, level, *s)
+        if self.error_fd: return self._log_file(
+            self.error_fd, self.error_fd_mutex, level, *s)
         else: return self.warn(*s, level=level)
+
+    def debugf(self, fmt, *args, **kwargs):
+        ''' Like debug(), but with a format string that is only formatted
+        with args and kwargs if the message is written. With async_writes,
+        that happens in the writer thread. '''
+        if self._enabled['debug']:
+            return self.debug(LazyFormat(fmt, args, kwargs))
+
+    def infof(self, fmt, *args, **kwargs):
+        if self._enabled['info']:
+            return self.info(LazyFormat(fmt, args, kwargs))
+
+    def noticef(self, fmt, *args, **kwargs):
+        if self._enabled['notice']:
+            return self.notice(LazyFormat(fmt, args, kwargs))
+
+    def warnf(self, fmt, *args, **kwargs):
+        if self._enabled['warn']:
+            return self.warn(LazyFormat(fmt, args, kwargs))
+
+    def errorf(self, fmt, *args, **kwargs):
+        if self._enabled['error']:
+            return self.error(LazyFormat(fmt, args, kwargs))
@@ -0,0 +1,149 @@
+import re
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+
+class AhoCorasick:
+    ''' An Aho-Corasick automaton: finds every occurrence of any number of
+    literal strings in one pass over the text.
+
+    The automaton is built once from the given words. search() returns the set
+    of words that appear somewhere in the given text. '''
+    def __init__(self, words):
+        # Node i is described by _goto[i] (char -> next node), _fail[i] (node
+        # to fall back to when no goto matches), and _out[i] (words that end
+        # at this node, including via fail links)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [frozenset()]
+        for w in words:
+            self._add_word(w)
+        self._build_fail_links()
+
+    def _add_word(self, word):
+        node = 0
+        for c in word:
+            nxt = self._goto[node].get(c)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(frozenset())
+                self._goto[node][c] = nxt
+            node = nxt
+        self._out[node] = self._out[node] | {word}
+
+    def _build_fail_links(self):
+        goto, fail, out = self._goto, self._fail, self._out
+        # breadth first, so a node's fail link is always done before its
+        # children need it
+        queue = list(goto[0].values())
+        for node in queue:
+            for c, child in goto[node].items():
+                queue.append(child)
+                f = fail[node]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(c, 0)
+                fail[child] = f if f != child else 0
+                out[child] = out[child] | out[fail[child]]
+
+    def search(self, text):
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        node = 0
+        for c in text:
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+
+def required_literal(pattern, flags=0):
+    ''' Return the longest literal string that every match of the given regex
+    must contain, or None if we can't find one.
+
+    This is deliberately simple: it only looks at runs of literal characters
+    at the top level of the pattern (and inside plain groups at the top
+    level). Anything fancier ends the current run. If the pattern is case
+    insensitive, the literal is casefolded. A pattern that turns on case
+    insensitivity itself when flags don't has no usable literal. '''
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return None
+    ignore_case = bool(parsed.state.flags & re.IGNORECASE)
+    if ignore_case and not flags & re.IGNORECASE:
+        return None
+    best, run = '', []
+
+    def end_run():
+        nonlocal best, run
+        if len(run) > len(best):
+            best = ''.join(run)
+        run = []
+
+    def walk(items):
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                run.append(chr(av))
+            elif op is sre_parse.SUBPATTERN and not av[1] and not av[2]:
+                # a group with no local flags. Its contents are required.
+                walk(av[3])
+            else:
+                end_run()
+
+    walk(parsed)
+    end_run()
+    if not best:
+        return None
+    return best.casefold() if ignore_case else best
+
+
+class PatternMatcher:
+    ''' Matches text against many regexes at once, reporting the first one
+    (in the order given) that matches.
+
+    Instead of running every regex on every piece of text, first scan the text
+    once with an Aho-Corasick automaton built from a literal string that each
+    regex requires. Only the regexes whose literal was found (and those we
+    couldn't find a literal for) are then actually run, so the cost of
+    checking a message mostly doesn't depend on how many patterns there are.
+
+    All patterns are compiled with the same flags. '''
+    def __init__(self, patterns, flags=0):
+        self._patterns = list(patterns)
+        self._regexes = [re.compile(p, flags) for p in self._patterns]
+        self._ignore_case = bool(flags & re.IGNORECASE)
+        # literal -> indexes of the patterns that require it
+        self._by_literal = {}
+        # indexes of the patterns that we must always run
+        self._always = []
+        for i, p in enumerate(self._patterns):
+            lit = required_literal(p, flags)
+            if lit is None:
+                self._always.append(i)
+            else:
+                self._by_literal.setdefault(lit, []).append(i)
+        self._automaton = AhoCorasick(self._by_literal.keys())
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def search(self, text):
+        ''' Return the first pattern (as it was given to us) that matches
+        text, or None if no pattern matches. '''
+        if not self._patterns:
+            return None
+        scan = text.casefold() if self._ignore_case else text
+        candidates = list(self._always)
+        for lit in self._automaton.search(scan):
+            candidates.extend(self._by_literal[lit])
+        for i in sorted(candidates):
+            if self._regexes[i].search(text):
+                return self._patterns[i]
+        return None
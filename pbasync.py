@@ -0,0 +1,115 @@
+import asyncio
+from queue import Empty, Full, Queue
+from threading import Event
+
+
+# Helpers for classes that can either run in their own thread (the default) or
+# as a coroutine on an asyncio event loop (see run_async() in main.py). They
+# look at gs['loop'] to decide which kind of queue or event to give back.
+# Producers use the same put()/set() calls either way.
+
+
+def _on_loop(loop):
+    ''' Whether we are running in loop's thread '''
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class LoopQueue:
+    ''' A queue whose producers use the queue.Queue API from any thread and
+    whose consumer is a coroutine on the given event loop.
+
+    get() is a coroutine, and like queue.Queue.get() raises queue.Empty if
+    given a timeout that passes without anything to get. '''
+    def __init__(self, loop, maxsize=0):
+        self._loop = loop
+        self._q = asyncio.Queue()
+        self._maxsize = maxsize
+
+    def put(self, item, block=True, timeout=None):
+        # Producers on the loop can't block waiting for the consumer without
+        # deadlocking, so maxsize is only enforced for put_nowait().
+        if _on_loop(self._loop):
+            self._q.put_nowait(item)
+        else:
+            self._loop.call_soon_threadsafe(self._q.put_nowait, item)
+
+    def put_nowait(self, item):
+        if self._maxsize > 0 and self.qsize() >= self._maxsize:
+            raise Full
+        return self.put(item)
+
+    async def get(self, timeout=None):
+        if timeout is None:
+            return await self._q.get()
+        try:
+            return await asyncio.wait_for(self._q.get(), timeout)
+        except asyncio.TimeoutError:
+            raise Empty
+
+    def get_nowait(self):
+        try:
+            return self._q.get_nowait()
+        except asyncio.QueueEmpty:
+            raise Empty
+
+    def qsize(self):
+        return self._q.qsize()
+
+    def empty(self):
+        return self._q.empty()
+
+
+class LoopEvent:
+    ''' An event that can be set/cleared from any thread and waited on by a
+    coroutine on the given event loop. wait() returns whether the event is
+    set, like threading.Event.wait(). '''
+    def __init__(self, loop):
+        self._loop = loop
+        self._event = asyncio.Event()
+        self._is_set = False
+
+    def _call(self, func):
+        if _on_loop(self._loop):
+            func()
+        else:
+            self._loop.call_soon_threadsafe(func)
+
+    def set(self):
+        self._is_set = True
+        self._call(self._event.set)
+
+    def clear(self):
+        self._is_set = False
+        self._call(self._event.clear)
+
+    def is_set(self):
+        return self._is_set
+
+    async def wait(self, timeout=None):
+        if timeout is None:
+            await self._event.wait()
+            return True
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self._is_set
+
+
+def new_queue(gs, maxsize=0):
+    ''' A queue.Queue, or a LoopQueue when running on an event loop '''
+    loop = gs.get('loop')
+    if loop is None:
+        return Queue(maxsize)
+    return LoopQueue(loop, maxsize)
+
+
+def new_event(gs):
+    ''' A threading.Event, or a LoopEvent when running on an event loop '''
+    loop = gs.get('loop')
+    if loop is None:
+        return Event()
+    return LoopEvent(loop)
@@ -25,6 +25,14 @@ class PBThread:
     def join(self, timeout=None):
         return self._thread.join(timeout=timeout)
 
+    # This should probably NOT be reimplemented in children. Instead of
+    # starting the thread, return a coroutine that does this thread's work on
+    # an asyncio event loop (see run_async() in main.py). Children that
+    # support this implement _enter_async, which runs until cancelled.
+    def run_async(self):
+        self._started = True
+        return self._enter_async()
+
     # This probably SHOULD be reimplemented in children. Instead of using a _gs
     # member, it would be smarter to only pull the things out of the global
     # state that the class actually uses. Therefore, reimplement this.
@@ -1,16 +1,252 @@
-from threading import Timer
+import heapq
+import traceback
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
 
+# Every timer in the process is run by one TimerService: a heap of timers and
+# one thread that sleeps until the next is due. When running on an asyncio
+# event loop (see run_async() in main.py) the service uses the loop instead of
+# a thread.
+_loop = None
+_service = None
+# Where timers that raise are logged
+_log = None
 
-def fire_one_off_event(interval, func, args=None, kwargs=None):
-    return Timer(interval, func, args=args, kwargs=kwargs).start()
 
+def use_event_loop(loop):
+    ''' Schedule all timers created from now on on the given asyncio event
+    loop. Pass None to go back to a thread. '''
+    global _loop, _service
+    if _service is not None:
+        _service.stop()
+    _loop = loop
+    _service = None
 
-# https://stackoverflow.com/a/13151104
+
+def use_log(log):
+    ''' Log timers that raise to the given PastlyLogger, instead of printing
+    their tracebacks to stderr '''
+    global _log
+    _log = log
+    if _service is not None:
+        _service.log = log
+
+
+def timer_service():
+    ''' Return the TimerService timers in this process should use, starting
+    it if needed '''
+    global _service
+    if _service is None:
+        _service = TimerService(loop=_loop, log=_log)
+    return _service
+
+
+class TimerHandle:
+    ''' A timer scheduled with a TimerService. Can be cancelled and
+    rescheduled from any thread. '''
+    __slots__ = ['_service', '_seq', 'when', 'name', 'function', 'args',
+                 'kwargs']
+
+    def __init__(self, service, function, args, kwargs, name):
+        self._service = service
+        # Which entry in the service's heap is the live one, or None if the
+        # timer already fired or was cancelled
+        self._seq = None
+        # monotonic() time the timer fires at
+        self.when = None
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    @property
+    def active(self):
+        ''' Whether the timer has yet to fire and wasn't cancelled '''
+        return self._seq is not None
+
+    def remaining(self):
+        ''' Seconds until the timer fires, or None if it won't '''
+        when = self.when
+        if not self.active or when is None:
+            return None
+        return max(0.0, when - monotonic())
+
+    def cancel(self):
+        ''' Returns whether the timer was still waiting to fire '''
+        return self._service._cancel(self)
+
+    def reschedule(self, interval):
+        ''' Make the timer fire interval seconds from now instead of when it
+        was going to. Returns False, and does nothing, if it already fired or
+        was cancelled. '''
+        return self._service._schedule(self, interval, only_if_active=True)
+
+
+class TimerService:
+    ''' Runs timers, all of them from one thread, or on the given asyncio
+    event loop.
+
+    Timers are kept in a heap ordered by when they fire. Cancelling or
+    rescheduling a timer leaves its old entry in the heap to be skipped when
+    it comes up, so both are O(log n). The heap is rebuilt when it is mostly
+    stale entries.
+
+    Timer functions are called in the service's thread (or on the loop), so
+    they must be quick. Hand anything slow to another thread. One that raises
+    is logged to log at warn, if given. '''
+    def __init__(self, loop=None, log=None):
+        self._loop = loop
+        self.log = log
+        self._cond = Condition()
+        # (when, seq, handle)
+        self._heap = []
+        self._seq = count()
+        # Number of handles that are active
+        self._live = 0
+        self._stopped = False
+        self._thread = None
+        # The loop's handle for calling _rearm_loop() when the next timer is
+        # due, when using a loop
+        self._loop_handle = None
+
+    def call_later(self, interval, function, args=None, kwargs=None,
+                   name=None):
+        ''' Call function with the given args and kwargs in interval seconds.
+        Returns a TimerHandle. '''
+        handle = TimerHandle(
+            self, function, args if args is not None else [],
+            kwargs if kwargs is not None else {},
+            name or getattr(function, '__qualname__', repr(function)))
+        self._schedule(handle, interval)
+        return handle
+
+    def pending(self):
+        ''' Return a list of (seconds until it fires, name) for every timer
+        waiting to fire, soonest first '''
+        now = monotonic()
+        with self._cond:
+            pending = [(max(0.0, when - now), handle.name)
+                       for when, seq, handle in self._heap
+                       if handle._seq == seq]
+        return sorted(pending)
+
+    def __len__(self):
+        return self._live
+
+    def stop(self):
+        ''' Forget every timer and stop the thread, if there is one '''
+        with self._cond:
+            self._stopped = True
+            for _, _, handle in self._heap:
+                handle._seq = None
+            self._heap.clear()
+            self._live = 0
+            self._cond.notify()
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._rearm_loop)
+
+    def _schedule(self, handle, interval, only_if_active=False):
+        with self._cond:
+            if self._stopped or (only_if_active and not handle.active):
+                return False
+            if not handle.active:
+                self._live += 1
+            handle._seq = next(self._seq)
+            handle.when = monotonic() + interval
+            heapq.heappush(self._heap, (handle.when, handle._seq, handle))
+            self._maybe_compact()
+            self._cond.notify()
+            if self._loop is None and self._thread is None:
+                self._thread = Thread(target=self._run, name='TimerService',
+                                      daemon=True)
+                self._thread.start()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._rearm_loop)
+        return True
+
+    def _cancel(self, handle):
+        with self._cond:
+            if not handle.active:
+                return False
+            handle._seq = None
+            self._live -= 1
+            return True
+
+    def _maybe_compact(self):
+        # Must hold self._cond
+        if len(self._heap) > 64 and len(self._heap) > 4 * self._live:
+            self._heap = [entry for entry in self._heap
+                          if entry[2]._seq == entry[1]]
+            heapq.heapify(self._heap)
+
+    def _pop_due(self, now):
+        ''' Take the timers that are due out of the heap. Returns them and
+        the time until the next one is due (None if there isn't one). Must
+        hold self._cond. '''
+        due = []
+        heap = self._heap
+        while heap:
+            when, seq, handle = heap[0]
+            if handle._seq != seq:
+                heapq.heappop(heap)
+                continue
+            if when > now:
+                return due, when - now
+            heapq.heappop(heap)
+            handle._seq = None
+            self._live -= 1
+            due.append(handle)
+        return due, None
+
+    def _call(self, handle):
+        try:
+            handle.function(*handle.args, **handle.kwargs)
+        except Exception as e:
+            if self.log is None:
+                traceback.print_exc()
+                return
+            self.log.warn('Timer', handle.name, 'failed:', repr(e))
+            self.log.debug(traceback.format_exc())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    due, timeout = self._pop_due(monotonic())
+                    if due:
+                        break
+                    self._cond.wait(timeout)
+            for handle in due:
+                self._call(handle)
+
+    def _rearm_loop(self):
+        ''' Call the timers that are due, and make sure the loop calls us
+        again when the next one is. Runs on the loop. '''
+        if self._loop_handle is not None:
+            self._loop_handle.cancel()
+            self._loop_handle = None
+        with self._cond:
+            due, timeout = self._pop_due(monotonic())
+        for handle in due:
+            self._call(handle)
+        if timeout is not None:
+            self._loop_handle = self._loop.call_later(
+                timeout, self._rearm_loop)
+
+
+def fire_one_off_event(interval, func, args=None, kwargs=None, name=None):
+    ''' Call func in interval seconds. Returns a TimerHandle for it. '''
+    return timer_service().call_later(interval, func, args=args,
+                                      kwargs=kwargs, name=name)
 
 
 class RepeatedTimer(object):
+    ''' Calls function every interval seconds until stopped '''
     def __init__(self, interval, function, *args, **kwargs):
-        self._timer = None
+        self._handle = None
         self.function = function
         self.interval = interval
         self.args = args
@@ -25,10 +261,11 @@ class RepeatedTimer(object):
 
     def start(self):
         if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
+            self._handle = fire_one_off_event(
+                self.interval, self._run,
+                name=getattr(self.function, '__qualname__', None))
             self.is_running = True
 
     def stop(self):
-        self._timer.cancel()
+        self._handle.cancel()
         self.is_running = False
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+''' Generate lines like the ones ii writes to its out files, for raids and
+other kinds of traffic, to test and benchmark the bot with.
+
+    ./raidgen.py OUT_DIR [--channels N] [--members N] [--chatter N]
+                 [--shape SHAPE=COUNT ...] [--link TEXT] [--rate LINES/S]
+                 [--seed N]
+
+Writes OUT_DIR/out, and OUT_DIR/#raidN/out for each channel, laid out like
+ii's directory for a server (see bench_replay.py). Lines are timestamped as
+if they came --rate a second, starting now.
+
+Everybody in --members joins every channel first. Then come the --shape
+options, one after another in the order given, each COUNT lines long and
+mixed in with an equal share of the --chatter lines of normal conversation.
+The shapes are:
+- join_wave: clones joining, each from its own host
+- mass_highlight: messages that mention lots of people at once
+- slow_highlight: messages that each mention a few people
+- soapbox: messages containing --link
+- flood: a few people saying lots
+- nick_storm: people changing their nicks over and over
+- chatter: more normal conversation
+
+Without any --shape options, one of each is generated. '''
+import os
+import random
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from itertools import count
+
+_WORDS = ['the', 'relay', 'is', 'down', 'again', 'anyone', 'know', 'why',
+          'my', 'bridge', 'works', 'fine', 'thanks', 'for', 'help', 'tor',
+          'browser', 'update', 'circuit', 'onion', 'service', 'exit', 'how',
+          'do', 'i', 'configure', 'it', 'ok', 'cool', 'lol', 'yes', 'no']
+
+
+class RaidGenerator:
+    ''' Makes lists of (source, channel name, line) tuples, where source is
+    'chan' or 'serv' (then channel name is None), and line is what ii would
+    write after the timestamp. Keeps track of who is in each channel, so
+    later lines talk about the right people. '''
+    shapes = ['join_wave', 'mass_highlight', 'slow_highlight', 'soapbox',
+              'flood', 'nick_storm', 'chatter']
+
+    def __init__(self, channel_names, members=200, link='example.com',
+                 seed=None):
+        self._random = random.Random(seed)
+        self._channel_names = list(channel_names)
+        self._link = link
+        self._clone_ids = count()
+        self._nick_ids = count()
+        self._regulars = ['user{}'.format(i) for i in range(members)]
+        # channel name -> nicks in it
+        self._nicks = {channel_name: [] for channel_name in channel_names}
+
+    def generate(self, name, n):
+        ''' n lines of the shape called name '''
+        assert name in RaidGenerator.shapes
+        return getattr(self, name)(n)
+
+    def _channel(self):
+        return self._random.choice(self._channel_names)
+
+    def _nick(self, channel_name):
+        return self._random.choice(self._nicks[channel_name] or ['nobody'])
+
+    def _join(self, channel_name, nick, user, host):
+        self._nicks[channel_name].append(nick)
+        return ('chan', channel_name, '-!- {}({}@{}) has joined {}'.format(
+            nick, user, host, channel_name))
+
+    def members_joining(self):
+        ''' Everybody in members joining every channel '''
+        return [self._join(channel_name, nick, '~' + nick,
+                           '{}.example.org'.format(nick))
+                for channel_name in self._channel_names
+                for nick in self._regulars]
+
+    def chatter(self, n):
+        lines = []
+        for _ in range(n):
+            channel_name = self._channel()
+            words = self._random.choices(_WORDS, k=self._random.randint(2, 12))
+            lines.append(('chan', channel_name, '<{}> {}'.format(
+                self._nick(channel_name), ' '.join(words))))
+        return lines
+
+    def join_wave(self, n):
+        lines = []
+        for _ in range(n):
+            i = next(self._clone_ids)
+            lines.append(self._join(self._channel(), 'clone{}'.format(i),
+                                    '~clone', 'raid{}.example.net'.format(i)))
+        return lines
+
+    def _highlight(self, n, mentions):
+        lines = []
+        for _ in range(n):
+            channel_name = self._channel()
+            nicks = self._nicks[channel_name]
+            mentioned = self._random.sample(nicks, min(mentions, len(nicks)))
+            lines.append(('chan', channel_name, '<{}> {}'.format(
+                self._nick(channel_name), ' '.join(mentioned))))
+        return lines
+
+    def mass_highlight(self, n):
+        return self._highlight(n, 30)
+
+    def slow_highlight(self, n):
+        return self._highlight(n, 3)
+
+    def soapbox(self, n):
+        lines = []
+        for _ in range(n):
+            channel_name = self._channel()
+            lines.append(('chan', channel_name, '<{}> go to {} right now'
+                          .format(self._nick(channel_name), self._link)))
+        return lines
+
+    def flood(self, n):
+        channel_name = self._channel()
+        speakers = [self._nick(channel_name) for _ in range(3)]
+        return [('chan', channel_name, '<{}> {}'.format(
+            self._random.choice(speakers), self._random.choice(_WORDS)))
+            for _ in range(n)]
+
+    def nick_storm(self, n):
+        lines = []
+        for _ in range(n):
+            channel_name = self._channel()
+            nicks = self._nicks[channel_name]
+            if not nicks:
+                continue
+            i = self._random.randrange(len(nicks))
+            old = nicks[i]
+            new = 'nick{}'.format(next(self._nick_ids))
+            # Nicks are the same in every channel
+            for others in self._nicks.values():
+                if old in others:
+                    others[others.index(old)] = new
+            lines.append(('serv', None, '-!- {} changed nick to {}'.format(
+                old, new)))
+        return lines
+
+    def mixed(self, shapes, chatter):
+        ''' Everybody joining, followed by each of shapes (a list of (name,
+        n)) one after another, all mixed in with chatter lines of chatter '''
+        lines = self.members_joining()
+        share = chatter // (len(shapes) + 1)
+        lines.extend(self.chatter(share))
+        for name, n in shapes:
+            lines.extend(self._interleave(self.generate(name, n),
+                                          self.chatter(share)))
+        return lines
+
+    def _interleave(self, a, b):
+        ''' Mix a and b together randomly, keeping each in order '''
+        lines = []
+        i, j = 0, 0
+        while i < len(a) or j < len(b):
+            if self._random.random() * (len(a) - i + len(b) - j) < len(a) - i:
+                lines.append(a[i])
+                i += 1
+            else:
+                lines.append(b[j])
+                j += 1
+        return lines
+
+
+def add_arguments(parser):
+    ''' Add the options that say what traffic to generate to parser '''
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--members', type=int, default=200,
+                        help='People in each channel before anything happens')
+    parser.add_argument('--chatter', type=int, default=10000,
+                        help='Lines of normal conversation')
+    parser.add_argument('--shape', action='append', default=[],
+                        metavar='SHAPE=COUNT', help='One of: {}'.format(
+                            ', '.join(RaidGenerator.shapes)))
+    parser.add_argument('--link', default='example.com',
+                        help='What soapboxers link to')
+    parser.add_argument('--seed', type=int)
+
+
+def generate(args):
+    ''' Return the channel names and lines the options parsed into args ask
+    for '''
+    shapes = []
+    for shape in args.shape or \
+            ['{}=1000'.format(s) for s in RaidGenerator.shapes[:-1]]:
+        name, _, n = shape.partition('=')
+        if name not in RaidGenerator.shapes or not n.isdigit():
+            raise ValueError('Bad --shape {}'.format(shape))
+        shapes.append((name, int(n)))
+    channel_names = ['#raid{}'.format(i) for i in range(args.channels)]
+    gen = RaidGenerator(channel_names, members=args.members, link=args.link,
+                        seed=args.seed)
+    return channel_names, gen.mixed(shapes, args.chatter)
+
+
+def write(out_dir, channel_names, lines, rate):
+    ''' Write lines to out files in out_dir, as if they came rate a
+    second '''
+    fds = {None: open(os.path.join(out_dir, 'out'), 'wt')}
+    for channel_name in channel_names:
+        os.makedirs(os.path.join(out_dir, channel_name), exist_ok=True)
+        fds[channel_name] = open(
+            os.path.join(out_dir, channel_name, 'out'), 'wt')
+    start = datetime.now()
+    for i, (_, channel_name, line) in enumerate(lines):
+        ts = start + timedelta(seconds=i / rate)
+        fds[channel_name].write('{} {}\n'.format(
+            ts.strftime('%Y-%m-%d %H:%M'), line))
+    for fd in fds.values():
+        fd.close()
+
+
+def main(args):
+    channel_names, lines = generate(args)
+    os.makedirs(args.out_dir, exist_ok=True)
+    write(args.out_dir, channel_names, lines, args.rate)
+    print('Wrote', len(lines), 'lines to', args.out_dir)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('out_dir')
+    add_arguments(parser)
+    parser.add_argument('--rate', type=float, default=100,
+                        help='Lines a second, for the timestamps')
+    main(parser.parse_args())
@@ -0,0 +1,327 @@
+import zlib
+from itertools import count
+from threading import Event, Lock
+from pbthread import PBThread
+from pbtimer import timer_service
+
+# Support for spreading the moderated channels over more than one process
+# (see run_shard_worker() in main.py). The main process keeps the one
+# OutboundMessageThread, so every message still goes through the same rate
+# limit and the same ii FIFO, along with the CommandListenerThread and
+# HeartbeatThread. Each shard worker process runs the ChanOpThreads and
+# OperatorActionThreads for its channels, and a HeartbeatThread that counts
+# their events and sends the totals to the main one now and then.
+#
+# The processes talk over a ShardLinkThread at each end of a pipe. Threads
+# that live in the other process are stood in for by a RemoteThread, so code
+# like ChanOpThread doesn't need to know whether its OutboundMessageThread is
+# in the same process or not.
+
+
+def shard_for(channel_name, shards):
+    ''' Which of the given number of shards moderates channel_name. Unlike
+    hash(), this gives the same answer in every process. '''
+    return zlib.crc32(channel_name.casefold().encode('utf8')) % shards
+
+
+def split_channels(channel_names, shards):
+    ''' Return a list with, for each shard, the list of channel names it
+    moderates '''
+    split = [[] for _ in range(shards)]
+    for channel_name in channel_names:
+        split[shard_for(channel_name, shards)].append(channel_name)
+    return split
+
+
+class RemoteMethod:
+    ''' A method of a thread in the process at the other end of a
+    ShardLinkThread. Calling it calls the real method without waiting for it
+    to finish. It can also be sent to the other process (for example as
+    an argument to OutboundMessageThread.add()), where it turns back into
+    the real method. '''
+    def __init__(self, link, target, channel, method):
+        self._link = link
+        self.target = target
+        self.channel = channel
+        self.method = method
+
+    def __call__(self, *args, **kwargs):
+        self._link.cast(self.target, self.channel, self.method,
+                        *args, **kwargs)
+
+    def __reduce__(self):
+        return (RemoteMethod, (None, self.target, self.channel, self.method))
+
+
+class RemoteThread:
+    ''' Stands in for a thread in the process at the other end of the given
+    link. target is the thread's key in gs['threads'] over there, and
+    channel its key within that if it is one of the per-channel threads.
+
+    Any method called on it is called on the real thread without waiting for
+    it to finish, so only methods that don't return anything useful (which
+    is most of the ones that say "Call from other threads") work this way. '''
+    def __init__(self, link, target, channel=None):
+        self._link = link
+        self._target = target
+        self._channel = channel
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return RemoteMethod(self._link, self._target, self._channel, method)
+
+
+class RemoteMemberList:
+    ''' Enough of a MemberList in another process for the
+    CommandListenerThread to look members up in it '''
+    def __init__(self, link, channel):
+        self._link = link
+        self._channel = channel
+
+    def contains(self, nick=None, user=None, host=None):
+        return bool(self._link.call(
+            'chan_ops', self._channel, 'members.contains',
+            nick=nick, user=user, host=host))
+
+    def __getitem__(self, nick):
+        return self._link.call(
+            'chan_ops', self._channel, 'members.__getitem__', nick)
+
+    def __len__(self):
+        return self._link.call('chan_ops', self._channel, 'members.__len__')
+
+
+class RemoteChanOp(RemoteThread):
+    ''' Stands in for a ChanOpThread in a shard worker process '''
+    def __init__(self, link, channel):
+        RemoteThread.__init__(self, link, 'chan_ops', channel)
+        self._members = RemoteMemberList(link, channel)
+
+    @property
+    def channel_name(self):
+        return self._channel
+
+    @property
+    def members(self):
+        return self._members
+
+
+class OutboundProxy(RemoteThread):
+    ''' Stands in for the OutboundMessageThread in shard worker processes.
+
+    Functions given to add() that belong to the real OutboundMessageThread
+    (omt.privmsg, omt.servmsg, etc. where omt is this proxy) are sent to it
+    to be done in turn with everybody else's. Any other function, like
+    ChanOpThread asking itself to fetch the member list, lives in this
+    process, so it is called right away here. '''
+    def __init__(self, link):
+        RemoteThread.__init__(self, link, 'out_message')
+
+    def add(self, func, args=None, kwargs=None, priority=None, lane=None):
+        if isinstance(func, RemoteMethod):
+            return self._link.cast(
+                'out_message', None, 'add', func, args, kwargs, priority,
+                lane=lane)
+        return func(*(args or []), **(kwargs or {}))
+
+
+class ShardedMemberRegistry:
+    ''' Stands in for the MemberRegistry in the main process when the
+    channels are spread over shard worker processes. Queries are sent to
+    every shard at once, and their answers merged. Members that come back
+    are copies that don't know which channels they are in. '''
+    def __init__(self, links):
+        self._links = links
+
+    def _ask(self, method, *args, **kwargs):
+        pending = [link.request('member_registry', None, method,
+                                *args, **kwargs)
+                   for link in self._links]
+        return [p.result() for p in pending]
+
+    def find(self, nick):
+        for m in self._ask('find', nick):
+            if m is not None:
+                return m
+        return None
+
+    def channels(self, nick):
+        chans = set()
+        for c in self._ask('channels', nick):
+            chans.update(c or ())
+        return chans
+
+    def matches(self, user=None, host=None):
+        merged = {'user': {}, 'host': {}}
+        for matches in self._ask('matches', user=user, host=host):
+            if matches is None:
+                continue
+            for which in merged:
+                for nick, chans in matches[which].items():
+                    merged[which].setdefault(nick, set()).update(chans)
+        return merged
+
+    def wildcard(self, partial, star_front, star_back, limit=None):
+        # The same nick can be in more than one shard, so each must give us
+        # every match for the count to be right
+        merged = {}
+        for res in self._ask('wildcard', partial, star_front, star_back):
+            if res is None:
+                continue
+            for nick, chans in res[1].items():
+                merged.setdefault(nick, set()).update(chans)
+        nicks = sorted(merged)
+        if limit is not None:
+            nicks = nicks[:limit]
+        return len(merged), {n: merged[n] for n in nicks}
+
+
+class _Pending:
+    def __init__(self, link, req_id):
+        self._link = link
+        self._req_id = req_id
+        self._done = Event()
+        self._result = None
+
+    def _set(self, result):
+        self._result = result
+        self._done.set()
+
+    def result(self, timeout=5):
+        if not self._done.wait(timeout):
+            self._link._forget(self._req_id)
+            self._link._log.warn('Gave up waiting for a reply from',
+                                 self._link.peer)
+        return self._result
+
+
+class ShardLinkThread(PBThread):
+    ''' One end of the pipe between the main process and a shard worker
+    process. This thread reads from the pipe and does what the other end
+    asks: calling methods on threads in this process, or handing back the
+    answers to what this end asked.
+
+    Messages are tuples:
+    - ('call', req_id, target, channel, method, args, kwargs): call method on
+      gs['threads'][target] (or gs['member_registry'], gs['log'], or the
+      timer_service()), indexed by channel if given. method may be dotted,
+      like 'members.contains'. If req_id isn't None, send back ('reply',
+      req_id, result).
+    - ('stop',): the other end wants us to go away '''
+    def __init__(self, global_state, conn, peer):
+        PBThread.__init__(self, self._enter,
+                          name='ShardLink-{}'.format(peer))
+        self.peer = peer
+        self._conn = conn
+        self._send_lock = Lock()
+        self._req_ids = count()
+        # req_id -> _Pending
+        self._waiting = {}
+        self._waiting_lock = Lock()
+        self.update_global_state(global_state)
+
+    def update_global_state(self, gs):
+        self._log = gs['log']
+        self._threads = gs['threads']
+        self._member_registry = gs['member_registry']
+
+    def _enter(self):
+        log = self._log
+        log.info('Started ShardLinkThread instance to', self.peer)
+        while True:
+            try:
+                msg = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            if msg[0] == 'stop':
+                break
+            elif msg[0] == 'reply':
+                with self._waiting_lock:
+                    pending = self._waiting.pop(msg[1], None)
+                if pending is not None:
+                    pending._set(msg[2])
+            elif msg[0] == 'call':
+                self._proc_call(*msg[1:])
+            else:
+                log.warn('Ignoring unknown message from', self.peer, msg[0])
+        self._shutdown()
+
+    def _shutdown(self):
+        with self._waiting_lock:
+            waiting, self._waiting = self._waiting, {}
+        for pending in waiting.values():
+            pending._set(None)
+        self._log.info('ShardLinkThread to', self.peer, 'going away')
+
+    def _resolve(self, target, channel, method=None):
+        if target == 'member_registry':
+            obj = self._member_registry
+        elif target == 'log':
+            obj = self._log
+        elif target == 'timers':
+            obj = timer_service()
+        else:
+            obj = self._threads[target]
+        if channel is not None:
+            obj = obj[channel]
+        if method is not None:
+            for attr in method.split('.'):
+                obj = getattr(obj, attr)
+        return obj
+
+    def _unwrap(self, value):
+        ''' Turn RemoteMethods that came from the other end back into the
+        methods they refer to in this process '''
+        if isinstance(value, RemoteMethod):
+            return self._resolve(value.target, value.channel, value.method)
+        if type(value) in (list, tuple):
+            return type(value)(self._unwrap(v) for v in value)
+        return value
+
+    def _proc_call(self, req_id, target, channel, method, args, kwargs):
+        result = None
+        try:
+            func = self._resolve(target, channel, method)
+            result = func(*self._unwrap(args), **kwargs)
+        except Exception as e:
+            self._log.warn('Failed to call', target, channel, method,
+                           'for', self.peer, e)
+        if req_id is not None:
+            self._send(('reply', req_id, result))
+
+    def _send(self, msg):
+        with self._send_lock:
+            try:
+                self._conn.send(msg)
+            except (BrokenPipeError, OSError) as e:
+                self._log.warn('Could not send to', self.peer, e)
+
+    def _forget(self, req_id):
+        with self._waiting_lock:
+            self._waiting.pop(req_id, None)
+
+    def cast(self, target, channel, method, *args, **kwargs):
+        ''' Call from any thread. Call method on the other end without
+        waiting for it. '''
+        self._send(('call', None, target, channel, method, args, kwargs))
+
+    def request(self, target, channel, method, *args, **kwargs):
+        ''' Call from any thread. Call method on the other end, returning
+        something whose result() waits for the return value. '''
+        pending = _Pending(self, next(self._req_ids))
+        with self._waiting_lock:
+            self._waiting[pending._req_id] = pending
+        self._send(('call', pending._req_id, target, channel, method,
+                    args, kwargs))
+        return pending
+
+    def call(self, target, channel, method, *args, **kwargs):
+        ''' Call from any thread other than this one. Call method on the
+        other end and wait for its return value. '''
+        return self.request(target, channel, method,
+                            *args, **kwargs).result()
+
+    def stop(self):
+        ''' Tell the other end to go away '''
+        self._send(('stop',))
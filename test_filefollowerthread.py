@@ -0,0 +1,58 @@
+import os
+from threading import Event
+from filefollowerthread import FileFollowerThread
+from pastlylogger import PastlyLogger
+
+
+def new_follower():
+    gs = {'log': PastlyLogger(), 'events': {'kill_watches': Event()}}
+    return FileFollowerThread(gs)
+
+
+def append(fname, text):
+    with open(fname, 'at') as fd:
+        fd.write(text)
+
+
+def test_replaced_file_gone_before_open(tmp_path, monkeypatch):
+    ''' The file is replaced, and then disappears between the stat that
+    notices and the open of the new one '''
+    fname = str(tmp_path / 'out')
+    append(fname, 'old\n')
+    ff = new_follower()
+    lines = []
+    ff.follow(fname, lines.append)
+    append(fname, 'one\n')
+    os.unlink(fname)
+    append(fname, 'two\n')
+    real_open = os.open
+
+    def open_after_unlink(path, *args, **kwargs):
+        os.unlink(path)
+        return real_open(path, *args, **kwargs)
+    monkeypatch.setattr(os, 'open', open_after_unlink)
+    ff._check_all()
+    assert lines == ['one']
+    monkeypatch.setattr(os, 'open', real_open)
+    append(fname, 'three\n')
+    ff._check_all()
+    assert lines == ['one', 'three']
+
+
+def test_callback_can_unfollow(tmp_path):
+    ''' Callbacks are called without the lock held '''
+    fname = str(tmp_path / 'out')
+    append(fname, '')
+    ff = new_follower()
+    lines = []
+
+    def callback(line):
+        lines.append(line)
+        ff.unfollow(fname)
+    ff.follow(fname, callback)
+    append(fname, 'one\n')
+    ff._check_all()
+    assert lines == ['one']
+    append(fname, 'two\n')
+    ff._check_all()
+    assert lines == ['one']
@@ -0,0 +1,66 @@
+import time
+from configparser import ConfigParser
+from threading import Event
+import latency
+from heartbeatthread import HeartbeatThread
+from latency import Trace, latencies, tracing
+from operatoractionthread import OperatorActionThread
+from outboundmessagethread import OutboundMessageThread
+from pastlylogger import PastlyLogger
+
+
+class Sink:
+    ''' Stands in for the FifoWriter to the server's in FIFO '''
+    def __init__(self):
+        self.lines = []
+        self.writes = 0
+        self.write_seconds = 0.0
+
+    def add(self, line):
+        self.lines.append(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def new_global_state():
+    conf = ConfigParser()
+    conf.read_dict({'ii': {'ircdir': '/nonexistent', 'server': 'localhost'}})
+    gs = {'log': PastlyLogger(), 'conf': conf, 'threads': {},
+          'events': {name: Event() for name in [
+              'kill_heartbeat', 'kill_opactions', 'kill_outmessage']}}
+    gs['threads']['heart'] = HeartbeatThread(gs)
+    return gs
+
+
+def test_not_opped_total_includes_op_wait(monkeypatch):
+    monkeypatch.setattr(latency, '_latencies', None)
+    gs = new_global_state()
+    sink = Sink()
+    omt = OutboundMessageThread(gs, long_timeout=0.1, server_in=sink)
+    gs['threads']['out_message'] = omt
+    oat = OperatorActionThread(gs, '#test')
+    omt.start()
+    oat.start()
+    try:
+        with tracing(Trace.start(time.monotonic())):
+            oat.kick_nick('spammer', 'testing')
+        time.sleep(0.2)
+        oat.set_opped(True)
+        give_up_at = time.monotonic() + 5
+        while not any(line.startswith('/kick') for line in sink.lines):
+            assert time.monotonic() < give_up_at
+            time.sleep(0.01)
+    finally:
+        gs['events']['kill_opactions'].set()
+        oat.join()
+        gs['events']['kill_outmessage'].set()
+        omt.join()
+    assert any(' op #test ' in line for line in sink.lines)
+    op_wait, total = latencies()['op_wait'], latencies()['total']
+    assert op_wait.count == 1
+    assert total.count == 1
+    assert total.max >= op_wait.max >= 0.2
@@ -1,4 +1,36 @@
+from array import array
 from time import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _refill(tokens, last_action, full, refill_rate, now):
+    ''' Give a bucket the tokens it earned since last_action, up to full.
+    Returns the new tokens and last_action. Time that didn't earn a whole
+    token yet isn't lost, unless the bucket is full. '''
+    if tokens >= full:
+        return tokens, now
+    earned = int((now - last_action) // refill_rate)
+    if tokens + earned >= full:
+        return full, now
+    if earned <= 0:
+        return tokens, last_action
+    return tokens + earned, last_action + earned * refill_rate
+
+
+class TokenBucketState:
+    ''' The state of one token bucket made by token_bucket() '''
+    __slots__ = ['tokens', 'last_action']
+
+    def __init__(self, tokens, last_action=0):
+        self.tokens = tokens
+        self.last_action = last_action
+
+    def __repr__(self):
+        return 'TokenBucketState(tokens={}, last_action={})'.format(
+            self.tokens, self.last_action)
 
 
 def token_bucket(size_, refill_rate_):
@@ -19,32 +51,186 @@ def token_bucket(size_, refill_rate_):
     It takes one argument: its previous state
     It returns two values:
     - the amount of time that must be waited before doing another action; and
-    - its new state '''
+    - its new state
+
+    The state is a TokenBucketState. The tokens earned since the last action
+    are worked out in one step, however long ago it was. '''
 
     def closure_token_bucket(state):
         size = size_
         refill_rate = refill_rate_
         # If no state yet, initialize it.
         if not state:
-            state = {'tokens': size, 'last_action': 0}
+            state = TokenBucketState(size)
         # By calling this function, we know we have performed an action and
-        # must therefore spend a token
-        state['tokens'] -= 1
-        # Now calculate how many more tokens we can give ourselves based on how
-        # much time has passed since the last action
-        now = time()
-        time_since_last_action = now - state['last_action']
-        state['last_action'] = now
-        # Gives ourselves more tokens until
-        # - we hit the max; or
-        # - haven't earned any more
-        while state['tokens'] < size - 1 and \
-                time_since_last_action > refill_rate:
-            state['tokens'] += 1
-            time_since_last_action -= refill_rate
-        if state['tokens'] > 0:
+        # must therefore spend a token. Then give ourselves the tokens we
+        # earned since the last action, up to one less than the size.
+        state.tokens, state.last_action = _refill(
+            state.tokens - 1, state.last_action, size - 1, refill_rate,
+            time())
+        if state.tokens > 0:
             return 0, state
         else:
             return refill_rate, state
 
     return closure_token_bucket
+
+
+class TokenBucketArray:
+    ''' Many token buckets of the same size and refill rate, one per key (for
+    example one per nick), that work like the ones token_bucket() makes.
+
+    The buckets' state is kept in two arrays of doubles instead of an object
+    per bucket, so hundreds of thousands of them are cheap. If use_numpy is
+    True (the default when NumPy is installed) the arrays are NumPy arrays,
+    and spend_many() and refill_all() work on all the buckets they are given
+    at once.
+
+    Not thread safe. '''
+    def __init__(self, size, refill_rate, use_numpy=None):
+        self._size = size
+        self._refill_rate = refill_rate
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ImportError('NumPy is not installed')
+        self._numpy = use_numpy
+        # key -> index into the arrays
+        self._index = {}
+        self._tokens = self._new_array(16)
+        self._last_action = self._new_array(16)
+        # indexes not used by any key, lowest last
+        self._free = list(range(15, -1, -1))
+
+    def _new_array(self, n):
+        if self._numpy:
+            return numpy.zeros(n)
+        return array('d', bytes(8 * n))
+
+    def _grow(self):
+        n = len(self._tokens)
+        if self._numpy:
+            self._tokens = numpy.concatenate((self._tokens, numpy.zeros(n)))
+            self._last_action = numpy.concatenate(
+                (self._last_action, numpy.zeros(n)))
+        else:
+            self._tokens.extend(self._new_array(n))
+            self._last_action.extend(self._new_array(n))
+        self._free.extend(range(2 * n - 1, n - 1, -1))
+
+    def _slot(self, key):
+        i = self._index.get(key)
+        if i is None:
+            if not self._free:
+                self._grow()
+            i = self._free.pop()
+            self._index[key] = i
+            self._tokens[i] = self._size
+            self._last_action[i] = 0
+        return i
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def forget(self, key):
+        ''' Drop key's bucket. It starts out full if key comes back. '''
+        i = self._index.pop(key, None)
+        if i is not None:
+            self._free.append(i)
+
+    def rename(self, old_key, new_key):
+        ''' Give old_key's bucket to new_key, replacing any it had '''
+        i = self._index.pop(old_key, None)
+        if i is None:
+            return
+        self.forget(new_key)
+        self._index[new_key] = i
+
+    def clear(self):
+        self._index.clear()
+        self._free = list(range(len(self._tokens) - 1, -1, -1))
+
+    def tokens(self, key):
+        ''' How many tokens key's bucket had after its last spend() or
+        refill_all() '''
+        i = self._index.get(key)
+        return self._size if i is None else float(self._tokens[i])
+
+    def is_full(self, key, now=None):
+        ''' Whether key's bucket has earned all the tokens it can by now, so
+        that forgetting it makes no difference to spend()s from now on '''
+        if now is None:
+            now = time()
+        i = self._index.get(key)
+        if i is None:
+            return True
+        # A spend() now would leave a new bucket with size - 1 tokens
+        tokens, _ = _refill(self._tokens[i] - 1, self._last_action[i],
+                            self._size - 1, self._refill_rate, now)
+        return tokens >= self._size - 1
+
+    def spend(self, key, now=None):
+        ''' Spend a token from key's bucket, creating it if needed. Like the
+        function token_bucket() makes, returns how long key must wait before
+        doing another action. '''
+        if now is None:
+            now = time()
+        i = self._slot(key)
+        tokens, last_action = _refill(
+            self._tokens[i] - 1, self._last_action[i], self._size - 1,
+            self._refill_rate, now)
+        self._tokens[i] = tokens
+        self._last_action[i] = last_action
+        return 0 if tokens > 0 else self._refill_rate
+
+    def spend_many(self, keys, now=None):
+        ''' spend() once for each of keys, all at the same time now. Returns
+        a list of the wait times, in the same order as keys. '''
+        if now is None:
+            now = time()
+        if not self._numpy or len(set(keys)) != len(keys):
+            # Spending twice from the same bucket has to be done in order
+            return [self.spend(key, now) for key in keys]
+        idx = numpy.fromiter((self._slot(key) for key in keys),
+                             dtype=numpy.intp, count=len(keys))
+        tokens, last_action = self._refill_np(
+            self._tokens[idx] - 1, self._last_action[idx], self._size - 1,
+            now)
+        self._tokens[idx] = tokens
+        self._last_action[idx] = last_action
+        return numpy.where(tokens > 0, 0, self._refill_rate).tolist()
+
+    def refill_all(self, now=None):
+        ''' Give every bucket the tokens it earned by now, so tokens() is up
+        to date. Doesn't change what later spend()s return. '''
+        if now is None:
+            now = time()
+        if not self._index:
+            return
+        if not self._numpy:
+            for i in self._index.values():
+                self._tokens[i], self._last_action[i] = _refill(
+                    self._tokens[i], self._last_action[i], self._size,
+                    self._refill_rate, now)
+            return
+        idx = numpy.fromiter(self._index.values(), dtype=numpy.intp,
+                             count=len(self._index))
+        tokens, last_action = self._refill_np(
+            self._tokens[idx], self._last_action[idx], self._size, now)
+        self._tokens[idx] = tokens
+        self._last_action[idx] = last_action
+
+    def _refill_np(self, tokens, last_action, full, now):
+        ''' _refill() for arrays of buckets '''
+        earned = numpy.maximum(
+            numpy.floor((now - last_action) / self._refill_rate), 0)
+        fills = tokens + earned >= full
+        new_tokens = numpy.where(fills | (tokens >= full),
+                                 numpy.maximum(tokens, full), tokens + earned)
+        new_last_action = numpy.where(
+            fills | (tokens >= full), now,
+            last_action + earned * self._refill_rate)
+        return new_tokens, new_last_action
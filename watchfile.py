@@ -0,0 +1,73 @@
+from time import monotonic
+from iievent import parse_line
+
+
+class WatchFile:
+    ''' Watches one of ii's out files and hands each new line, parsed into an
+    IIEvent, to the threads that want it.
+
+    The reading itself is done by the FileFollowerThread, which follows all
+    the files at once. Call start() once the global state has everything in
+    it to start getting lines. '''
+    def __init__(self, fname, source, global_state, channel_name=None):
+        # if <source> == 'chan' or 'comm', then <channel_name> must be given.
+        # Otherwise, it must not be given
+        assert source in ['chan', 'comm', 'serv', 'priv']
+        if source in ['chan', 'comm']:
+            assert channel_name is not None
+        else:
+            assert channel_name is None
+        self._fname = fname
+        self._source = source
+        self._channel_name = channel_name
+        self.update_global_state(global_state)
+
+    @property
+    def fname(self):
+        return self._fname
+
+    @property
+    def source(self):
+        return self._source
+
+    def lines_read(self):
+        return self._file_follower.lines_read(self._fname)
+
+    def start(self):
+        log = self._log
+        log.info('Starting WatchFile', self._source, self._fname)
+        self._file_follower.follow(self._fname, self._recv_line)
+        return self
+
+    def stop(self):
+        self._file_follower.unfollow(self._fname)
+        log = self._log
+        if log:
+            log.info('WatchFile', self._source, self._fname, 'going away')
+
+    def _recv_line(self, line):
+        ''' Called in the FileFollowerThread with every new line '''
+        # Parse the line once here instead of in every thread that gets it
+        ev = parse_line(self._source, line, received_at=monotonic())
+        if self._source == 'chan':
+            assert self._channel_name in self._chanop_threads
+            t = self._chanop_threads[self._channel_name]
+            t.recv_event(ev)
+        elif self._source == 'serv':
+            # ChanOpThreads don't care about the other sources
+            for t in self._chanop_threads:
+                self._chanop_threads[t].recv_event(ev)
+        if self._command_thread:
+            self._command_thread.recv_event(ev)
+
+    def update_global_state(self, gs):
+        self._log = gs['log']
+        chanop_threads = gs['threads']['chan_ops']
+        if self._source == 'chan':
+            assert self._channel_name in chanop_threads
+        self._chanop_threads = gs['threads']['chan_ops']
+        self._command_thread = gs['threads']['command_listener']
+        self._file_follower = gs['threads']['file_follower']
+        if self._log:
+            self._log.info('WatchFile', self._source, self._fname,
+                           'updated state')